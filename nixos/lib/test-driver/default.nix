@@ -7,7 +7,6 @@
   coreutils,
   imagemagick_light,
   ipython,
-  junit-xml,
   ptpython,
   pydantic,
   python,
@@ -46,7 +45,6 @@ buildPythonApplication {
   dependencies = [
     colorama
     ipython
-    junit-xml
     ptpython
     pydantic
     remote-pdb
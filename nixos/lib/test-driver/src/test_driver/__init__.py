@@ -56,6 +56,17 @@ def writeable_dir(arg: str) -> Path:
     return path
 
 
+def non_negative_int(arg: str) -> int:
+    """Raises an ArgumentTypeError if the given argument isn't an integer >= 0"""
+    try:
+        value = int(arg)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{arg} is not an integer")
+    if value < 0:
+        raise argparse.ArgumentTypeError(f"{arg} is negative")
+    return value
+
+
 def formatwarning(
     message: Warning | str,
     category: type[Warning],
@@ -100,6 +111,11 @@ def main() -> None:
         help="re-use a machine state coming from a previous run",
         action="store_true",
     )
+    arg_parser.add_argument(
+        "--snapshot-subtests",
+        help="boot the VMs once, snapshot them and restore that snapshot before every subtest",
+        action="store_true",
+    )
     arg_parser.add_argument(
         "-I",
         "--interactive",
@@ -123,6 +139,12 @@ def main() -> None:
         help="Enable JunitXML report generation to the given path",
         type=Path,
     )
+    arg_parser.add_argument(
+        "--junit-xml-max-output",
+        metavar="CHARS",
+        help="Truncate the output of each test case in the JunitXML report to the given number of characters",
+        type=non_negative_int,
+    )
     log_level_map = {level.name.lower(): level for level in LogLevel}
     arg_parser.add_argument(
         "--log-level",
@@ -148,7 +170,12 @@ def main() -> None:
         logger.add_logger(XMLLogger(os.environ["LOGFILE"]))
 
     if args.junit_xml:
-        logger.add_logger(JunitXMLLogger(output_directory / args.junit_xml))
+        logger.add_logger(
+            JunitXMLLogger(
+                output_directory / args.junit_xml,
+                max_output_chars=args.junit_xml_max_output,
+            )
+        )
 
     if args.log_level:
         logger.set_log_level(log_level_map[args.log_level])
@@ -168,6 +195,7 @@ def main() -> None:
         logger=logger,
         keep_machine_state=args.keep_machine_state,
         debug=debugger,
+        snapshot_subtests=args.snapshot_subtests,
     ) as driver:
         if driver.config.enable_ssh_backdoor:
             driver.dump_machine_ssh()
@@ -7,7 +7,8 @@ import sys
 import tempfile
 import threading
 import traceback
-from collections.abc import Callable, Generator, Iterator
+from collections.abc import Callable, Generator, Iterator, Sequence
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import AbstractContextManager, contextmanager
 from dataclasses import dataclass
 from pathlib import Path
@@ -19,7 +20,7 @@ from pydantic import BaseModel
 
 from test_driver.debug import DebugAbstract, DebugNop
 from test_driver.errors import MachineError, RequestedAssertionFailed
-from test_driver.logger import AbstractLogger
+from test_driver.logger import AbstractLogger, RecordingLogger
 from test_driver.machine import (
     BaseMachine,
     MachineDeprecationWrapper,
@@ -85,6 +86,10 @@ def pythonize_name(name: str) -> str:
     return re.sub(r"^[^A-Za-z_]|[^A-Za-z0-9_]", "_", name)
 
 
+# Name of the snapshot that subtests start from with `snapshot_subtests`
+SUBTEST_SNAPSHOT = "nixos-test-subtest"
+
+
 def in_nix_sandbox() -> bool:
     # There seems to be no better method at the time
     typical_nix_env_vars = "NIX_BUILD_TOP" in os.environ
@@ -144,6 +149,8 @@ class Driver:
     polling_conditions: list[PollingCondition]
     race_timer: threading.Timer
     keep_machine_state: bool
+    snapshot_subtests: bool
+    subtest_depth: int
     logger: AbstractLogger
     debug: DebugAbstract
     vhost_vsock: VHostDeviceVsock | None = None
@@ -155,6 +162,7 @@ class Driver:
         logger: AbstractLogger,
         keep_machine_state: bool = False,
         debug: DebugAbstract = DebugNop(),
+        snapshot_subtests: bool = False,
     ):
         self.config = config
         self.tests = config.test_script.read_text()
@@ -163,6 +171,9 @@ class Driver:
         self.debug = debug
         self.polling_conditions = []
         self.keep_machine_state = keep_machine_state
+        self.snapshot_subtests = snapshot_subtests
+        self.subtest_snapshot_taken = False
+        self.subtest_depth = 0
 
     def __enter__(self) -> "Driver":
         self.race_timer = threading.Timer(
@@ -304,11 +315,40 @@ class Driver:
         """Group logs under a given test name"""
         with self.logger.subtest(name):
             try:
-                yield
+                # Restoring in a nested subtest would wipe its parent's state
+                if self.snapshot_subtests and self.subtest_depth == 0:
+                    self.reset_for_subtest()
+                self.subtest_depth += 1
+                try:
+                    yield
+                finally:
+                    self.subtest_depth -= 1
             except Exception as e:
                 self.logger.log_test_error(f'Test "{name}" failed with error: "{e}"')
                 raise e
 
+    def reset_for_subtest(self) -> None:
+        """
+        Before the first subtest, boot all VMs up to `multi-user.target` and
+        take a snapshot of them. Before every other top-level subtest, restore
+        that snapshot, so each one starts from the same freshly booted state.
+        """
+
+        def take_snapshot(machine: BaseMachine) -> None:
+            assert isinstance(machine, QemuMachine)
+            machine.wait_for_unit("multi-user.target")
+            machine.snapshot(SUBTEST_SNAPSHOT)
+
+        def restore_snapshot(machine: BaseMachine) -> None:
+            assert isinstance(machine, QemuMachine)
+            machine.restore(SUBTEST_SNAPSHOT)
+
+        if not self.subtest_snapshot_taken:
+            self.parallel(take_snapshot, self.machines_qemu)
+            self.subtest_snapshot_taken = True
+        else:
+            self.parallel(restore_snapshot, self.machines_qemu)
+
     def test_symbols(self) -> dict[str, Any]:
         @contextmanager
         def subtest(name: str) -> Iterator[None]:
@@ -328,6 +368,8 @@ class Driver:
             subtest=subtest,
             run_tests=self.run_tests,
             join_all=self.join_all,
+            parallel=self.parallel,
+            succeed_all=self.succeed_all,
             retry=retry,
             serial_stdout_off=self.serial_stdout_off,
             serial_stdout_on=self.serial_stdout_on,
@@ -469,6 +511,84 @@ class Driver:
                     "Failed to start the following machines:\n" + "\n".join(messages)
                 )
 
+    def parallel(
+        self,
+        fn: Callable[[BaseMachine], Any],
+        machines: Sequence[BaseMachine] | None = None,
+    ) -> list[Any]:
+        """
+        Call `fn` with each of the given machines (all machines by default)
+        at the same time, e.g.,
+        `parallel(lambda m: m.wait_for_unit("multi-user.target"))`.
+
+        Returns the results in the order of `machines`. The log output of each
+        machine is kept together and emitted in that order once all calls have
+        finished. If any call raises, an exception listing all failures is
+        raised after all calls have finished.
+        """
+        if machines is None:
+            machines = list(self.machines)
+        # Each call swaps the logger of its machine, so they can't share one
+        if len({id(machine) for machine in machines}) != len(machines):
+            raise MachineError("parallel() got the same machine more than once")
+
+        # By position, as machine names don't have to be unique
+        recorders = [RecordingLogger(machine.logger) for machine in machines]
+
+        def run(machine: BaseMachine, recorder: RecordingLogger) -> Any:
+            original_logger = machine.logger
+            machine.logger = recorder
+            try:
+                return fn(machine)
+            finally:
+                machine.logger = original_logger
+
+        with self.logger.nested(
+            "running on " + ", ".join(machine.name for machine in machines)
+        ):
+            with ThreadPoolExecutor(max_workers=max(1, len(machines))) as pool:
+                futures = [
+                    pool.submit(run, machine, recorder)
+                    for machine, recorder in zip(machines, recorders)
+                ]
+
+            results: list[Any] = []
+            errors: list[tuple[str, BaseException]] = []
+            for machine, recorder, future in zip(machines, recorders, futures):
+                recorder.replay()
+                if (error := future.exception()) is not None:
+                    errors.append((machine.name, error))
+                else:
+                    results.append(future.result())
+
+            if errors:
+                message = "\n".join(f"{name}: {e}" for name, e in errors)
+                first_error = errors[0][1]
+                if all(isinstance(e, RequestedAssertionFailed) for _, e in errors):
+                    raise RequestedAssertionFailed(
+                        f"failed on the following machines:\n{message}"
+                    ) from first_error
+                raise MachineError(
+                    f"failed on the following machines:\n{message}"
+                ) from first_error
+
+            return results
+
+    def succeed_all(
+        self,
+        *commands: str,
+        machines: Sequence[BaseMachine] | None = None,
+        timeout: int | None = None,
+    ) -> list[str]:
+        """
+        Run `succeed` with the given commands on each of the given machines
+        (all machines by default) at the same time, see `parallel`.
+        Returns the output of each machine in the order of `machines`.
+        """
+        return self.parallel(
+            lambda machine: machine.succeed(*commands, timeout=timeout), machines
+        )
+
     def join_all(self) -> None:
         """Wait for all machines to shut down"""
         with self.logger.nested("wait for all VMs to finish"):
@@ -1,20 +1,23 @@
 import atexit
 import os
+import re
 import sys
+import tempfile
+import threading
 import time
 import unicodedata
 from abc import ABC, abstractmethod
-from collections.abc import Iterator
+from collections import deque
+from collections.abc import Generator, Iterator
 from contextlib import ExitStack, contextmanager
 from enum import IntEnum
 from pathlib import Path
 from queue import Empty, Queue
-from typing import Any
+from typing import Any, TextIO
 from xml.sax.saxutils import XMLGenerator
 from xml.sax.xmlreader import AttributesImpl
 
 from colorama import Fore, Style
-from junit_xml import TestCase, TestSuite
 
 
 class LogLevel(IntEnum):
@@ -72,33 +75,127 @@ class AbstractLogger(ABC):
         pass
 
 
+# Characters that are not allowed in XML 1.0 documents
+ILLEGAL_XML_CHARS = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]")
+
+
+class SpooledOutput:
+    """
+    Output of a test case, written to a file in `path` as it arrives instead
+    of being kept in memory. The file is only kept open while output is
+    written to it, see `suspend`.
+
+    If `max_chars` is set, only the first and the last `max_chars / 2`
+    characters are kept, and a note about the dropped part is inserted.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, path: Path, max_chars: int | None = None) -> None:
+        self.max_chars = max_chars
+        self.path = path
+        self._file: TextIO | None = None
+        self.written = 0
+        self.tail: deque[str] = deque()
+        self.tail_size = 0
+        self.dropped = 0
+
+    @property
+    def file(self) -> TextIO:
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8", newline="")
+        return self._file
+
+    def suspend(self) -> None:
+        """
+        Close the file until the next write, so a test with many subtests
+        does not run out of file descriptors.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def write(self, text: str) -> None:
+        if self.max_chars is None:
+            self.file.write(text)
+            self.written += len(text)
+            return
+
+        head_limit = self.max_chars - self.max_chars // 2
+        if self.written < head_limit:
+            head = text[: head_limit - self.written]
+            self.file.write(head)
+            self.written += len(head)
+            text = text[len(head) :]
+
+        if text:
+            self.tail.append(text)
+            self.tail_size += len(text)
+            while self.tail_size > self.max_chars // 2:
+                excess = self.tail_size - self.max_chars // 2
+                if len(self.tail[0]) <= excess:
+                    removed = self.tail.popleft()
+                else:
+                    removed = self.tail[0][:excess]
+                    self.tail[0] = self.tail[0][excess:]
+                self.tail_size -= len(removed)
+                self.dropped += len(removed)
+
+    def __bool__(self) -> bool:
+        return self.written > 0 or self.tail_size > 0
+
+    def chunks(self) -> Iterator[str]:
+        self.suspend()
+        if self.written:
+            with open(self.path, encoding="utf-8", newline="") as f:
+                while chunk := f.read(self.CHUNK_SIZE):
+                    yield chunk
+        if self.dropped:
+            yield f"{os.linesep}[... {self.dropped} characters truncated ...]{os.linesep}"
+        yield from self.tail
+
+    def close(self) -> None:
+        self.suspend()
+        self.path.unlink(missing_ok=True)
+
+
 class JunitXMLLogger(AbstractLogger):
     class TestCaseState:
-        def __init__(self) -> None:
-            self.stdout = ""
-            self.stderr = ""
+        def __init__(self, spool: Path, max_output_chars: int | None = None) -> None:
+            self.stdout = SpooledOutput(spool.with_suffix(".out"), max_output_chars)
+            self.stderr = SpooledOutput(spool.with_suffix(".err"), max_output_chars)
             self.failure = False
 
-    def __init__(self, outfile: Path) -> None:
-        self.tests: dict[str, JunitXMLLogger.TestCaseState] = {
-            "main": self.TestCaseState()
-        }
+    def __init__(self, outfile: Path, max_output_chars: int | None = None) -> None:
+        self.max_output_chars = max_output_chars
+        self.spool_dir = tempfile.TemporaryDirectory(prefix="junit-xml-")
+        self.tests: dict[str, JunitXMLLogger.TestCaseState] = {}
+        self._add_test("main")
         self.currentSubtest = "main"
         self.outfile: Path = outfile
         self._print_serial_logs = True
         self._log_level = LogLevel.INFO
         atexit.register(self.close)
 
+    def _add_test(self, name: str) -> None:
+        spool = Path(self.spool_dir.name) / str(len(self.tests))
+        self.tests[name] = self.TestCaseState(spool, self.max_output_chars)
+
     def log(self, message: str, attributes: dict[str, str] = {}) -> None:
-        self.tests[self.currentSubtest].stdout += message + os.linesep
+        self.tests[self.currentSubtest].stdout.write(message + os.linesep)
 
     @contextmanager
     def subtest(self, name: str, attributes: dict[str, str] = {}) -> Iterator[None]:
         old_test = self.currentSubtest
-        self.tests.setdefault(name, self.TestCaseState())
+        if name not in self.tests:
+            self._add_test(name)
         self.currentSubtest = name
 
-        yield
+        try:
+            yield
+        finally:
+            self.tests[name].stdout.suspend()
+            self.tests[name].stderr.suspend()
 
         self.currentSubtest = old_test
 
@@ -109,18 +206,18 @@ class JunitXMLLogger(AbstractLogger):
 
     def debug(self, *args, **kwargs) -> None:
         if self._log_level <= LogLevel.DEBUG:
-            self.tests[self.currentSubtest].stdout += args[0] + os.linesep
+            self.tests[self.currentSubtest].stdout.write(args[0] + os.linesep)
 
     def info(self, *args, **kwargs) -> None:
         if self._log_level <= LogLevel.INFO:
-            self.tests[self.currentSubtest].stdout += args[0] + os.linesep
+            self.tests[self.currentSubtest].stdout.write(args[0] + os.linesep)
 
     def warning(self, *args, **kwargs) -> None:
         if self._log_level <= LogLevel.WARNING:
-            self.tests[self.currentSubtest].stdout += args[0] + os.linesep
+            self.tests[self.currentSubtest].stdout.write(args[0] + os.linesep)
 
     def error(self, *args, **kwargs) -> None:
-        self.tests[self.currentSubtest].stderr += args[0] + os.linesep
+        self.tests[self.currentSubtest].stderr.write(args[0] + os.linesep)
         self.tests[self.currentSubtest].failure = True
 
     def log_test_error(self, *args, **kwargs) -> None:
@@ -139,20 +236,68 @@ class JunitXMLLogger(AbstractLogger):
         self._log_level = level
 
     def close(self) -> None:
-        with open(self.outfile, "w") as f:
-            test_cases = []
+        failures = str(sum(test.failure for test in self.tests.values()))
+        tests = str(len(self.tests))
+
+        with open(self.outfile, "wb") as f:
+            xml = XMLGenerator(f, encoding="utf-8")
+
+            def element(
+                name: str, attrs: dict[str, str], output: SpooledOutput
+            ) -> None:
+                xml.startElement(name, AttributesImpl(attrs))
+                for chunk in output.chunks():
+                    xml.characters(ILLEGAL_XML_CHARS.sub("", chunk))
+                xml.endElement(name)
+
+            xml.startDocument()
+            xml.startElement(
+                "testsuites",
+                AttributesImpl(
+                    {
+                        "disabled": "0",
+                        "errors": "0",
+                        "failures": failures,
+                        "tests": tests,
+                        "time": "0.0",
+                    }
+                ),
+            )
+            xml.startElement(
+                "testsuite",
+                AttributesImpl(
+                    {
+                        "disabled": "0",
+                        "errors": "0",
+                        "failures": failures,
+                        "name": "NixOS integration test",
+                        "skipped": "0",
+                        "tests": tests,
+                        "time": "0",
+                    }
+                ),
+            )
             for name, test_case_state in self.tests.items():
-                tc = TestCase(
-                    name,
-                    stdout=test_case_state.stdout,
-                    stderr=test_case_state.stderr,
-                )
+                xml.startElement("testcase", AttributesImpl({"name": name}))
                 if test_case_state.failure:
-                    tc.add_failure_info("test case failed")
-
-                test_cases.append(tc)
-            ts = TestSuite("NixOS integration test", test_cases)
-            f.write(TestSuite.to_xml_string([ts]))
+                    xml.startElement(
+                        "failure",
+                        AttributesImpl(
+                            {"type": "failure", "message": "test case failed"}
+                        ),
+                    )
+                    xml.endElement("failure")
+                if test_case_state.stdout:
+                    element("system-out", {}, test_case_state.stdout)
+                if test_case_state.stderr:
+                    element("system-err", {}, test_case_state.stderr)
+                xml.endElement("testcase")
+                test_case_state.stdout.close()
+                test_case_state.stderr.close()
+            xml.endElement("testsuite")
+            xml.endElement("testsuites")
+            xml.endDocument()
+        self.spool_dir.cleanup()
 
 
 class CompositeLogger(AbstractLogger):
@@ -214,6 +359,92 @@ class CompositeLogger(AbstractLogger):
             logger.set_log_level(level)
 
 
+class RecordingLogger(AbstractLogger):
+    """
+    Records log messages instead of emitting them, so that they can be
+    replayed on the wrapped logger later on. This keeps the output of
+    operations that run concurrently together.
+    Serial console output is passed through right away.
+    """
+
+    def __init__(self, logger: AbstractLogger) -> None:
+        self.logger = logger
+        self.events: list[tuple[str, tuple, dict, list]] = []
+        self._stack = [self.events]
+
+    def _record(self, method: str, *args, **kwargs) -> list:
+        children: list = []
+        self._stack[-1].append((method, args, kwargs, children))
+        return children
+
+    @contextmanager
+    def _record_block(self, method: str, *args, **kwargs) -> Generator[None]:
+        children = self._record(method, *args, **kwargs)
+        self._stack.append(children)
+        tic = time.time()
+        try:
+            yield
+        finally:
+            toc = time.time()
+            self._stack.pop()
+            # Replaying takes no time, so keep the actual duration around
+            children.append(
+                ("log", (f"(recorded in {toc - tic:.2f} seconds)", *args[1:]), {}, [])
+            )
+
+    def replay(self) -> None:
+        """Emit all recorded messages on the wrapped logger."""
+
+        def replay_events(events: list) -> None:
+            for method, args, kwargs, children in events:
+                if method in ("nested", "subtest"):
+                    with getattr(self.logger, method)(*args, **kwargs):
+                        replay_events(children)
+                else:
+                    getattr(self.logger, method)(*args, **kwargs)
+
+        events, self.events = self.events, []
+        self._stack = [self.events]
+        replay_events(events)
+
+    def log(self, message: str, attributes: dict[str, str] = {}) -> None:
+        self._record("log", message, attributes)
+
+    @contextmanager
+    def subtest(self, name: str, attributes: dict[str, str] = {}) -> Generator[None]:
+        with self._record_block("subtest", name, attributes):
+            yield
+
+    @contextmanager
+    def nested(self, message: str, attributes: dict[str, str] = {}) -> Generator[None]:
+        with self._record_block("nested", message, attributes):
+            yield
+
+    def debug(self, *args, **kwargs) -> None:
+        self._record("debug", *args, **kwargs)
+
+    def info(self, *args, **kwargs) -> None:
+        self._record("info", *args, **kwargs)
+
+    def warning(self, *args, **kwargs) -> None:
+        self._record("warning", *args, **kwargs)
+
+    def error(self, *args, **kwargs) -> None:
+        self._record("error", *args, **kwargs)
+
+    def log_test_error(self, *args, **kwargs) -> None:
+        self._record("log_test_error", *args, **kwargs)
+
+    def log_serial(self, message: str, machine: str) -> None:
+        self.logger.log_serial(message, machine)
+
+    def print_serial_logs(self, enable: bool) -> None:
+        self.logger.print_serial_logs(enable)
+
+    def set_log_level(self, level: LogLevel) -> None:
+        self.logger.set_log_level(level)
+
+
 class TerminalLogger(AbstractLogger):
     def __init__(self) -> None:
         self._print_serial_logs = True
@@ -285,24 +516,55 @@ class TerminalLogger(AbstractLogger):
         self.warning(f"{prefix}{args[0]}", *args[1:], **kwargs)
 
 
+# Control characters in the Latin-1 range, which is where nearly all of them
+# in serial console output are
+LATIN1_CONTROL_CHARS = re.compile("[\x00-\x1f\x7f-\x9f]")
+
+
 class XMLLogger(AbstractLogger):
+    """
+    Writes the log as XML. All writes happen on a background thread, which
+    batches queued messages and flushes the file every `FLUSH_LINES` messages
+    or `FLUSH_SECONDS` seconds, whichever comes first.
+    """
+
+    FLUSH_LINES = 1000
+    FLUSH_SECONDS = 0.5
+
     def __init__(self, outfile: str) -> None:
         self.logfile_handle = open(outfile, "wb")
         self.xml = XMLGenerator(self.logfile_handle, encoding="utf-8")
-        self.queue: Queue[dict[str, str]] = Queue()
+        # Items are (kind, message, attributes), `None` stops the writer.
+        self.queue: Queue[tuple[str, str, dict[str, str]] | None] = Queue()
 
         self._print_serial_logs = True
         self._log_level = LogLevel.INFO
+        self._closed = False
 
         self.xml.startDocument()
         self.xml.startElement("logfile", attrs=AttributesImpl({}))
 
+        self.writer = threading.Thread(
+            target=self._write_batches, name="xml-logger", daemon=True
+        )
+        self.writer.start()
+        atexit.register(self.close)
+
     def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self.queue.put(None)
+        self.writer.join()
         self.xml.endElement("logfile")
         self.xml.endDocument()
         self.logfile_handle.close()
 
     def sanitise(self, message: str) -> str:
+        message = LATIN1_CONTROL_CHARS.sub("", message)
+        if message.isprintable():
+            return message
+        # Slow path for other non-printable characters, which are rare
         return "".join(ch for ch in message if unicodedata.category(ch)[0] != "C")
 
     def maybe_prefix(self, message: str, attributes: dict[str, str]) -> str:
@@ -310,6 +572,40 @@ class XMLLogger(AbstractLogger):
             return f"{attributes['machine']}: {message}"
         return message
 
+    def _write_batches(self) -> None:
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.FLUSH_SECONDS
+            while batch[-1] is not None and len(batch) < self.FLUSH_LINES:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except Empty:
+                    break
+
+            for item in batch:
+                if item is None:
+                    self.logfile_handle.flush()
+                    return
+                self._write(*item)
+            self.logfile_handle.flush()
+
+    def _write(self, kind: str, message: str, attributes: dict[str, str]) -> None:
+        match kind:
+            case "line":
+                self.log_line(message, attributes)
+            case "serial":
+                self.log_line(self.sanitise(message), attributes)
+            case "nest":
+                self.xml.startElement("nest", attrs=AttributesImpl({}))
+                self.xml.startElement("head", attrs=AttributesImpl(attributes))
+                self.xml.characters(message)
+                self.xml.endElement("head")
+            case "end_nest":
+                self.xml.endElement("nest")
+
     def log_line(self, message: str, attributes: dict[str, str]) -> None:
         self.xml.startElement("line", attrs=AttributesImpl(attributes))
         self.xml.characters(message)
@@ -334,8 +630,7 @@ class XMLLogger(AbstractLogger):
         self.log(*args, **kwargs)
 
     def log(self, message: str, attributes: dict[str, str] = {}) -> None:
-        self.drain_log_queue()
-        self.log_line(message, attributes)
+        self.queue.put(("line", message, attributes))
 
     def print_serial_logs(self, enable: bool) -> None:
         self._print_serial_logs = enable
@@ -347,20 +642,7 @@ class XMLLogger(AbstractLogger):
         if not self._print_serial_logs:
             return
 
-        self.enqueue({"msg": message, "machine": machine, "type": "serial"})
-
-    def enqueue(self, item: dict[str, str]) -> None:
-        self.queue.put(item)
-
-    def drain_log_queue(self) -> None:
-        try:
-            while True:
-                item = self.queue.get_nowait()
-                msg = self.sanitise(item["msg"])
-                del item["msg"]
-                self.log_line(msg, item)
-        except Empty:
-            pass
+        self.queue.put(("serial", message, {"machine": machine, "type": "serial"}))
 
     @contextmanager
     def subtest(self, name: str, attributes: dict[str, str] = {}) -> Iterator[None]:
@@ -369,16 +651,11 @@ class XMLLogger(AbstractLogger):
 
     @contextmanager
     def nested(self, message: str, attributes: dict[str, str] = {}) -> Iterator[None]:
-        self.xml.startElement("nest", attrs=AttributesImpl({}))
-        self.xml.startElement("head", attrs=AttributesImpl(attributes))
-        self.xml.characters(message)
-        self.xml.endElement("head")
+        self.queue.put(("nest", message, attributes))
 
         tic = time.time()
-        self.drain_log_queue()
         yield
-        self.drain_log_queue()
         toc = time.time()
         self.log(f"(finished: {message}, in {toc - tic:.2f} seconds)")
 
-        self.xml.endElement("nest")
+        self.queue.put(("end_nest", "", {}))
@@ -1,8 +1,7 @@
 import base64
-import io
+import math
 import os
 import platform
-import queue
 import re
 import select
 import shlex
@@ -19,16 +18,15 @@ from collections.abc import Callable, Generator
 from contextlib import _GeneratorContextManager, contextmanager, nullcontext
 from functools import cached_property
 from pathlib import Path
-from queue import Queue
 from typing import Any
 
 from test_driver.errors import MachineError, RequestedAssertionFailed
 from test_driver.logger import AbstractLogger
-from test_driver.machine.ocr import (
-    perform_ocr_on_screenshot,
-    perform_ocr_variants_on_screenshot,
-)
+from test_driver.machine import transfer
+from test_driver.machine.console import ConsoleLog
+from test_driver.machine.ocr import Frame, OCRCache
 from test_driver.machine.qmp import QMPSession
+from test_driver.machine.shell import ShellChannel
 
 CHAR_TO_KEY = {
     "A": "shift-a",
@@ -94,22 +92,54 @@ CHAR_TO_KEY = {
 }
 
 
+# Follows the messages systemd logs on every state change of a unit
+# ("Started ...", "Stopped ...", "Failed with result ...", and so on).
+# The service manager of a user tags them with USER_UNIT instead of UNIT.
+UNIT_EVENTS_WATCH = (
+    "journalctl --follow --lines=0 --quiet SYSLOG_IDENTIFIER=systemd {field}={unit}"
+)
+
+UNIT_TYPES = (
+    "service socket device mount automount swap target path timer slice scope"
+).split()
+
+# Event-driven waits re-check their condition in the guest at least this often,
+# in case an event source misses a change.
+EVENT_RECHECK_SECONDS = 5
+
+# Waits without an event source poll their condition inside the guest at
+# these intervals, the last one repeating. Polls like `nc -z` spawn processes,
+# so this backs off, but never beyond the one second of a host-side `retry`.
+GUEST_POLL_SECONDS = (0.25, 0.5, 1)
+
+
 def make_command(args: list) -> str:
     return " ".join(map(shlex.quote, (map(str, args))))
 
 
-def retry(fn: Callable, timeout_seconds: int = 900) -> None:
-    """Call the given function repeatedly, with a one second interval between
-    retries, until it returns True or a timeout is reached.
+def retry(
+    fn: Callable,
+    timeout_seconds: int = 900,
+    wait: Callable[[float], None] | None = None,
+) -> None:
+    """Call the given function repeatedly until it returns True or a timeout
+    is reached.
+
+    Between retries, `wait` is called with the remaining number of seconds.
+    It is expected to block until the outcome of `fn` may have changed. If no
+    `wait` is given, retries happen with a one second interval.
 
     Note that the timeout shown will include the time of the last attempted run.
     """
     start_time = time.monotonic()
 
-    while time.monotonic() - start_time < timeout_seconds:
+    while (elapsed := time.monotonic() - start_time) < timeout_seconds:
         if fn(False):
             return
-        time.sleep(1)
+        if wait is None:
+            time.sleep(1)
+        else:
+            wait(timeout_seconds - elapsed)
 
     elapsed = time.monotonic() - start_time
 
@@ -319,14 +349,18 @@ class BaseMachine(ABC):
         machine.systemctl("list-jobs --no-pager", "any-user")
         ```
         """
+        return self.execute(self._systemctl_command(q, user))
+
+    @staticmethod
+    def _systemctl_command(q: str, user: str | None = None) -> str:
         if user is not None:
             q = q.replace("'", "\\'")
-            return self.execute(
+            return (
                 f"su -l {user} --shell /bin/sh -c "
                 "$'XDG_RUNTIME_DIR=/run/user/`id -u` "
                 f"systemctl --user {q}'"
             )
-        return self.execute(f"systemctl {q}")
+        return f"systemctl {q}"
 
     def wait_for_unit(
         self, unit: str, user: str | None = None, timeout: int = 900
@@ -337,7 +371,10 @@ class BaseMachine(ABC):
         timing out.
         """
 
+        state = ""
+
         def check_active(_last_try: bool) -> bool:
+            nonlocal state
             state = self.get_unit_property(unit, "ActiveState", user)
             if state == "failed":
                 raise RequestedAssertionFailed(f'unit "{unit}" reached state "{state}"')
@@ -353,11 +390,62 @@ class BaseMachine(ABC):
 
             return state == "active"
 
+        # systemd logs the full unit name, `foo` is short for `foo.service`
+        if unit.rpartition(".")[2] in UNIT_TYPES:
+            unit_name = unit
+        else:
+            unit_name = f"{unit}.service"
+
+        def wait_for_state_change(remaining: float) -> None:
+            current_state = self._systemctl_command(
+                f'--no-pager show "{unit}" --property=ActiveState --value', user
+            )
+            self._wait_in_guest(
+                f'[ "$({current_state})" != {shlex.quote(state)} ]',
+                remaining,
+                watch=UNIT_EVENTS_WATCH.format(
+                    field="UNIT" if user is None else "USER_UNIT",
+                    unit=shlex.quote(unit_name),
+                ),
+            )
+
         with self.nested(
             f"waiting for unit {unit}"
             + (f" with user {user}" if user is not None else "")
         ):
-            retry(check_active, timeout)
+            retry(check_active, timeout, wait_for_state_change)
+
+    def _wait_in_guest(
+        self, probe: str, timeout: float, watch: str | None = None
+    ) -> None:
+        """
+        Block inside the guest until the shell condition `probe` holds, or
+        for at most `timeout` seconds.
+
+        If `watch` is given, it is started before `probe` is first evaluated
+        and must print a line whenever the outcome of `probe` may have changed.
+        The probe is then only re-evaluated on such events (or every
+        `EVENT_RECHECK_SECONDS`), so waiting does not keep the guest busy. If
+        there is no watcher, or it exits, the probe is polled at the
+        `GUEST_POLL_SECONDS` intervals instead.
+        """
+        secs = max(1, math.ceil(timeout))
+        *backoff, interval = GUEST_POLL_SECONDS
+        delays = f"delays=({' '.join(map(str, backoff))}); "
+        poll = f'{{ sleep "${{delays[0]:-{interval}}}"; delays=("${{delays[@]:1}}"); }}'
+        if watch is None:
+            script = f"{delays}until {probe}; do {poll}; done"
+        else:
+            script = (
+                delays + f"exec 3< <(exec {watch}); watcher=$!; "
+                f"until {probe}; do "
+                f"read -r -t {EVENT_RECHECK_SECONDS} _ <&3 "
+                f"|| [ $? -gt 128 ] || {poll}; "
+                "done; "
+                "kill $watcher 2>/dev/null || true"
+            )
+        # The outcome is checked by the caller, the status does not matter.
+        self.execute(script, timeout=secs)
 
     def get_unit_info(self, unit: str, user: str | None = None) -> dict[str, str]:
         """
@@ -513,8 +601,18 @@ class BaseMachine(ABC):
             status, _ = self.execute(f"test -e {filename}")
             return status == 0
 
+        def wait_for_creation(remaining: float) -> None:
+            parent = shlex.quote(os.path.dirname(filename) or ".")
+            self._wait_in_guest(
+                f"test -e {filename}",
+                remaining,
+                # Falls back to polling if inotify-tools are not installed
+                # or the parent directory does not exist yet.
+                watch=f"inotifywait --monitor --quiet --event create,moved_to {parent}",
+            )
+
         with self.nested(f"waiting for file '{filename}'"):
-            retry(check_file, timeout)
+            retry(check_file, timeout, wait_for_creation)
 
     def wait_for_open_port(
         self, port: int, addr: str = "localhost", timeout: int = 900
@@ -528,8 +626,11 @@ class BaseMachine(ABC):
             status, _ = self.execute(f"nc -z {addr} {port}")
             return status == 0
 
+        def wait_for_open(remaining: float) -> None:
+            self._wait_in_guest(f"nc -z {addr} {port}", remaining)
+
         with self.nested(f"waiting for TCP port {port} on {addr}"):
-            retry(port_is_open, timeout)
+            retry(port_is_open, timeout, wait_for_open)
 
     def wait_for_open_unix_socket(
         self, addr: str, is_datagram: bool = False, timeout: int = 900
@@ -548,10 +649,13 @@ class BaseMachine(ABC):
             status, _ = self.execute(f"nc {' '.join(nc_flags)} {addr}")
             return status == 0
 
+        def wait_for_open(remaining: float) -> None:
+            self._wait_in_guest(f"nc {' '.join(nc_flags)} {addr}", remaining)
+
         with self.nested(
             f"waiting for UNIX-domain {'datagram' if is_datagram else 'stream'} on '{addr}'"
         ):
-            retry(socket_is_open, timeout)
+            retry(socket_is_open, timeout, wait_for_open)
 
     def wait_for_closed_port(
         self, port: int, addr: str = "localhost", timeout: int = 900
@@ -565,8 +669,11 @@ class BaseMachine(ABC):
             status, _ = self.execute(f"nc -z {addr} {port}")
             return status != 0
 
+        def wait_for_closed(remaining: float) -> None:
+            self._wait_in_guest(f"! nc -z {addr} {port}", remaining)
+
         with self.nested(f"waiting for TCP port {port} on {addr} to be closed"):
-            retry(port_is_closed, timeout)
+            retry(port_is_closed, timeout, wait_for_closed)
 
     def start_job(self, jobname: str, user: str | None = None) -> tuple[int, str]:
         """
@@ -658,15 +765,16 @@ class BaseMachine(ABC):
             vm_intermediate = vm_shared_temp / vm_src.name
             intermediate = shared_temp / vm_src.name
             # Copy the file to the shared directory inside machines
+            tic = time.monotonic()
             self.succeed(make_command(["mkdir", "-p", vm_shared_temp]))
             self.succeed(make_command(["cp", "-r", vm_src, vm_intermediate]))
             abs_target = self.out_dir / target_dir / vm_src.name
             abs_target.parent.mkdir(exist_ok=True, parents=True)
-            # Copy the file from the shared directory outside machines
-            if intermediate.is_dir():
-                shutil.copytree(intermediate, abs_target)
-            else:
-                shutil.copy(intermediate, abs_target)
+            # Move the file out of the shared directory outside machines,
+            # which does not copy any data if `$out` is on the same file system
+            size = transfer.move(intermediate, abs_target)
+            toc = time.monotonic()
+            self.log(f"copied {transfer.format_throughput(size, toc - tic)}")
 
     @warnings.deprecated("Use copy_from_machine() instead")
     def copy_from_vm(self, source: str, target_dir: str = "") -> None:
@@ -677,12 +785,27 @@ class BaseMachine(ABC):
         shell into the destination file. Works without host-guest shared folder.
         Prefer copy_from_host for whenever possible.
         """
-        with open(source, "rb") as fh:
-            content_b64 = base64.b64encode(fh.read()).decode()
+        with self.nested(f"copying {source} to {target} via the shell"):
+            tic = time.monotonic()
             self.succeed(
                 f"mkdir -p $(dirname {target})",
-                f"echo -n {content_b64} | base64 -d > {target}",
+                f": > {target}",
             )
+            size = 0
+            # Send the file in chunks that keep each command line at 64 KiB,
+            # so the file never needs to be held in memory as a whole.
+            for chunk in transfer.read_chunks(Path(source), 48 * 1024):
+                content_b64 = base64.b64encode(chunk).decode()
+                status, _ = self.execute(
+                    f"echo -n {content_b64} | base64 -d >> {target}"
+                )
+                if status != 0:
+                    raise RequestedAssertionFailed(
+                        f"writing to {target} failed (exit code {status})"
+                    )
+                size += len(chunk)
+            toc = time.monotonic()
+            self.log(f"copied {transfer.format_throughput(size, toc - tic)}")
 
     def copy_from_host(self, source: str, target: str) -> None:
         """
@@ -697,7 +820,8 @@ class BaseMachine(ABC):
         be written to.
 
         The file is copied via the `shared_dir` directory which is shared among
-        all the machines (using a temporary directory).
+        all the machines (using a temporary directory). Where possible, it is
+        hardlinked or reflinked into that directory instead of being copied.
         The access rights bits will mimic the ones from the host file and
         user:group will be root:root.
         """
@@ -709,13 +833,13 @@ class BaseMachine(ABC):
             vm_shared_temp = Path("/tmp/shared") / shared_temp.name
             vm_intermediate = vm_shared_temp / host_src.name
 
+            tic = time.monotonic()
             self.succeed(make_command(["mkdir", "-p", vm_shared_temp]))
-            if host_src.is_dir():
-                shutil.copytree(host_src, host_intermediate)
-            else:
-                shutil.copy(host_src, host_intermediate)
+            size = transfer.transfer(host_src, host_intermediate)
             self.succeed(make_command(["mkdir", "-p", vm_target.parent]))
             self.succeed(make_command(["cp", "-r", vm_intermediate, vm_target]))
+            toc = time.monotonic()
+            self.log(f"copied {transfer.format_throughput(size, toc - tic)}")
 
 
 class QemuMachine(BaseMachine):
@@ -737,6 +861,7 @@ class QemuMachine(BaseMachine):
     monitor: socket.socket | None
     qmp_client: QMPSession | None
     shell: socket.socket | None
+    shell_channel: ShellChannel | None
     serial_thread: threading.Thread | None
 
     vsock_guest: Path | None
@@ -744,11 +869,12 @@ class QemuMachine(BaseMachine):
 
     booted: bool
     connected: bool
-    # Store last serial console lines for use
-    # of wait_for_console_text
-    last_lines: Queue = Queue()
-    # Store all console output for full log retrieval
-    full_console_log: list[str]
+    # OCR results of recent screenshots
+    ocr_cache: OCRCache
+    # Serial console output since boot, bounded in size
+    console_log: ConsoleLog
+    # Index of the first console line that wait_for_console_text will consider
+    console_position: int
 
     def __init__(
         self,
@@ -772,7 +898,9 @@ class QemuMachine(BaseMachine):
             keep_machine_state=keep_machine_state,
         )
 
-        self.full_console_log = []
+        self.console_log = ConsoleLog()
+        self.console_position = 0
+        self.ocr_cache = OCRCache()
         self.vsock_guest = vsock_guest
         self.vsock_host = vsock_host
 
@@ -786,6 +914,8 @@ class QemuMachine(BaseMachine):
         self.monitor = None
         self.qmp_client = None
         self.shell = None
+        self.shell_channel = None
+        self.connect_lock = threading.Lock()
         self.serial_thread = None
 
         self.booted = False
@@ -821,22 +951,6 @@ class QemuMachine(BaseMachine):
         self.monitor.send(message)
         return self.wait_for_monitor_prompt()
 
-    def _next_newline_closed_block_from_shell(self) -> str:
-        assert self.shell
-        output_buffer = []
-        while True:
-            # This receives up to 4096 bytes from the socket
-            chunk = self.shell.recv(4096)
-            if not chunk:
-                # Probably a broken pipe, return the output we have
-                break
-
-            decoded = chunk.decode()
-            output_buffer += [decoded]
-            if decoded[-1] == "\n":
-                break
-        return "".join(output_buffer)
-
     def get_tty_text(self, tty: str) -> str:
         """
         Get the output printed to a given TTY.
@@ -880,32 +994,33 @@ class QemuMachine(BaseMachine):
         # Always run command with shell opts
         command = f"set -euo pipefail; {command}"
 
-        timeout_str = ""
+        timeout_args = []
         if timeout is not None:
-            timeout_str = f"timeout {timeout}"
+            timeout_args = ["timeout", str(timeout)]
 
         # While sh is bash on NixOS, this is not the case for every distro.
         # We explicitly call bash here to allow for the driver to boot other distros as well.
-        out_command = (
-            f"{timeout_str} bash -c {shlex.quote(command)} | (base64 -w 0; echo)\n"
+        assert self.shell_channel
+        # Without output capture, the command still runs before later ones,
+        # e.g. so that `foo &` is started before the next command
+        request_id = self.shell_channel.submit(
+            [*timeout_args, "bash", "-c", command], ordered=not check_output
         )
 
-        assert self.shell
-        self.shell.send(out_command.encode())
-
         if not check_output:
+            self.shell_channel.discard(request_id)
             return (-2, "")
 
-        # Get the output
-        output = base64.b64decode(self._next_newline_closed_block_from_shell())
+        result = self.shell_channel.wait(request_id)
+        if result is None:
+            if not check_return:
+                return (-1, "")
+            raise MachineError(f"guest shell disconnected while running `{command}`")
 
+        rc, output = result
         if not check_return:
             return (-1, output.decode())
 
-        # Get the return code
-        self.shell.send(b"echo ${PIPESTATUS[0]}\n")
-        rc = int(self._next_newline_closed_block_from_shell().strip())
-
         return (rc, output.decode(errors="replace"))
 
     def shell_interact(self, address: str | None = None) -> None:
@@ -1008,18 +1123,6 @@ class QemuMachine(BaseMachine):
             for char in chars:
                 self.send_key(char, delay, log=False)
 
-    def wait_for_file(self, filename: str, timeout: int = 900) -> None:
-        """
-        Waits until the file exists in the machine's file system.
-        """
-
-        def check_file(_last_try: bool) -> bool:
-            status, _ = self.execute(f"test -e {filename}")
-            return status == 0
-
-        with self.nested(f"waiting for file '{filename}'"):
-            retry(check_file, timeout)
-
     def connect(self) -> None:
         """
         Wait for a connection to the guest root shell
@@ -1035,36 +1138,39 @@ class QemuMachine(BaseMachine):
             (ready, _, _) = select.select([self.shell], [], [], timeout_secs)
             return bool(ready)
 
-        if self.connected:
-            return
+        # Several threads may run commands on this machine at once
+        with self.connect_lock:
+            if self.connected:
+                return
 
-        with self.nested("waiting for the VM to finish booting"):
-            self.start()
+            with self.nested("waiting for the VM to finish booting"):
+                self.start()
 
-            assert self.shell
+                assert self.shell
 
-            tic = time.time()
-            # TODO: do we want to bail after a set number of attempts?
-            while not shell_ready(timeout_secs=30):
-                self.log("Guest root shell did not produce any data yet...")
-                self.log(
-                    "  To debug, enter the VM and run 'systemctl status backdoor.service'."
-                )
+                tic = time.time()
+                # TODO: do we want to bail after a set number of attempts?
+                while not shell_ready(timeout_secs=30):
+                    self.log("Guest root shell did not produce any data yet...")
+                    self.log(
+                        "  To debug, enter the VM and run 'systemctl status backdoor.service'."
+                    )
 
-            while True:
-                chunk = self.shell.recv(1024)
-                if len(chunk) == 0:
-                    raise RuntimeError("Shell disconnected")
-                self.log(f"Guest shell says: {chunk!r}")
-                # NOTE: for this to work, nothing must be printed after this line!
-                if b"Spawning backdoor root shell..." in chunk:
-                    break
+                while True:
+                    chunk = self.shell.recv(1024)
+                    if len(chunk) == 0:
+                        raise RuntimeError("Shell disconnected")
+                    self.log(f"Guest shell says: {chunk!r}")
+                    # NOTE: for this to work, nothing must be printed after this line!
+                    if b"Spawning backdoor root shell..." in chunk:
+                        break
 
-            toc = time.time()
+                toc = time.time()
 
-            self.log("connected to guest root shell")
-            self.log(f"(connecting took {toc - tic:.2f} seconds)")
-            self.connected = True
+                self.log("connected to guest root shell")
+                self.log(f"(connecting took {toc - tic:.2f} seconds)")
+                self.shell_channel = ShellChannel(self.shell)
+                self.connected = True
 
     @contextmanager
     def _managed_screenshot(self) -> Generator[Path]:
@@ -1113,7 +1219,7 @@ class QemuMachine(BaseMachine):
         :::
         """
         with self._managed_screenshot() as screenshot_path:
-            return perform_ocr_variants_on_screenshot(screenshot_path)
+            return self.ocr_cache.ocr(Frame.read(screenshot_path))
 
     def get_screen_text(self) -> str:
         """
@@ -1125,24 +1231,43 @@ class QemuMachine(BaseMachine):
         :::
         """
         with self._managed_screenshot() as screenshot_path:
-            return perform_ocr_on_screenshot(screenshot_path)
+            return self.ocr_cache.ocr(Frame.read(screenshot_path), variants=False)[0]
 
-    def wait_for_text(self, regex: str, timeout: int = 900) -> None:
+    def wait_for_text(
+        self, regex: str, timeout: int = 900, changed_regions_only: bool = False
+    ) -> None:
         """
         Wait until the supplied regular expressions matches the textual
         contents of the screen by using optical character recognition (see
         `get_screen_text` and `get_screen_text_variants`).
 
+        OCR is skipped while the screen does not change. With
+        `changed_regions_only=True`, after the first attempt only the part
+        of the screen that changed since the previous attempt is recognized,
+        which is faster but cannot match text that is only partially redrawn.
+
         ::: {.note}
         This requires [`enableOCR`](#test-opt-enableOCR) to be set to `true`.
         :::
         """
+        previous: Frame | None = None
+        variants: list[str] = []
 
         def screen_matches(last_try: bool) -> bool:
-            variants = self.get_screen_text_variants()
-            for text in variants:
-                if re.search(regex, text) is not None:
-                    return True
+            nonlocal previous, variants
+            with self._managed_screenshot() as screenshot_path:
+                frame = Frame.read(screenshot_path)
+                region: Frame | None = frame
+                if changed_regions_only and previous is not None:
+                    region = frame.changed_region(
+                        previous, screenshot_path.with_name("region.ppm")
+                    )
+                previous = frame
+                if region is not None:
+                    variants = self.ocr_cache.ocr(region)
+                    for text in variants:
+                        if re.search(regex, text) is not None:
+                            return True
 
             if last_try:
                 self.log(f"Last OCR attempt failed. Text was: {variants}")
@@ -1158,37 +1283,51 @@ class QemuMachine(BaseMachine):
         serial console output.
         This method is useful when OCR is not possible or inaccurate.
 
+        Only output after the match of the previous call is considered. The
+        regular expression may span several lines, which are separated by newlines.
+
         When this method returns, the console output that includes the match has already become part of get_console_log().
         """
-        # Buffer the console output, this is needed
-        # to match multiline regexes.
-        console = io.StringIO()
-
-        def console_matches(_last_try: bool) -> bool:
-            nonlocal console
-            try:
-                # This will return as soon as possible and
-                # sleep 1 second.
-                console.write(self.last_lines.get(block=False))
-            except queue.Empty:
-                pass
-            console.seek(0)
-            matches = re.search(regex, console.read())
-            return matches is not None
+        pattern = re.compile(regex)
+        log = self.console_log
+        start = self.console_position
+        searched = start
+        deadline = None if timeout is None else time.monotonic() + timeout
 
         with self.nested(f"waiting for {regex} to appear on console"):
-            if timeout is not None:
-                retry(console_matches, timeout)
-            else:
-                while not console_matches(False):
-                    pass
+            while True:
+                end = log.end
+                if end > searched:
+                    line = log.search(pattern, start, searched, end)
+                    if line is not None:
+                        self.console_position = line + 1
+                        return
+                    searched = end
+
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise RequestedAssertionFailed(
+                            f"action timed out after {timeout:.2f} seconds (timeout={timeout})"
+                        )
+
+                if not log.wait_for_lines(searched, remaining) and log.closed:
+                    raise MachineError(
+                        f"console of {self.name} closed while waiting for {regex}"
+                    )
 
     def get_console_log(self) -> str:
         """
-        Get the full console output from the machine since boot.
-        Returns all serial console output as a single string.
+        Get the console output from the machine since boot.
+        Returns all serial console output as a single string. Only the most
+        recent `CONSOLE_LOG_MAX_BYTES` of output are retained.
         """
-        return "\n".join(self.full_console_log)
+        return "\n".join(self.console_log.lines())
+
+    @property
+    def full_console_log(self) -> list[str]:
+        return self.console_log.lines()
 
     def send_key(
         self, key: str, delay: float | None = 0.01, log: bool | None = True
@@ -1275,22 +1414,20 @@ class QemuMachine(BaseMachine):
         self.shell = accept_or_fail(shell_socket, "shell")
         self.qmp_client = QMPSession.from_path(self.qmp_path)
 
-        # Store last serial console lines for use
-        # of wait_for_console_text
-        self.last_lines: Queue = Queue()
         # Re-initialize (if this is not the first start)
-        self.full_console_log: list[str] = []
+        self.console_log = ConsoleLog()
+        self.console_position = 0
 
         def process_serial_output() -> None:
             assert self.process
             assert self.process.stdout
+            console_log = self.console_log
             for _line in self.process.stdout:
                 # Ignore undecodable bytes that may occur in boot menus
                 line = _line.decode(errors="ignore").replace("\r", "").rstrip()
-                self.full_console_log.append(line)
-                # Put on queue after adding to full_console_log to guarantee ordering
-                self.last_lines.put(line)
+                console_log.append(line)
                 self.log_serial(line)
+            console_log.close()
 
         self.serial_thread = threading.Thread(target=process_serial_output)
         self.serial_thread.start()
@@ -1417,6 +1554,77 @@ class QemuMachine(BaseMachine):
         if self.qmp_client:
             self.qmp_client.close()
 
+    def _human_monitor_command(self, command: str) -> None:
+        if self.qmp_client is None:
+            raise MachineError("QMP API is not ready yet, is the VM running?")
+        self.run_callbacks()
+        result = self.qmp_client.send(
+            "human-monitor-command", {"command-line": command}
+        )
+        # These commands only print something if they fail
+        output = str(result.get("return", "")).strip()
+        if output:
+            raise MachineError(f"`{command}` failed: {output}")
+
+    def _unmount_shares(self) -> list[str]:
+        """
+        QEMU refuses to save the VM state while 9p shared directories are
+        mounted in the guest, so unmount them and return their mount points.
+        The Nix store can't be unmounted, so it must not be shared over 9p.
+        """
+        shares = self.succeed("findmnt --list --noheadings --types 9p --output TARGET")
+        mount_points = shares.split()
+        if any(path.startswith("/nix/") for path in mount_points):
+            raise MachineError(
+                f"cannot snapshot {self.name} while its Nix store is shared over "
+                "9p, set `virtualisation.useNixStoreImage = true`"
+            )
+        if mount_points:
+            self.succeed(f"umount {' '.join(mount_points)}")
+        return mount_points
+
+    def _mount_shares(self, mount_points: list[str]) -> None:
+        # The guest's fstab has their options
+        for mount_point in mount_points:
+            self.succeed(f"mount {mount_point}")
+
+    def snapshot(self, name: str) -> None:
+        """
+        Save the complete state of the running VM (memory, devices and disks)
+        as an internal snapshot called `name` in its disk images, e.g.,
+        `snapshot("booted")`. Use `restore` to go back to it.
+
+        This uses QEMU's `savevm`, which requires all writable disks to be
+        qcow2 images and the Nix store not to be shared over 9p
+        (`virtualisation.useNixStoreImage`). Other shared directories, like
+        the one of `copy_from_vm`, are briefly unmounted for it.
+        """
+        with self.nested(f"saving snapshot {name}"):
+            shares = self._unmount_shares()
+            try:
+                self._human_monitor_command(f"savevm {name}")
+            finally:
+                self._mount_shares(shares)
+
+    def restore(self, name: str) -> None:
+        """
+        Bring the running VM back to the state saved with `snapshot(name)`.
+        Snapshots are kept in the disk images in the machine's state
+        directory, so with `--keep-machine-state` they survive reruns of
+        the test.
+        """
+        with self.nested(f"restoring snapshot {name}"):
+            shares = self._unmount_shares()
+            self._human_monitor_command(f"loadvm {name}")
+            # The guest shell is back at the point where the snapshot was
+            # taken, so anything that was in flight since then is gone.
+            with self.connect_lock:
+                if self.connected:
+                    assert self.shell_channel
+                    self.shell_channel.reset()
+            # The shares were unmounted in the snapshot as well
+            self._mount_shares(shares)
+
     def switch_root(self) -> None:
         """
         Transition from stage 1 to stage 2. This requires the
@@ -1433,6 +1641,24 @@ class QemuMachine(BaseMachine):
         self.connect()
 
 
+# Sources /etc/profile in the container shell session, and sources it again
+# before the next command whenever it changed (e.g. after
+# switch-to-configuration). `-ef` is a builtin, so this does not fork.
+# /etc/profile and set-environment return early once they ran in a shell,
+# so their guards are cleared first. Commands run in a `bash -c` child, so
+# they only see what the profile exports.
+NSPAWN_SHELL_SETUP = """
+__nixos_test_prepare() {
+  if ! [[ /etc/profile -ef ${__nixos_test_profile:-} ]]; then
+    unset __ETC_PROFILE_SOURCED __ETC_PROFILE_DONE __NIXOS_SET_ENVIRONMENT_DONE
+    source /etc/profile
+    __nixos_test_profile=$(readlink -f /etc/profile)
+  fi
+}
+__nixos_test_prepare
+"""
+
+
 class NspawnMachine(BaseMachine):
     """
     A handle to a systemd-nspawn container machine with this name, that also
@@ -1447,6 +1673,9 @@ class NspawnMachine(BaseMachine):
     machine_sock_path: Path
     machine_sock: socket.socket | None
 
+    shell_process: subprocess.Popen | None
+    shell_channel: ShellChannel | None
+
     @staticmethod
     def machine_name_from_start_command(start_command: str) -> str:
         match = re.search("run-(.+)-nspawn", os.path.basename(start_command))
@@ -1476,6 +1705,9 @@ class NspawnMachine(BaseMachine):
 
         self.start_command = start_command
         self.process = None
+        self.shell_process = None
+        self.shell_channel = None
+        self.shell_lock = threading.Lock()
 
         self.machine_sock_path = self.tmp_dir / f"{self.name}-nspawn.sock"
 
@@ -1492,6 +1724,8 @@ class NspawnMachine(BaseMachine):
         if self.machine_sock:
             self.machine_sock.close()
 
+        self._close_shell()
+
         self.logger.info(f"kill NspawnMachine (pid {self.process.pid})")
         self.process.terminate()
         # Wait for the wrapper to finish its context-manager cleanups
@@ -1577,39 +1811,95 @@ class NspawnMachine(BaseMachine):
     ) -> tuple[int, str]:
         self.start()
 
-        container_pid = self.get_systemd_process
-        nsenter = shutil.which("nsenter")
-        assert nsenter is not None
-
-        # Sourcing /etc/profile on every call of `_execute` ensures a correct shell
-        # environment (correct PATH, etc.). This is slower than the QEMU version.
-        #
-        # NOTE If the test calls switch-to-configuration (with a differently configured specialization)
-        # this will use the /etc/profile of the new specialisation while `QemuMachine` nodes
-        # will continue to use the original /etc/profile.
-        command = f"set -eo pipefail; source /etc/profile; set -u; {command}"
-
-        cp = subprocess.run(
-            [
-                nsenter,
-                "--target",
-                str(container_pid),
-                "--mount",
-                "--uts",
-                "--ipc",
-                "--net",
-                "--pid",
-                "--cgroup",
-                "/bin/sh",
-                "-c",
-                command,
-            ],
-            env={},
-            timeout=timeout,
-            stdout=subprocess.PIPE,
-            text=True,
+        # Always run command with shell opts
+        command = f"set -euo pipefail; {command}"
+
+        timeout_args = []
+        if timeout is not None:
+            timeout_args = ["timeout", str(timeout)]
+
+        channel = self._shell()
+        request_id = channel.submit(
+            [*timeout_args, "bash", "-c", command], ordered=not check_output
         )
-        return (cp.returncode, cp.stdout)
+
+        if not check_output:
+            channel.discard(request_id)
+            return (-2, "")
+
+        result = channel.wait(request_id)
+        if result is None:
+            if not check_return:
+                return (-1, "")
+            raise MachineError(f"container shell exited while running `{command}`")
+
+        rc, output = result
+        if not check_return:
+            return (-1, output.decode())
+
+        return (rc, output.decode(errors="replace"))
+
+    def _shell(self) -> ShellChannel:
+        """
+        Return the shell session inside the container, starting it if needed.
+
+        A single shell is entered with `nsenter` and kept around, so commands
+        do not pay for forking `nsenter` and sourcing /etc/profile every time.
+        Unlike on `QemuMachine`, /etc/profile is sourced again when it changes,
+        e.g. when the test calls switch-to-configuration with a differently
+        configured specialisation.
+
+        The shell exits with the container's PID namespace, e.g. when the
+        container reboots. A new one is then entered into the namespace of
+        the new leader process.
+        """
+        with self.shell_lock:
+            if self.shell_channel is not None:
+                assert self.shell_process is not None
+                if self.shell_process.poll() is None:
+                    return self.shell_channel
+                self.shell_channel.close()
+                self.shell_channel = None
+                self.shell_process = None
+                # Wait for the rebooted container to report its new leader
+                del self.get_systemd_process
+
+            container_pid = self.get_systemd_process
+            nsenter = shutil.which("nsenter")
+            assert nsenter is not None
+
+            host_sock, container_sock = socket.socketpair()
+            self.shell_process = subprocess.Popen(
+                [
+                    nsenter,
+                    "--target",
+                    str(container_pid),
+                    "--mount",
+                    "--uts",
+                    "--ipc",
+                    "--net",
+                    "--pid",
+                    "--cgroup",
+                    "/bin/sh",
+                ],
+                env={},
+                stdin=container_sock.fileno(),
+                stdout=container_sock.fileno(),
+            )
+            container_sock.close()
+            self.shell_channel = ShellChannel(host_sock, setup=NSPAWN_SHELL_SETUP)
+            return self.shell_channel
+
+    def _close_shell(self) -> None:
+        with self.shell_lock:
+            if self.shell_channel is not None:
+                self.shell_channel.close()
+                self.shell_channel = None
+            if self.shell_process is not None:
+                self.shell_process.kill()
+                self.shell_process.wait()
+                self.shell_process = None
+            self.__dict__.pop("get_systemd_process", None)
 
     def _stream_journal(self) -> None:
         assert self.process is not None, "Container not started"
@@ -1718,6 +2008,7 @@ class NspawnMachine(BaseMachine):
         with self.nested("waiting for the container to power off"):
             self.process.wait()
             self.process = None
+            self._close_shell()
 
 
 class MachineDeprecationWrapper:
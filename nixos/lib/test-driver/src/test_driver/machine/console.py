@@ -0,0 +1,110 @@
+import re
+import threading
+
+# Serial console output kept per machine, in characters
+CONSOLE_LOG_MAX_BYTES = 32 * 1024 * 1024
+
+# Number of already searched lines that are searched again together with new
+# output, so that patterns spanning several lines still match.
+CONSOLE_MATCH_WINDOW = 64
+
+
+class ConsoleLog:
+    """
+    A bounded buffer of serial console lines.
+
+    Every line gets an absolute index, starting at 0 for the first line after
+    boot. When more than `max_bytes` of output are buffered, the oldest lines
+    are dropped, but indices of the remaining lines stay the same. Readers can
+    block until lines beyond a given index arrive.
+    """
+
+    def __init__(self, max_bytes: int = CONSOLE_LOG_MAX_BYTES) -> None:
+        self.max_bytes = max_bytes
+        self._lines: list[str] = []
+        # Position of the oldest retained line in `_lines`; dropped lines are
+        # only removed from the list in bulk.
+        self._head = 0
+        # Absolute index of `_lines[0]`
+        self._offset = 0
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    @property
+    def start(self) -> int:
+        """Absolute index of the oldest retained line."""
+        with self._cond:
+            return self._offset + self._head
+
+    @property
+    def end(self) -> int:
+        """Absolute index one past the newest line."""
+        with self._cond:
+            return self._offset + len(self._lines)
+
+    @property
+    def closed(self) -> bool:
+        with self._cond:
+            return self._closed
+
+    def append(self, line: str) -> None:
+        with self._cond:
+            self._lines.append(line)
+            self._size += len(line) + 1
+            while self._size > self.max_bytes and self._head < len(self._lines) - 1:
+                self._size -= len(self._lines[self._head]) + 1
+                self._head += 1
+            if self._head > len(self._lines) // 2:
+                del self._lines[: self._head]
+                self._offset += self._head
+                self._head = 0
+            self._cond.notify_all()
+
+    def close(self) -> None:
+        """Mark the end of the output, waking up all readers."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def lines(self, start: int = 0, end: int | None = None) -> list[str]:
+        """Return the retained lines with absolute indices in [start, end)."""
+        with self._cond:
+            begin = max(start - self._offset, self._head)
+            stop = len(self._lines) if end is None else end - self._offset
+            return self._lines[begin:stop]
+
+    def wait_for_lines(self, index: int, timeout: float | None = None) -> bool:
+        """
+        Block until there is a line with an absolute index of at least `index`.
+        Returns False on timeout or if no more output is going to arrive.
+        """
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self._offset + len(self._lines) > index or self._closed,
+                timeout,
+            )
+            return self._offset + len(self._lines) > index
+
+    def search(
+        self,
+        pattern: re.Pattern,
+        start: int,
+        searched: int,
+        end: int,
+        window: int = CONSOLE_MATCH_WINDOW,
+    ) -> int | None:
+        """
+        Search for `pattern` in the lines [start, end), given that the lines
+        before `searched` have already been searched without a match. Only
+        the new lines, plus `window` lines before them, are searched again.
+
+        Returns the absolute index of the line in which the match ends, or
+        None if there is no match.
+        """
+        first = max(start, searched - window, self.start)
+        text = "\n".join(self.lines(first, end))
+        match = pattern.search(text)
+        if match is None:
+            return None
+        return first + text.count("\n", 0, max(match.start(), match.end() - 1))
@@ -1,11 +1,137 @@
+import hashlib
 import os
+import re
 import shutil
 import subprocess
+from collections import OrderedDict
 from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
 
 from test_driver.errors import MachineError
 
+PPM_HEADER = re.compile(rb"P6\s+(\d+)\s+(\d+)\s+(\d+)\s")
+
+# Pixels added around a changed region, so that OCR sees whole glyphs
+REGION_MARGIN = 16
+
+
+@dataclass
+class Frame:
+    """
+    A screenshot as written by QEMU's `screendump`, i.e. a binary PPM.
+    If the file cannot be parsed, `width` and `height` are 0 and the frame
+    is only usable as a whole.
+    """
+
+    path: Path
+    data: bytes
+    width: int = 0
+    height: int = 0
+    maxval: int = 255
+    # Offset of the first pixel in `data`
+    pixels: int = 0
+
+    @classmethod
+    def read(cls, path: Path) -> "Frame":
+        data = path.read_bytes()
+        match = PPM_HEADER.match(data)
+        if match is None:
+            return cls(path, data)
+        width, height, maxval = (int(g) for g in match.groups())
+        bytes_per_sample = 1 if maxval < 256 else 2
+        if len(data) - match.end() < width * height * 3 * bytes_per_sample:
+            return cls(path, data)
+        return cls(path, data, width, height, maxval, match.end())
+
+    @property
+    def digest(self) -> str:
+        return hashlib.sha256(self.data).hexdigest()
+
+    @property
+    def row_size(self) -> int:
+        return self.width * 3 * (1 if self.maxval < 256 else 2)
+
+    def row(self, y: int) -> bytes:
+        start = self.pixels + y * self.row_size
+        return self.data[start : start + self.row_size]
+
+    def changed_region(self, previous: "Frame", out: Path) -> "Frame | None":
+        """
+        Compare this frame with `previous` and return the bounding box of all
+        changed pixels (plus `REGION_MARGIN`) as a new frame written to `out`.
+        Returns None if both frames are identical, and this frame if they
+        cannot be compared.
+        """
+        if self.data == previous.data:
+            return None
+        if self.width == 0 or (self.width, self.height, self.maxval) != (
+            previous.width,
+            previous.height,
+            previous.maxval,
+        ):
+            return self
+
+        changed_rows = [y for y in range(self.height) if self.row(y) != previous.row(y)]
+        top, bottom = changed_rows[0], changed_rows[-1] + 1
+        pixel_size = self.row_size // self.width
+        left, right = self.width, 0
+        for y in changed_rows:
+            new, old = self.row(y), previous.row(y)
+            left = min(left, _first_difference(new, old) // pixel_size)
+            right = max(
+                right,
+                self.width - _first_difference(new[::-1], old[::-1]) // pixel_size,
+            )
+
+        top = max(0, top - REGION_MARGIN)
+        bottom = min(self.height, bottom + REGION_MARGIN)
+        left = max(0, left - REGION_MARGIN)
+        right = min(self.width, right + REGION_MARGIN)
+
+        rows = b"".join(
+            self.row(y)[left * pixel_size : right * pixel_size]
+            for y in range(top, bottom)
+        )
+        header = f"P6\n{right - left} {bottom - top}\n{self.maxval}\n".encode()
+        out.write_bytes(header + rows)
+        return Frame.read(out)
+
+
+def _first_difference(a: bytes, b: bytes) -> int:
+    """Index of the first byte in which `a` and `b` differ (which they must)."""
+    low, high = 0, min(len(a), len(b))
+    while high - low > 1:
+        mid = (low + high) // 2
+        if a[low:mid] == b[low:mid]:
+            low = mid
+        else:
+            high = mid
+    return low
+
+
+class OCRCache:
+    """
+    Memoizes OCR results by the content of the screenshot, so that OCR runs
+    at most once for every distinct frame.
+    """
+
+    def __init__(self, max_entries: int = 32) -> None:
+        self.max_entries = max_entries
+        self._results: OrderedDict[tuple[str, bool], list[str]] = OrderedDict()
+
+    def ocr(self, frame: Frame, variants: bool = True) -> list[str]:
+        key = (frame.digest, variants)
+        if key in self._results:
+            self._results.move_to_end(key)
+            return self._results[key]
+
+        result = perform_ocr_variants_on_screenshot(frame.path, variants)
+        self._results[key] = result
+        if len(self._results) > self.max_entries:
+            self._results.popitem(last=False)
+        return result
+
 
 def perform_ocr_on_screenshot(screenshot_path: Path) -> str:
     """
@@ -0,0 +1,244 @@
+import shlex
+import socket
+import threading
+
+from test_driver.errors import MachineError
+
+FRAME_MAGIC = "NIXOS-TEST-FRAME"
+
+# Helper functions installed into the guest's backdoor shell once per
+# connection. Every command is run with its stdout captured into a temporary
+# file; once the command (and everything still holding its stdout) is done,
+# a single frame is written back:
+#
+#     NIXOS-TEST-FRAME <request id> <exit status> <length>\n<length raw bytes>
+#
+# When `flock` is available, commands are run in the background and frames are
+# written under a lock, so several commands can be in flight at once.
+# Otherwise commands run one after another, which is still correct.
+# Commands submitted with `__nixos_test_run` always run in the foreground, so
+# later commands only start once they are done.
+#
+# If the shell defines `__nixos_test_prepare` before this, it is called in the
+# shell itself before every command is started.
+SHELL_PRELUDE = f"""
+__nixos_test_lock=$(command -v flock >/dev/null && mktemp)
+__nixos_test_exec() {{
+  local id=$1 out rc
+  shift
+  out=$(mktemp) || return
+  "$@" | cat > "$out"
+  rc=${{PIPESTATUS[0]}}
+  {{
+    [ -n "$__nixos_test_lock" ] && flock 9
+    printf '%s %s %s %s\\n' {FRAME_MAGIC} "$id" "$rc" "$(wc -c < "$out")"
+    cat "$out"
+  }} 9>>"${{__nixos_test_lock:-/dev/null}}"
+  rm -f "$out"
+}}
+declare -F __nixos_test_prepare >/dev/null || __nixos_test_prepare() {{ :; }}
+__nixos_test_submit() {{
+  __nixos_test_prepare
+  if [ -n "$__nixos_test_lock" ]; then
+    __nixos_test_exec "$@" &
+  else
+    __nixos_test_exec "$@"
+  fi
+}}
+__nixos_test_run() {{
+  __nixos_test_prepare
+  __nixos_test_exec "$@"
+}}
+"""
+
+# Written after the helper functions when the channel is reset. Everything the
+# shell sent before this frame (with the given negative id) predates the reset.
+SYNC_FRAME = f"printf '\\n%s %s 0 0\\n' {FRAME_MAGIC} {{sync_id}}\n"
+
+
+class ShellChannel:
+    """
+    A framed command channel on top of the guest's backdoor shell.
+
+    Each command is tagged with a request id, and its output and exit status
+    come back in a single length-prefixed frame, so there is no need for
+    base64 encoding or a second round-trip for the exit status.
+    Several threads may submit commands and wait for their results at the
+    same time: whichever waiter is not served yet reads the next frame from
+    the socket and hands it to its owner.
+    """
+
+    RECV_SIZE = 64 * 1024
+
+    def __init__(self, sock: socket.socket, setup: str = "") -> None:
+        self.sock = sock
+        self._buffer = bytearray()
+        self._next_id = 0
+        # Requests below this id were lost when the channel was reset
+        self._first_id = 0
+        self._send_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._results: dict[int, tuple[int, bytes]] = {}
+        self._discarded: set[int] = set()
+        self._reading = False
+        self._closed = False
+        self._resets = 0
+        # Id of the frame that ends the output from before the last reset
+        self._sync_id: int | None = None
+
+        self._send(setup + SHELL_PRELUDE)
+
+    def close(self) -> None:
+        self.sock.close()
+
+    def reset(self, setup: str = "") -> None:
+        """
+        Start over after the guest shell lost its state, e.g. because a VM
+        snapshot was restored: pending requests are dropped and the helper
+        functions are installed again. Request ids keep counting up, so late
+        frames of the dropped requests are not mistaken for new ones.
+
+        The buffer belongs to whichever thread is reading and may hold part
+        of a frame that will never be completed. Instead of touching it, the
+        reader is told to skip everything up to a sync frame sent after the
+        new helper functions.
+        """
+        with self._send_lock, self._cond:
+            self._results.clear()
+            self._discarded.clear()
+            self._first_id = self._next_id
+            self._resets += 1
+            self._sync_id = -self._resets
+            self.sock.sendall(
+                (
+                    setup + SHELL_PRELUDE + SYNC_FRAME.format(sync_id=self._sync_id)
+                ).encode()
+            )
+            self._cond.notify_all()
+
+    def _send(self, data: str) -> None:
+        with self._send_lock:
+            self.sock.sendall(data.encode())
+
+    def submit(self, command: list[str], ordered: bool = False) -> int:
+        """
+        Send a command (given as an argument vector) to the guest and
+        return its request id without waiting for the result.
+
+        With `ordered`, the command runs in the foreground of the shell, so
+        commands submitted later only start once it is done, even when
+        nobody waits for its result.
+        """
+        args = " ".join(shlex.quote(arg) for arg in command)
+        submit = "__nixos_test_run" if ordered else "__nixos_test_submit"
+        with self._send_lock:
+            request_id = self._next_id
+            self._next_id += 1
+            self.sock.sendall(f"{submit} {request_id} {args}\n".encode())
+        return request_id
+
+    def discard(self, request_id: int) -> None:
+        """
+        Drop the result of a request once it arrives.
+        """
+        with self._cond:
+            if request_id < self._first_id:
+                return
+            if self._results.pop(request_id, None) is None:
+                self._discarded.add(request_id)
+
+    def wait(self, request_id: int) -> tuple[int, bytes] | None:
+        """
+        Block until the frame for the given request has arrived and return
+        its exit status and output. Returns `None` if the shell disconnected
+        or the channel was reset before the result was sent.
+        """
+        with self._cond:
+            while True:
+                if request_id in self._results:
+                    return self._results.pop(request_id)
+                if self._closed or request_id < self._first_id:
+                    return None
+                if self._reading:
+                    self._cond.wait()
+                    continue
+
+                self._reading = True
+                self._cond.release()
+                try:
+                    frame = self._read_frame()
+                finally:
+                    self._cond.acquire()
+                    self._reading = False
+                    self._cond.notify_all()
+
+                if frame is None:
+                    self._closed = True
+                    continue
+                frame_id, status, output = frame
+                if frame_id < self._first_id:
+                    continue
+                if frame_id in self._discarded:
+                    self._discarded.remove(frame_id)
+                else:
+                    self._results[frame_id] = (status, output)
+
+    def _fill(self) -> bool:
+        chunk = self.sock.recv(self.RECV_SIZE)
+        if not chunk:
+            # Probably a broken pipe
+            return False
+        self._buffer += chunk
+        return True
+
+    def _pending_sync(self) -> int | None:
+        with self._cond:
+            return self._sync_id
+
+    def _read_frame(self) -> tuple[int, int, bytes] | None:
+        magic = FRAME_MAGIC.encode()
+        while True:
+            sync_id = self._pending_sync()
+            newline = self._buffer.find(b"\n")
+            if newline < 0:
+                if not self._fill():
+                    return None
+                continue
+
+            header = bytes(self._buffer[:newline])
+            del self._buffer[: newline + 1]
+            start = header.find(magic)
+            if start < 0:
+                # Not a frame header, e.g. stray output of the shell itself
+                continue
+            try:
+                _, frame_id, status, length = header[start:].split()
+                request_id, rc, size = int(frame_id), int(status), int(length)
+            except ValueError:
+                if sync_id is not None:
+                    # Possibly cut off by the reset
+                    continue
+                raise MachineError(
+                    f"malformed frame header from guest shell: {header!r}"
+                )
+
+            if sync_id is not None:
+                # Skip the frames from before the reset, whose output is
+                # searched for headers like any other stray output
+                if request_id == sync_id:
+                    with self._cond:
+                        if self._sync_id == sync_id:
+                            self._sync_id = None
+                continue
+
+            while len(self._buffer) < size:
+                if not self._fill():
+                    return None
+                if self._pending_sync() is not None:
+                    # Reset while reading the output, which may never
+                    # arrive: look for the sync frame from here on
+                    break
+            else:
+                output = bytes(self._buffer[:size])
+                del self._buffer[:size]
+                return request_id, rc, output
@@ -0,0 +1,94 @@
+import fcntl
+import os
+import shutil
+from collections.abc import Iterator
+from pathlib import Path
+
+# ioctl from linux/fs.h that makes `dst` share all extents of `src`
+FICLONE = 0x40049409
+
+# Bytes read per chunk when data has to be streamed
+CHUNK_SIZE = 1024 * 1024
+
+
+def _reflink(src: Path, dst: Path) -> None:
+    with open(src, "rb") as src_fh, open(dst, "wb") as dst_fh:
+        fcntl.ioctl(dst_fh.fileno(), FICLONE, src_fh.fileno())
+    shutil.copymode(src, dst)
+
+
+def link_or_copy(src: Path, dst: Path) -> int:
+    """
+    Place the file `src` at `dst` as cheaply as possible and return its size.
+
+    A hardlink is tried first, then a reflink. If both fail (e.g. because
+    `src` and `dst` are on different file systems), the data is copied in the
+    kernel where possible, without ever holding the whole file in memory.
+    The access rights bits are preserved in every case.
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        try:
+            _reflink(src, dst)
+        except OSError:
+            dst.unlink(missing_ok=True)
+            shutil.copy(src, dst)
+    return dst.stat().st_size
+
+
+def transfer(src: Path, dst: Path) -> int:
+    """
+    Place the file or directory `src` at `dst` using `link_or_copy` for each
+    file and return the number of bytes transferred.
+    """
+    if not src.is_dir():
+        return link_or_copy(src, dst)
+
+    total = 0
+
+    def copy_function(s: str, d: str) -> None:
+        nonlocal total
+        total += link_or_copy(Path(s), Path(d))
+
+    shutil.copytree(src, dst, copy_function=copy_function)
+    return total
+
+
+def move(src: Path, dst: Path) -> int:
+    """
+    Move the file or directory `src` to `dst` and return the number of bytes
+    moved. This is a rename if both are on the same file system, otherwise
+    `src` is copied and left in place.
+    """
+    size = tree_size(src)
+    try:
+        os.rename(src, dst)
+    except OSError:
+        if src.is_dir():
+            shutil.copytree(src, dst)
+        else:
+            shutil.copy(src, dst)
+    return size
+
+
+def tree_size(path: Path) -> int:
+    if not path.is_dir():
+        return path.stat().st_size
+    return sum(
+        (Path(root) / name).lstat().st_size
+        for root, _, files in os.walk(path)
+        for name in files
+    )
+
+
+def read_chunks(path: Path, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    with open(path, "rb") as fh:
+        while chunk := fh.read(chunk_size):
+            yield chunk
+
+
+def format_throughput(size: int, seconds: float) -> str:
+    mib = size / (1024 * 1024)
+    rate = mib / seconds if seconds > 0 else float("inf")
+    return f"{mib:.2f} MiB in {seconds:.2f} seconds ({rate:.2f} MiB/s)"
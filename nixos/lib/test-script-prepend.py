@@ -2,7 +2,16 @@
 # checked.
 
 from contextlib import contextmanager
-from typing import Any, Callable, ContextManager, Generator, List, Optional, Union
+from typing import (
+    Any,
+    Callable,
+    ContextManager,
+    Generator,
+    List,
+    Optional,
+    Sequence,
+    Union,
+)
 from unittest import TestCase
 
 from test_driver.debug import DebugAbstract, DebugNop
@@ -97,16 +106,34 @@ def join_all() -> None:
 log: AbstractLogger = CompositeLogger([])
 
 
+def parallel(
+    fn: Callable[[BaseMachine], Any], machines: Sequence[BaseMachine] | None = None
+) -> list[Any]:
+    return []
+
+
 def polling_condition(
     fun: Callable | None, seconds_interval: float = 0.0, description: str | None = None
 ):
     pass
 
 
-def retry(fn: Callable, timeout_seconds: int = 900) -> None:
+def retry(
+    fn: Callable,
+    timeout_seconds: int = 900,
+    wait: Callable[[float], None] | None = None,
+) -> None:
     pass
 
 
+def succeed_all(
+    *commands: str,
+    machines: Sequence[BaseMachine] | None = None,
+    timeout: int | None = None,
+) -> list[str]:
+    return []
+
+
 def run_tests() -> None:
     return
 
@@ -1,14 +1,15 @@
 import argparse
 import logging
 import sys
+from pathlib import Path
 from subprocess import CalledProcessError, run
 from typing import Final, assert_never
 
-from . import nix, services
+from . import nix, services, timings
 from .constants import EXECUTABLE, WITH_SHELL_FILES
 from .elevate import NO_ELEVATOR, ElevatorKind
-from .models import Action, BuildAttr, Flake, GroupedNixArgs, Profile
-from .process import Remote
+from .models import Action, BuildAttr, Flake, FleetHost, GroupedNixArgs, Profile
+from .process import SSH_POOL_DEFAULT_TTL, Remote, enable_ssh_pool, prewarm_ssh
 from .utils import LogFormatter
 
 logger: Final = logging.getLogger(__name__)
@@ -206,18 +207,98 @@ def get_parser() -> tuple[argparse.ArgumentParser, dict[str, argparse.ArgumentPa
     main_parser.add_argument(
         "--target-host", help="Specifies host to activate the configuration"
     )
+    main_parser.add_argument(
+        "--ssh-pool",
+        action="store_true",
+        help="Keep SSH connections to the build and target hosts open "
+        "across runs, and open them while the system is evaluated",
+    )
+    main_parser.add_argument(
+        "--ssh-pool-ttl",
+        type=int,
+        default=SSH_POOL_DEFAULT_TTL,
+        metavar="SECONDS",
+        help="How long pooled SSH connections stay open while idle",
+    )
+    main_parser.add_argument(
+        "--copy-while-building",
+        action="store_true",
+        help="Copy store paths to the target host as soon as they are built, "
+        "while the rest of the system is still building",
+    )
+    main_parser.add_argument(
+        "--adaptive-copy",
+        action="store_true",
+        help="Report the size of the closure missing on the target host before "
+        "copying, and pick compression and substitution based on the "
+        "throughput of earlier copies",
+    )
+    main_parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="Print the time spent in each phase and the slowest commands",
+    )
+    main_parser.add_argument(
+        "--trace-file",
+        metavar="FILE",
+        help="Write the timings of all phases and commands to FILE "
+        "in the Chrome trace event format",
+    )
     main_parser.add_argument("--no-build-nix", action="store_true", help="Deprecated")
     main_parser.add_argument(
         "--image-variant",
+        action="append",
         help="Selects an image variant to build from the "
-        "config.system.build.images attribute of the given configuration",
+        "config.system.build.images attribute of the given configuration, "
+        "can be given several times or set to 'all'",
     )
     main_parser.add_argument(
         "--diff",
-        action="store_true",
+        action="store_const",
+        const="text",
         help="prints out the diff between the current system "
         "and the newly built one using nix store diff-closures",
     )
+    # Not `--diff [{text,json}]`, since that would take the action in
+    # e.g. `nixos-rebuild --diff switch` as the format
+    main_parser.add_argument(
+        "--diff=json",
+        dest="diff",
+        action="store_const",
+        const="json",
+        help="like --diff, but print the diff as JSON",
+    )
+    main_parser.add_argument(
+        "--fleet",
+        metavar="INVENTORY",
+        help="Deploy to all hosts from a JSON inventory mapping hosts to "
+        "flake references or store paths",
+    )
+    main_parser.add_argument(
+        "--fleet-jobs",
+        type=int,
+        default=8,
+        help="Number of hosts deployed to concurrently with --fleet",
+    )
+    main_parser.add_argument(
+        "--canary",
+        type=int,
+        default=0,
+        help="Deploy to this many hosts first with --fleet, and stop if any fails",
+    )
+    main_parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=0,
+        help="Deploy to hosts in batches of this size with --fleet (default: all)",
+    )
+    main_parser.add_argument(
+        "--max-failure-rate",
+        type=float,
+        default=0.0,
+        help="Stop deploying further batches with --fleet once this share of "
+        "hosts (0 to 1) has failed",
+    )
     main_parser.add_argument("action", choices=Action.values(), nargs="?")
 
     return main_parser, sub_parsers
@@ -312,7 +393,11 @@ def parse_args(
     if args.action == Action.EDIT.value and (args.file or args.attr):
         parser.error(f"--file and --attr are not supported with '{args.action}'")
 
+    if args.action == Action.LIST_GENERATIONS.value and args.build_host:
+        parser.error(f"--build-host is not supported with '{args.action}'")
+
     if (args.target_host or args.build_host) and args.action not in (
+        Action.LIST_GENERATIONS.value,
         Action.SWITCH.value,
         Action.BOOT.value,
         Action.TEST.value,
@@ -329,6 +414,11 @@ def parse_args(
     if args.flake and (args.file or args.attr):
         parser.error("--flake cannot be used with --file or --attr")
 
+    # ControlPersist=0 keeps the master open forever and negative values
+    # make ssh refuse to start
+    if args.ssh_pool_ttl < 1:
+        parser.error("--ssh-pool-ttl must be a positive number of seconds")
+
     if (args.file or args.attr) and args.flake is None:
         # Disable flake auto-detection when --file or --attr is used
         args.flake = False
@@ -349,12 +439,66 @@ def parse_args(
             # Disable flake auto-detection since we're using a pre-built store path
             args.flake = False
 
+    if args.fleet:
+        if args.action not in (
+            Action.SWITCH.value,
+            Action.BOOT.value,
+            Action.TEST.value,
+            Action.DRY_ACTIVATE.value,
+        ):
+            parser.error(f"--fleet cannot be used with '{args.action}'")
+        if args.target_host or args.store_path or args.rollback:
+            parser.error(
+                "--fleet cannot be used with --target-host, --store-path or --rollback"
+            )
+        if args.file or args.attr:
+            parser.error("--fleet cannot be used with --file or --attr")
+        if args.fleet_jobs < 1:
+            parser.error("--fleet-jobs must be at least 1")
+        if args.canary < 0 or args.batch_size < 0:
+            parser.error("--canary and --batch-size cannot be negative")
+        if not 0 <= args.max_failure_rate <= 1:
+            parser.error("--max-failure-rate must be between 0 and 1")
+        if args.diff:
+            parser_warn("--diff is a no-op with --fleet")
+            args.diff = False
+
     return args, grouped_nix_args
 
 
 def execute(argv: list[str]) -> None:
     args, grouped_nix_args = parse_args(argv)
 
+    if args.timings or args.trace_file:
+        timings.enable()
+    try:
+        _execute(argv, args, grouped_nix_args)
+    finally:
+        if args.timings:
+            print(timings.summary(), file=sys.stderr)
+        if args.trace_file:
+            timings.write_trace(Path(args.trace_file))
+
+
+def _execute(
+    argv: list[str],
+    args: argparse.Namespace,
+    grouped_nix_args: GroupedNixArgs,
+) -> None:
+    if args.ssh_pool:
+        enable_ssh_pool(args.ssh_pool_ttl)
+        remotes = [
+            remote
+            for host in (args.build_host, args.target_host)
+            if (remote := Remote.from_arg(host, validate_opts=False))
+        ]
+        if args.fleet:
+            # only the hosts are needed here, so the default flake path is moot
+            remotes += [
+                host.target_host for host in FleetHost.from_inventory(args.fleet, ".")
+            ]
+        prewarm_ssh(remotes)
+
     if args.upgrade or args.upgrade_all:
         nix.upgrade_channels(args.upgrade_all, args.elevator)
 
@@ -374,9 +518,13 @@ def execute(argv: list[str]) -> None:
     profile = Profile.from_arg(args.profile_name)
     target_host = Remote.from_arg(args.target_host)
     build_host = Remote.from_arg(args.build_host, validate_opts=False)
+    if args.fleet:
+        host_label = "all fleet hosts"
+    else:
+        host_label = target_host.host if target_host else "localhost"
     args.elevator = args.elevator.with_prompted_password(
         ask=args.ask_elevate_password,
-        host_label=target_host.host if target_host else "localhost",
+        host_label=host_label,
     )
     build_attr = BuildAttr.from_arg(args.attr, args.file)
     flake = Flake.from_arg(args.flake, target_host)
@@ -384,10 +532,25 @@ def execute(argv: list[str]) -> None:
     if flake and (args.upgrade or args.upgrade_all):
         logger.warning("'--upgrade(-all)' flag has no effect for flake-based systems")
 
-    if can_run and not flake and not args.store_path:
+    if can_run and not flake and not args.store_path and not args.fleet:
         services.write_version_suffix(grouped_nix_args)
 
     match action:
+        case Action.SWITCH | Action.BOOT | Action.TEST | Action.DRY_ACTIVATE if (
+            args.fleet
+        ):
+            services.deploy_fleet(
+                action=action,
+                args=args,
+                hosts=FleetHost.from_inventory(
+                    args.fleet, flake.path if flake else "."
+                ),
+                build_host=build_host,
+                profile=profile,
+                build_attr=build_attr,
+                grouped_nix_args=grouped_nix_args,
+            )
+
         case (
             Action.SWITCH
             | Action.BOOT
@@ -417,7 +580,11 @@ def execute(argv: list[str]) -> None:
             raise AssertionError("DRY_RUN should be a DRY_BUILD alias")
 
         case Action.LIST_GENERATIONS:
-            services.list_generations(args=args, profile=profile)
+            services.list_generations(
+                args=args,
+                profile=profile,
+                target_host=target_host,
+            )
 
         case Action.REPL:
             services.repl(
@@ -0,0 +1,42 @@
+# Activate a NixOS configuration with a single command, e.g. in one SSH
+# session on a target host, reporting each step as a JSON line on stdout.
+#
+# Usage: sh -c "$script" activate PROFILE TOPLEVEL CONFIG ACTION CHECK [PREFIX...]
+#
+# If PROFILE is not empty, it is first set to TOPLEVEL (checking that it looks
+# like a NixOS system if CHECK is 1). Then CONFIG, which is either TOPLEVEL or
+# one of its specialisations, is activated with ACTION, run through PREFIX
+# (e.g. systemd-run) if systemd is working on this host.
+set -u
+
+profile=$1 toplevel=$2 config=$3 action=$4 check=$5
+shift 5
+
+step() {
+  printf '{"step": "%s", "status": "%s"}\n' "$1" "$2"
+}
+
+if [ -n "$profile" ]; then
+  if [ "$check" = 1 ] && [ ! -f "$toplevel/nixos-version" ]; then
+    step check failed
+    exit 1
+  fi
+  step check ok
+  nix-env -p "$profile" --set "$toplevel" >&2 || {
+    rc=$?
+    step set-profile failed
+    exit "$rc"
+  }
+  step set-profile ok
+fi
+
+if [ ! -d /run/systemd/system ]; then
+  # systemd is not working on this host, so do not use the prefix
+  set --
+fi
+"$@" "$config/bin/switch-to-configuration" "$action" >&2 || {
+  rc=$?
+  step switch-to-configuration failed
+  exit "$rc"
+}
+step switch-to-configuration ok
@@ -0,0 +1,32 @@
+# List the generations of a NixOS profile with a single command, e.g. in one
+# SSH session on a target host.
+#
+# Usage: sh -c "$script" list-generations PROFILE
+#
+# Prints one line per generation with tab-separated fields: generation number,
+# creation time (seconds since the epoch), 1 if it is the current generation
+# (0 otherwise), NixOS version, kernel version, configuration revision and the
+# names of its specialisations.
+set -u
+
+profile=$1
+current=$(readlink "$profile") || exit 1
+current=${current##*/}
+
+for link in "$profile"-*-link; do
+  [ -e "$link" ] || continue
+  name=${link##*/}
+  id=${name#"${profile##*/}-"}
+  id=${id%-link}
+  [ "$name" = "$current" ] && is_current=1 || is_current=0
+  version=$(cat "$link/nixos-version" 2>/dev/null) || version=Unknown
+  kernel=$(ls "$link/kernel-modules/lib/modules" 2>/dev/null | head -n 1)
+  revision=$("$link/sw/bin/nixos-version" --configuration-revision 2>/dev/null) ||
+    revision=Unknown
+  printf '%s\t%s\t%s\t%s\t%s\t%s' "$id" "$(stat -L -c %Z "$link")" \
+    "$is_current" "$version" "${kernel:-Unknown}" "$revision"
+  for specialisation in "$link"/specialisation/*; do
+    [ -d "$specialisation" ] && printf '\t%s' "${specialisation##*/}"
+  done
+  printf '\n'
+done
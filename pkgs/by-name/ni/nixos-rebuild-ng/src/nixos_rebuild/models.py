@@ -1,3 +1,4 @@
+import json
 import platform
 import re
 import subprocess
@@ -148,6 +149,73 @@ class Flake:
             return platform.node()
 
 
+@dataclass(frozen=True)
+class FleetHost:
+    target_host: Remote
+    flake: Flake | None
+    store_path: Path | None
+
+    @property
+    def configuration(self) -> Flake | Path:
+        "The configuration to deploy, hosts with the same one share its build."
+        configuration = self.store_path or self.flake
+        assert configuration is not None
+        return configuration
+
+    @classmethod
+    def from_inventory(cls, inventory_path: str, default_flake_path: str) -> list[Self]:
+        """Read a JSON inventory that maps each target host to what it runs.
+
+        Values are either flake references (`path#name`, where an empty path
+        means `default_flake_path`) or pre-built system store paths.
+        """
+        try:
+            inventory = json.loads(Path(inventory_path).read_text())
+        except (OSError, ValueError) as ex:
+            raise NixOSRebuildError(
+                f"could not read fleet inventory '{inventory_path}': {ex}"
+            ) from ex
+
+        if not isinstance(inventory, dict) or not inventory:
+            raise NixOSRebuildError(
+                f"fleet inventory '{inventory_path}' must be a non-empty JSON "
+                "object mapping hosts to flake references or store paths"
+            )
+
+        hosts = []
+        for host, value in inventory.items():
+            target_host = Remote.from_arg(host)
+            if target_host is None or not isinstance(value, str):
+                raise NixOSRebuildError(
+                    f"invalid fleet inventory entry for host '{host}': {value!r}"
+                )
+            if "#" in value:
+                flake = Flake.parse(value, target_host)
+                if not flake.path:
+                    flake = Flake(default_flake_path, flake.attr)
+                hosts.append(cls(target_host, flake, None))
+            elif value.startswith("/"):
+                hosts.append(cls(target_host, None, Path(value)))
+            else:
+                raise NixOSRebuildError(
+                    f"invalid fleet inventory entry for host '{host}': expected "
+                    f"a flake reference (path#name) or a store path, got {value!r}"
+                )
+        return hosts
+
+
+@dataclass(frozen=True)
+class ImageDerivation:
+    drv_path: Path
+    out_path: Path
+    # path of the image file relative to out_path
+    file_path: str
+
+    @classmethod
+    def from_json(cls, j: dict[str, str]) -> Self:
+        return cls(Path(j["drvPath"]), Path(j["outPath"]), j["filePath"])
+
+
 @dataclass(frozen=True)
 class Generation:
     id: int
@@ -155,6 +223,14 @@ class Generation:
     current: bool
 
 
+# camelCase since this will be used as output for `--diff=json` flag
+class ClosureDiffJson(TypedDict):
+    package: str
+    versionsBefore: list[str]
+    versionsAfter: list[str]
+    sizeDelta: int
+
+
 # camelCase since this will be used as output for `--json` flag
 class GenerationJson(TypedDict):
     generation: int
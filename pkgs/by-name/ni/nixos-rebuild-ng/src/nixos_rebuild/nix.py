@@ -1,9 +1,15 @@
 import json
 import logging
 import os
+import queue
+import re
 import sys
 import textwrap
+import threading
+import time
 import uuid
+from collections import deque
+from collections.abc import Sequence
 from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from importlib.resources import files
@@ -11,26 +17,40 @@ from pathlib import Path
 from string import Template
 from subprocess import PIPE, CalledProcessError
 from textwrap import dedent
-from typing import Final, Literal
+from typing import Any, Final, Literal
 
-from . import tmpdir
+from . import timings, tmpdir
 from .elevate import NO_ELEVATOR, PRESERVE_ENV, Elevator
 from .models import (
     Action,
     BuildAttr,
+    ClosureDiffJson,
     Flake,
     Generation,
     GenerationJson,
+    ImageDerivation,
     ImageVariants,
     NixOSRebuildError,
     Profile,
     Remote,
 )
-from .process import SSH_DEFAULT_OPTS, run_wrapper
-from .utils import Args, dict_to_flags
+from .process import popen_wrapper, run_wrapper, ssh_opts
+from .utils import Args, dict_to_flags, read_cache, write_cache
 
 FLAKE_FLAGS: Final = ["--extra-experimental-features", "nix-command flakes"]
 FLAKE_REPL_TEMPLATE: Final = "repl.nix.template"
+ACTIVATE_SCRIPT: Final = "activate.sh"
+LIST_GENERATIONS_SCRIPT: Final = "list-generations.sh"
+GENERATION_INDEX_FILE: Final = "generations.json"
+COPY_STATS_FILE: Final = "copy-stats.json"
+# NARs usually compress well, so below this link throughput (bytes/s)
+# compressing the SSH stream is faster than sending them as they are
+COPY_COMPRESS_BELOW: Final = 16 * 1024 * 1024
+# Let the target host try its substituters first if sending the missing
+# paths is expected to take longer than this (seconds)
+COPY_SUBSTITUTE_ABOVE: Final = 60
+# Smaller transfers are dominated by latency and say little about throughput
+COPY_MEASURE_ABOVE: Final = 4 * 1024 * 1024
 SWITCH_TO_CONFIGURATION_CMD_PREFIX: Final = [
     "systemd-run",
     "-E",
@@ -48,6 +68,14 @@ SWITCH_TO_CONFIGURATION_CMD_PREFIX: Final = [
     "--service-type=exec",
     "--unit=nixos-rebuild-switch-to-configuration",
 ]
+ANSI_ESCAPE_RE: Final = re.compile(r"\x1b\[[0-9;]*m")
+CLOSURE_DIFF_SIZE_RE: Final = re.compile(r"(?:^|, )([+-]\d+(?:\.\d+)?) KiB$")
+# Activity and result types from Nix's `--log-format internal-json`
+NIX_ACT_BUILD: Final = 105
+NIX_ACT_SUBSTITUTE: Final = 108
+NIX_RES_BUILD_LOG_LINE: Final = 101
+# Lines of a failed build's log to show without `--print-build-logs`
+NIX_BUILD_LOG_TAIL: Final = 25
 logger: Final = logging.getLogger(__name__)
 
 
@@ -55,9 +83,14 @@ def build(
     attr: str,
     build_attr: BuildAttr,
     build_flags: Args | None = None,
+    copy_to: Remote | None = None,
+    copy_flags: Args | None = None,
 ) -> Path:
     """Build NixOS attribute using classic Nix.
 
+    If `copy_to` is set, store paths are already copied there while the
+    build is still running, see `_build_and_copy`.
+
     Returns the built attribute as path.
     """
     run_args = [
@@ -67,6 +100,8 @@ def build(
         build_attr.to_attr(attr),
         *dict_to_flags(build_flags),
     ]
+    if copy_to:
+        return _build_and_copy(run_args, build_flags, copy_to, copy_flags)
     r = run_wrapper(run_args, stdout=PIPE)
     return Path(r.stdout.strip())
 
@@ -75,9 +110,14 @@ def build_flake(
     attr: str,
     flake: Flake,
     flake_build_flags: Args | None = None,
+    copy_to: Remote | None = None,
+    copy_flags: Args | None = None,
 ) -> Path:
     """Build NixOS attribute using Flakes.
 
+    If `copy_to` is set, store paths are already copied there while the
+    build is still running, see `_build_and_copy`.
+
     Returns the built attribute as path.
     """
     run_args = [
@@ -88,10 +128,121 @@ def build_flake(
         flake.to_attr(attr),
         *dict_to_flags(flake_build_flags),
     ]
+    if copy_to:
+        return _build_and_copy(run_args, flake_build_flags, copy_to, copy_flags)
     r = run_wrapper(run_args, stdout=PIPE)
     return Path(r.stdout.strip())
 
 
+def _build_and_copy(
+    run_args: Sequence[str | Path],
+    build_flags: Args | None,
+    copy_to: Remote,
+    copy_flags: Args | None,
+) -> Path:
+    """Run a build, copying every path to `copy_to` as soon as it is built or
+    substituted, so only the last paths are left to copy when it finishes.
+
+    The build's activities are followed with `--log-format internal-json`;
+    its messages, a line for every build and substitution and the build logs
+    are still shown. Without `--print-build-logs` only the last lines of the
+    logs of failed builds are.
+    """
+    print_build_logs = bool((build_flags or {}).get("print_build_logs"))
+    # The last --log-format flag wins
+    run_args = [*run_args, "--log-format", "internal-json"]
+
+    finished: queue.Queue[str | None] = queue.Queue()
+    copied = 0
+
+    def copy_finished() -> None:
+        nonlocal copied
+        done = False
+        while not done:
+            items = [finished.get()]
+            while not finished.empty():
+                items.append(finished.get_nowait())
+            done = None in items
+            paths = [item for item in items if item is not None]
+            if not paths:
+                continue
+
+            drvs = [p for p in paths if p.endswith(".drv")]
+            if drvs:
+                r = run_wrapper(
+                    ["nix-store", "--query", "--outputs", *drvs],
+                    check=False,
+                    capture_output=True,
+                )
+                paths = [p for p in paths if not p.endswith(".drv")]
+                paths.extend(r.stdout.split())
+            try:
+                copy_closure([Path(p) for p in paths], copy_to, copy_flags=copy_flags)
+                copied += len(paths)
+            except CalledProcessError as ex:
+                # e.g. a failed build, anything missing is copied afterwards
+                logger.debug("could not copy paths while building: %s", ex)
+
+    copier = threading.Thread(target=copy_finished, daemon=True)
+    copier.start()
+
+    process = popen_wrapper(run_args, stdout=PIPE, stderr=PIPE)
+    assert process.stdout is not None and process.stderr is not None
+    activities: dict[int, str] = {}
+    build_logs: dict[str, deque[str]] = {}
+    try:
+        for line in process.stderr:
+            if not line.startswith("@nix "):
+                print(line, end="", file=sys.stderr)
+                continue
+            event = json.loads(line.removeprefix("@nix "))
+            match event.get("action"):
+                case "start" if event.get("type") in (
+                    NIX_ACT_BUILD,
+                    NIX_ACT_SUBSTITUTE,
+                ):
+                    # The derivation for builds, the store path for substitutions
+                    activities[event["id"]] = event["fields"][0]
+                    if event.get("text"):
+                        print(event["text"], file=sys.stderr)
+                case "stop" if event["id"] in activities:
+                    finished.put(activities.pop(event["id"]))
+                case "msg":
+                    print(event["msg"], file=sys.stderr)
+                    # Nix reports failed builds after their activity stopped,
+                    # add the log unless the error already includes it
+                    if event.get("level") == 0:
+                        for drv, log in build_logs.items():
+                            if drv in event["msg"] and log[-1] not in event["msg"]:
+                                print(
+                                    f"last {len(log)} log lines of '{drv}':",
+                                    *log,
+                                    sep="\n",
+                                    file=sys.stderr,
+                                )
+                case "result" if event.get("type") == NIX_RES_BUILD_LOG_LINE:
+                    if print_build_logs:
+                        print(event["fields"][0], file=sys.stderr)
+                    elif event["id"] in activities:
+                        build_logs.setdefault(
+                            activities[event["id"]], deque(maxlen=NIX_BUILD_LOG_TAIL)
+                        ).append(event["fields"][0])
+        stdout = process.stdout.read()
+        returncode = process.wait()
+    finally:
+        # e.g. on KeyboardInterrupt, don't leave the build running
+        if process.poll() is None:
+            process.terminate()
+            process.wait()
+        finished.put(None)
+        copier.join()
+
+    if returncode:
+        raise CalledProcessError(returncode, run_args, output=stdout)
+    logger.debug("copied %d path(s) to '%s' while building", copied, copy_to.host)
+    return Path(stdout.strip())
+
+
 def build_remote(
     attr: str,
     build_attr: BuildAttr,
@@ -182,18 +333,162 @@ def build_remote_flake(
     return Path(r.stdout.strip())
 
 
+def _format_size(size: float) -> str:
+    units = ["B", "KiB", "MiB", "GiB", "TiB"]
+    unit = 0
+    while size >= 1024 and unit < len(units) - 1:
+        size /= 1024
+        unit += 1
+    return f"{size:.1f} {units[unit]}"
+
+
+def _query_missing_size(
+    closures: Sequence[Path],
+    host: Remote,
+) -> tuple[int, int, int]:
+    """Find out how much of the closures is not valid on `host` yet.
+
+    Returns the number of missing paths, their NAR size and the NAR size of
+    the whole closure.
+    """
+    r = run_wrapper(
+        ["nix", *FLAKE_FLAGS, "path-info", "--json", "--recursive", *closures],
+        stdout=PIPE,
+    )
+    info = json.loads(r.stdout)
+    # Nix < 2.19 returns a list of objects, newer versions a path -> info map
+    if isinstance(info, list):
+        info = {i["path"]: i for i in info}
+    sizes = {path: i.get("narSize", 0) for path, i in info.items()}
+
+    # a closure easily has thousands of paths, too many for one ssh command line
+    r = run_wrapper(
+        ["xargs", "nix-store", "--check-validity", "--print-invalid"],
+        remote=host,
+        stdin_text="\n".join(sizes),
+        stdout=PIPE,
+    )
+    missing = r.stdout.split()
+    return (
+        len(missing),
+        sum(sizes.get(path, 0) for path in missing),
+        sum(sizes.values()),
+    )
+
+
+def _plan_copy(
+    closures: Sequence[Path],
+    host: Remote,
+    copy_flags: Args | None,
+) -> tuple[int, Args | None, list[str]]:
+    """Plan the copy of `closures` to `host`.
+
+    Reports how much has to be transferred and, based on the throughput
+    measured by earlier copies to the same host, picks SSH compression and
+    substitution on the target. Returns the missing NAR size, the copy flags
+    and extra SSH options to use.
+    """
+    missing_paths, missing_size, total_size = _query_missing_size(closures, host)
+    logger.info(
+        "copying %d path(s) (%s of %s) to '%s'",
+        missing_paths,
+        _format_size(missing_size),
+        _format_size(total_size),
+        host.host,
+    )
+    if not missing_size:
+        return missing_size, copy_flags, []
+
+    stats = read_cache(COPY_STATS_FILE).get(host.host, {})
+    plain = stats.get("plain_throughput")
+    compressed = stats.get("compressed_throughput")
+    if plain is None and compressed is None:
+        logger.debug("no throughput measured for '%s' yet", host.host)
+        return missing_size, copy_flags, []
+
+    # Decided anew on every copy from the latest measurements: compress on
+    # slow links, unless compressing turned out to be slower there
+    compress = (
+        plain is not None
+        and plain < COPY_COMPRESS_BELOW
+        and (compressed is None or compressed > plain)
+    )
+    # without a measurement for the chosen mode, estimate with the other one
+    throughput = compressed if compress and compressed is not None else plain
+    if throughput is None:
+        throughput = compressed
+    eta = missing_size / throughput
+    logger.info("estimated transfer time: %ds at %s/s", eta, _format_size(throughput))
+    sshopts: list[str] = []
+    if compress:
+        logger.debug("compressing the transfer to '%s'", host.host)
+        # ssh uses the first value of an option, and a shared connection
+        # keeps the compression it was opened with
+        sshopts = [
+            "-o",
+            "Compression=yes",
+            "-o",
+            f"ControlPath={tmpdir.TMPDIR_PATH / 'ssh-compressed-%C'}",
+        ]
+    if eta > COPY_SUBSTITUTE_ABOVE and not (copy_flags or {}).get("s"):
+        logger.info("letting '%s' try its substituters first", host.host)
+        copy_flags = (copy_flags or {}) | {"s": True}
+    return missing_size, copy_flags, sshopts
+
+
+def _record_copy_throughput(
+    host: Remote,
+    size: int,
+    duration: float,
+    compressed: bool,
+) -> None:
+    if size < COPY_MEASURE_ABOVE or duration <= 0:
+        return
+    stats = read_cache(COPY_STATS_FILE)
+    key = "compressed_throughput" if compressed else "plain_throughput"
+    stats[host.host] = stats.get(host.host, {}) | {key: size / duration}
+    write_cache(COPY_STATS_FILE, stats)
+
+
 def copy_closure(
-    closure: Path,
+    closure: Path | Sequence[Path],
     to_host: Remote | None,
     from_host: Remote | None = None,
     copy_flags: Args | None = None,
+    adaptive: bool = False,
 ) -> None:
-    """Copy a nix closure to or from host to localhost.
+    """Copy a nix closure (or the closures of several paths) to or from host
+    to localhost.
 
-    Also supports copying a closure from a remote to another remote."""
+    Also supports copying a closure from a remote to another remote.
+
+    With `adaptive`, copies from localhost to an SSH host are planned first:
+    the missing size is reported, nothing is sent if the closure is already
+    there, and compression and substitution on the target are picked based on
+    the throughput of earlier copies to that host."""
+    closures = [closure] if isinstance(closure, Path) else list(closure)
 
     sshopts = os.getenv("NIX_SSHOPTS", "")
-    env = {"NIX_SSHOPTS": " ".join(filter(lambda x: x, [sshopts, *SSH_DEFAULT_OPTS]))}
+    plan = (
+        adaptive
+        and from_host is None
+        and to_host is not None
+        and to_host.store_type in ("ssh", "ssh-ng")
+    )
+    extra_sshopts: list[str] = []
+    if plan:
+        assert to_host is not None
+        missing_size, copy_flags, extra_sshopts = _plan_copy(
+            closures, to_host, copy_flags
+        )
+        if not missing_size:
+            return
+    env = {
+        "NIX_SSHOPTS": " ".join(
+            filter(lambda x: x, [sshopts, *extra_sshopts, *ssh_opts()])
+        )
+    }
+    start = time.monotonic()
 
     def nix_copy_closure(host: Remote, to: bool) -> None:
         run_wrapper(
@@ -202,7 +497,7 @@ def copy_closure(
                 *dict_to_flags(copy_flags),
                 "--to" if to else "--from",
                 host.host,
-                closure,
+                *closures,
             ],
             append_local_env=env,
         )
@@ -221,7 +516,7 @@ def copy_closure(
                 "copy",
                 *dict_to_flags(copy_flags),
                 *host_flags,
-                closure,
+                *closures,
             ],
             append_local_env=env,
         )
@@ -237,6 +532,18 @@ def copy_closure(
         case (Remote(_), _) | (_, Remote(_)):
             nix_copy(to_host, from_host)
 
+    # with substitution, part of the missing paths came from the target's
+    # substituters instead of over the link, so the duration says nothing
+    # about its throughput
+    if plan and not (copy_flags or {}).get("s"):
+        assert to_host is not None
+        _record_copy_throughput(
+            to_host,
+            missing_size,
+            time.monotonic() - start,
+            compressed=bool(extra_sshopts),
+        )
+
 
 def edit() -> None:
     "Try to find and open NixOS configuration file in editor."
@@ -385,6 +692,173 @@ def get_build_image_variants_flake(
     return j
 
 
+def _image_derivations_fn(variants: Sequence[str]) -> str:
+    """Nix function from config.system.build.images to what build-image needs.
+
+    Also returns the names of all variants, so unknown variants can be
+    reported without evaluating the images again."""
+    variant_list = " ".join(json.dumps(v) for v in variants)
+    return (
+        "images: { variants = builtins.attrNames images;"
+        " images = builtins.listToAttrs (map (v: { name = v; value = {"
+        " drvPath = images.${v}.drvPath;"
+        " outPath = images.${v}.outPath;"
+        " filePath = images.${v}.passthru.filePath;"
+        " }; }) (builtins.filter (v: builtins.hasAttr v images)"
+        f" [ {variant_list} ])); }}"
+    )
+
+
+def get_build_image_derivations(
+    build_attr: BuildAttr,
+    variants: Sequence[str],
+    instantiate_flags: Args | None = None,
+) -> tuple[ImageVariants, dict[str, ImageDerivation]]:
+    """Evaluate the derivations and image file names of several image
+    variants at once, so they can be built without evaluating again.
+
+    Returns all variants of the configuration alongside the derivations of
+    those of `variants` that exist."""
+    path = (
+        f'"{build_attr.path.resolve()}"'
+        if isinstance(build_attr.path, Path)
+        else build_attr.path
+    )
+    r = run_wrapper(
+        [
+            "nix-instantiate",
+            "--eval",
+            "--strict",
+            "--json",
+            # instantiates the derivations, needed for drvPath
+            "--read-write-mode",
+            "--expr",
+            textwrap.dedent(f"""
+            let
+              value = import {path};
+              set = if builtins.isFunction value then value {{}} else value;
+            in
+              ({_image_derivations_fn(variants)})
+                set.{build_attr.to_attr("config.system.build.images")}
+            """),
+            *dict_to_flags(instantiate_flags),
+        ],
+        stdout=PIPE,
+    )
+    j = json.loads(r.stdout.strip())
+    images = j["images"]
+    return j["variants"], {
+        v: ImageDerivation.from_json(images[v]) for v in variants if v in images
+    }
+
+
+def get_build_image_derivations_flake(
+    flake: Flake,
+    variants: Sequence[str],
+    eval_flags: Args | None = None,
+) -> tuple[ImageVariants, dict[str, ImageDerivation]]:
+    """Evaluate the derivations and image file names of several image
+    variants at once, so they can be built without evaluating again.
+
+    Returns all variants of the configuration alongside the derivations of
+    those of `variants` that exist."""
+    r = run_wrapper(
+        [
+            "nix",
+            *FLAKE_FLAGS,
+            "eval",
+            "--json",
+            flake.to_attr("config.system.build.images"),
+            "--apply",
+            _image_derivations_fn(variants),
+            *dict_to_flags(eval_flags),
+        ],
+        stdout=PIPE,
+    )
+    j = json.loads(r.stdout.strip())
+    images = j["images"]
+    return j["variants"], {
+        v: ImageDerivation.from_json(images[v]) for v in variants if v in images
+    }
+
+
+def realise(
+    drvs: Sequence[Path],
+    build_host: Remote | None,
+    out_link: Path | None = None,
+    realise_flags: Args | None = None,
+    copy_flags: Args | None = None,
+) -> None:
+    """Build already instantiated derivations in a single `nix-store
+    --realise`, so Nix can schedule them in parallel.
+
+    Locally, GC roots are created at `out_link`, `out_link-2`, ... in the
+    order of `drvs`. With a `build_host`, the derivations are built there and
+    their outputs copied back.
+    """
+    if build_host is None:
+        run_args: list[str | Path] = ["nix-store", "--realise", *drvs]
+        if out_link:
+            run_args += ["--add-root", out_link]
+        run_wrapper([*run_args, *dict_to_flags(realise_flags)], stdout=PIPE)
+        return
+
+    copy_closure(drvs, to_host=build_host, copy_flags=copy_flags)
+    r = run_wrapper(
+        ["mktemp", "-d", "-t", "nixos-rebuild.XXXXX"], remote=build_host, stdout=PIPE
+    )
+    remote_tmpdir = Path(r.stdout.strip())
+    try:
+        r = run_wrapper(
+            [
+                "nix-store",
+                "--realise",
+                *drvs,
+                "--add-root",
+                remote_tmpdir / "result",
+                *dict_to_flags(realise_flags),
+            ],
+            remote=build_host,
+            stdout=PIPE,
+        )
+        r = run_wrapper(
+            ["readlink", "-f", *r.stdout.split()], remote=build_host, stdout=PIPE
+        )
+        copy_closure(
+            [Path(p) for p in r.stdout.split()],
+            to_host=None,
+            from_host=build_host,
+            copy_flags=copy_flags,
+        )
+    finally:
+        run_wrapper(["rm", "-rf", remote_tmpdir], remote=build_host, check=False)
+
+
+def get_flake_metadata(
+    flake: Flake,
+    eval_flags: Args | None = None,
+) -> dict[str, Any] | None:
+    "Get the locked metadata of a flake, see `nix flake metadata --json`."
+    r = run_wrapper(
+        [
+            "nix",
+            *FLAKE_FLAGS,
+            "flake",
+            "metadata",
+            "--json",
+            flake.path or ".",
+            *dict_to_flags(eval_flags),
+        ],
+        check=False,
+        capture_output=True,
+    )
+    if r.returncode:
+        logger.debug("could not get flake metadata: %s", r.stderr)
+        return None
+    metadata: dict[str, Any] = json.loads(r.stdout)
+    return metadata
+
+
 def get_nixpkgs_rev(nixpkgs_path: Path | None) -> str | None:
     """Get Nixpkgs path as a Git revision.
 
@@ -491,71 +965,143 @@ def get_generations_from_nix_env(
     )
 
 
-def list_generations(profile: Profile) -> list[GenerationJson]:
+def _get_generation_info(generation_path: Path) -> dict[str, Any]:
+    try:
+        nixos_version = (generation_path / "nixos-version").read_text().strip()
+    except OSError as ex:
+        logger.debug("could not get nixos-version: %s", ex)
+        nixos_version = "Unknown"
+    try:
+        kernel_version = next(
+            (generation_path / "kernel-modules/lib/modules").iterdir()
+        ).name
+    except OSError as ex:
+        logger.debug("could not get kernel version: %s", ex)
+        kernel_version = "Unknown"
+    specialisations = [
+        s.name for s in (generation_path / "specialisation").glob("*") if s.is_dir()
+    ]
+    try:
+        configuration_revision = run_wrapper(
+            [generation_path / "sw/bin/nixos-version", "--configuration-revision"],
+            capture_output=True,
+        ).stdout.strip()
+    except (OSError, CalledProcessError) as ex:
+        logger.debug("could not get configuration revision: %s", ex)
+        configuration_revision = "Unknown"
+
+    return {
+        "nixosVersion": nixos_version,
+        "kernelVersion": kernel_version,
+        "configurationRevision": configuration_revision,
+        "specialisations": specialisations,
+    }
+
+
+def list_generations(
+    profile: Profile,
+    target_host: Remote | None = None,
+) -> list[GenerationJson]:
     """Get all NixOS generations from profile, including extra information.
 
     Includes OS information like the commit, kernel version, configuration
     revision and specialisations.
 
+    Generations are immutable store paths, so locally this information is
+    kept in an index in the cache directory, keyed by store path, and every
+    generation is only inspected once. On a target host, everything is
+    collected with a single command.
+
     Will be formatted in a way that is expected by the output of
     `nixos-rebuild list-generations --json`.
     """
+    if target_host:
+        return _list_generations_remote(profile, target_host)
+
+    index = read_cache(GENERATION_INDEX_FILE)
+    new_entries: dict[str, dict[str, Any]] = {}
 
     def get_generation_info(generation: Generation) -> GenerationJson:
         generation_path = (
             profile.path.parent / f"{profile.path.name}-{generation.id}-link"
         )
-        try:
-            nixos_version = (generation_path / "nixos-version").read_text().strip()
-        except OSError as ex:
-            logger.debug("could not get nixos-version: %s", ex)
-            nixos_version = "Unknown"
-        try:
-            kernel_version = next(
-                (generation_path / "kernel-modules/lib/modules").iterdir()
-            ).name
-        except OSError as ex:
-            logger.debug("could not get kernel version: %s", ex)
-            kernel_version = "Unknown"
-        specialisations = [
-            s.name for s in (generation_path / "specialisation").glob("*") if s.is_dir()
-        ]
-        try:
-            configuration_revision = run_wrapper(
-                [generation_path / "sw/bin/nixos-version", "--configuration-revision"],
-                capture_output=True,
-            ).stdout.strip()
-        except (OSError, CalledProcessError) as ex:
-            logger.debug("could not get configuration revision: %s", ex)
-            configuration_revision = "Unknown"
+        store_path = generation_path.resolve()
+        info = index.get(str(store_path))
+        if info is None:
+            info = _get_generation_info(generation_path)
+            if store_path != generation_path and store_path.exists():
+                new_entries[str(store_path)] = info
 
         return GenerationJson(
             generation=generation.id,
             date=generation.timestamp,
-            nixosVersion=nixos_version,
-            kernelVersion=kernel_version,
-            configurationRevision=configuration_revision,
-            specialisations=specialisations,
+            nixosVersion=info["nixosVersion"],
+            kernelVersion=info["kernelVersion"],
+            configurationRevision=info["configurationRevision"],
+            specialisations=info["specialisations"],
             current=generation.current,
         )
 
     # This can be surprisingly slow, especially with lots of generations,
     # but it is basically IO work so we can run in parallel
     with ThreadPoolExecutor() as executor:
-        return sorted(
+        generations = sorted(
             executor.map(get_generation_info, get_generations(profile)),
             key=lambda x: x["generation"],
             reverse=True,
         )
 
+    if new_entries:
+        # Drop generations that have been garbage collected in the meantime
+        index = {path: info for path, info in index.items() if Path(path).exists()}
+        write_cache(GENERATION_INDEX_FILE, index | new_entries)
+    return generations
+
+
+def _list_generations_remote(
+    profile: Profile,
+    target_host: Remote,
+) -> list[GenerationJson]:
+    script = files(__package__).joinpath(LIST_GENERATIONS_SCRIPT).read_text()
+    r = run_wrapper(
+        ["/bin/sh", "-c", script, "list-generations", profile.path],
+        remote=target_host,
+        check=False,
+        stdout=PIPE,
+    )
+    if r.returncode:
+        raise NixOSRebuildError(
+            f"no profile '{profile.name}' found on '{target_host.host}'"
+        )
+
+    def parse_line(line: str) -> GenerationJson:
+        entry_id, ctime, current, version, kernel, revision, *specialisations = (
+            line.split("\t")
+        )
+        return GenerationJson(
+            generation=int(entry_id),
+            date=datetime.fromtimestamp(int(ctime)).strftime("%Y-%m-%d %H:%M:%S"),
+            nixosVersion=version,
+            kernelVersion=kernel,
+            configurationRevision=revision,
+            specialisations=specialisations,
+            current=current == "1",
+        )
+
+    return sorted(
+        [parse_line(line) for line in r.stdout.splitlines() if line],
+        key=lambda x: x["generation"],
+        reverse=True,
+    )
+
 
 def diff_closures(
     current_config: Path,
     new_config: Path,
     target_host: Remote | None = None,
-) -> None:
-    print(f"<<< {current_config}\n>>> {new_config}", file=sys.stderr)
-    run_wrapper(
+) -> str:
+    "Return the output of `nix store diff-closures` for two configurations."
+    r = run_wrapper(
         [
             "nix",
             *FLAKE_FLAGS,
@@ -565,8 +1111,52 @@ def diff_closures(
             new_config,
         ],
         remote=target_host,
-        stdout=sys.stderr,
+        stdout=PIPE,
     )
+    return r.stdout
+
+
+def parse_closures_diff(diff: str) -> list[ClosureDiffJson]:
+    """Parse the output of `nix store diff-closures`.
+
+    Each line looks like `name: 1.0, 1.1 → 1.2, +12.5 KiB`, where either the
+    versions or the size may be missing, `∅` means that the package is not
+    in the closure and `ε` stands for an empty version.
+    """
+
+    def parse_versions(versions: str) -> list[str]:
+        if versions == "∅":
+            return []
+        return ["" if v == "ε" else v for v in versions.split(", ")]
+
+    changes: list[ClosureDiffJson] = []
+    for line in diff.splitlines():
+        line = ANSI_ESCAPE_RE.sub("", line).strip()
+        package, sep, rest = line.partition(": ")
+        if not sep:
+            continue
+        size_delta = 0
+        if m := CLOSURE_DIFF_SIZE_RE.search(rest):
+            size_delta = round(float(m.group(1)) * 1024)
+            rest = rest[: m.start()]
+        before, sep, after = rest.partition(" → ")
+        changes.append(
+            {
+                "package": package,
+                "versionsBefore": parse_versions(before) if sep else [],
+                "versionsAfter": parse_versions(after) if sep else [],
+                "sizeDelta": size_delta,
+            }
+        )
+    return changes
+
+
+def resolve_link(path: Path, target_host: Remote | None = None) -> Path:
+    "Resolve all symlinks in `path`, on `target_host` if given."
+    if target_host is None:
+        return path.resolve()
+    r = run_wrapper(["readlink", "-f", path], remote=target_host, stdout=PIPE)
+    return Path(r.stdout.strip())
 
 
 def repl(build_attr: BuildAttr, nix_flags: Args | None = None) -> None:
@@ -632,6 +1222,32 @@ def rollback_temporary_profile(
         return None
 
 
+def _missing_essential_files_error(path_to_config: Path) -> NixOSRebuildError:
+    msg = dedent(
+        # the lowercase for the first letter below is proposital
+        f"""
+            your NixOS configuration path seems to be missing essential files.
+            To avoid corrupting your current NixOS installation, the activation will abort.
+
+            This could be caused by Nix bug: https://github.com/NixOS/nix/issues/13367.
+            This is the evaluated NixOS configuration path: {path_to_config}.
+            Change the directory to somewhere else (e.g., `cd $HOME`) before trying again.
+
+            If you think this is a mistake, you can set the environment variable
+            NIXOS_REBUILD_I_UNDERSTAND_THE_CONSEQUENCES_PLEASE_BREAK_MY_SYSTEM to 1
+            and re-run the command to continue.
+            Please open an issue if this is the case.
+        """
+    ).strip()
+    return NixOSRebuildError(msg)
+
+
+def _check_essential_files() -> bool:
+    return not os.environ.get(
+        "NIXOS_REBUILD_I_UNDERSTAND_THE_CONSEQUENCES_PLEASE_BREAK_MY_SYSTEM"
+    )
+
+
 def set_profile(
     profile: Profile,
     path_to_config: Path,
@@ -639,32 +1255,14 @@ def set_profile(
     elevate: Elevator,
 ) -> None:
     "Set a path as the current active Nix profile."
-    if not os.environ.get(
-        "NIXOS_REBUILD_I_UNDERSTAND_THE_CONSEQUENCES_PLEASE_BREAK_MY_SYSTEM"
-    ):
+    if _check_essential_files():
         r = run_wrapper(
             ["test", "-f", path_to_config / "nixos-version"],
             remote=target_host,
             check=False,
         )
         if r.returncode:
-            msg = dedent(
-                # the lowercase for the first letter below is proposital
-                f"""
-                    your NixOS configuration path seems to be missing essential files.
-                    To avoid corrupting your current NixOS installation, the activation will abort.
-
-                    This could be caused by Nix bug: https://github.com/NixOS/nix/issues/13367.
-                    This is the evaluated NixOS configuration path: {path_to_config}.
-                    Change the directory to somewhere else (e.g., `cd $HOME`) before trying again.
-
-                    If you think this is a mistake, you can set the environment variable
-                    NIXOS_REBUILD_I_UNDERSTAND_THE_CONSEQUENCES_PLEASE_BREAK_MY_SYSTEM to 1
-                    and re-run the command to continue.
-                    Please open an issue if this is the case.
-                """
-            ).strip()
-            raise NixOSRebuildError(msg)
+            raise _missing_essential_files_error(path_to_config)
 
     run_wrapper(
         ["nix-env", "-p", profile.path, "--set", path_to_config],
@@ -673,6 +1271,25 @@ def set_profile(
     )
 
 
+def _specialisation_path(
+    path_to_config: Path,
+    action: Action,
+    specialisation: str | None,
+) -> Path:
+    if not specialisation:
+        return path_to_config
+
+    if action not in (Action.SWITCH, Action.TEST):
+        raise NixOSRebuildError(
+            "'--specialisation' can only be used with 'switch' and 'test'"
+        )
+    path_to_config = path_to_config / f"specialisation/{specialisation}"
+
+    if not path_to_config.exists():
+        raise NixOSRebuildError(f"specialisation not found: {specialisation}")
+    return path_to_config
+
+
 def switch_to_configuration(
     path_to_config: Path,
     action: Literal[Action.SWITCH, Action.BOOT, Action.TEST, Action.DRY_ACTIVATE],
@@ -686,15 +1303,7 @@ def switch_to_configuration(
     Expects a built path to run, like one generated with `nixos_build` or
     `nixos_build_flake` functions.
     """
-    if specialisation:
-        if action not in (Action.SWITCH, Action.TEST):
-            raise NixOSRebuildError(
-                "'--specialisation' can only be used with 'switch' and 'test'"
-            )
-        path_to_config = path_to_config / f"specialisation/{specialisation}"
-
-        if not path_to_config.exists():
-            raise NixOSRebuildError(f"specialisation not found: {specialisation}")
+    path_to_config = _specialisation_path(path_to_config, action, specialisation)
 
     r = run_wrapper(
         ["test", "-d", "/run/systemd/system"],
@@ -729,6 +1338,108 @@ def switch_to_configuration(
     )
 
 
+def activate(
+    path_to_config: Path,
+    action: Literal[Action.SWITCH, Action.BOOT, Action.TEST, Action.DRY_ACTIVATE],
+    profile: Profile | None,
+    target_host: Remote | None,
+    elevate: Elevator,
+    install_bootloader: bool = False,
+    specialisation: str | None = None,
+) -> None:
+    """Set the profile (if given) to a configuration and switch to it.
+
+    Locally this is `set_profile` followed by `switch_to_configuration`. On a
+    target host, all steps run as a small script in a single elevated
+    command, so activation costs only one round-trip.
+    """
+    if target_host is None:
+        if profile:
+            with timings.phase("set_profile"):
+                set_profile(profile, path_to_config, target_host=None, elevate=elevate)
+        with timings.phase("activation"):
+            switch_to_configuration(
+                path_to_config,
+                action,
+                target_host=None,
+                elevate=elevate,
+                install_bootloader=install_bootloader,
+                specialisation=specialisation,
+            )
+        return
+
+    config = _specialisation_path(path_to_config, action, specialisation)
+    cmd = (
+        []
+        if os.environ.get("NIXOS_REBUILD_NO_SYSTEMD_RUN")
+        else SWITCH_TO_CONFIGURATION_CMD_PREFIX
+    )
+    script = files(__package__).joinpath(ACTIVATE_SCRIPT).read_text()
+    # Setting the profile is part of the same command on target hosts
+    failed_step = None
+    with timings.phase("activation"):
+        process = popen_wrapper(
+            [
+                "/bin/sh",
+                "-c",
+                script,
+                "activate",
+                profile.path if profile else "",
+                path_to_config,
+                config,
+                str(action),
+                "1" if _check_essential_files() else "0",
+                *cmd,
+            ],
+            env={
+                "LOCALE_ARCHIVE": PRESERVE_ENV,
+                "NIXOS_NO_CHECK": PRESERVE_ENV,
+                "NIXOS_INSTALL_BOOTLOADER": "1" if install_bootloader else "0",
+            },
+            remote=target_host,
+            elevate=elevate,
+            stdout=PIPE,
+        )
+        assert process.stdout is not None
+        try:
+            # Report the steps as they finish, switching can take a while
+            for line in process.stdout:
+                # Skip anything that is not a progress line, e.g. from a noisy
+                # shell profile on the target host
+                if not line.startswith('{"step"'):
+                    continue
+                step = json.loads(line)
+                logger.info("activation step '%s': %s", step["step"], step["status"])
+                if step["status"] == "failed":
+                    failed_step = step["step"]
+            returncode = process.wait()
+        finally:
+            if process.poll() is None:
+                process.terminate()
+                process.wait()
+
+    if not returncode:
+        return
+
+    match failed_step:
+        case "check":
+            raise _missing_essential_files_error(path_to_config)
+        case "set-profile":
+            assert profile is not None
+            failed_cmd = [
+                "nix-env",
+                "-p",
+                str(profile.path),
+                "--set",
+                str(path_to_config),
+            ]
+        case _:
+            failed_cmd = [str(config / "bin/switch-to-configuration"), str(action)]
+    if hint := elevate.on_remote_failure():
+        logger.error(hint)
+    raise CalledProcessError(returncode, failed_cmd)
+
+
 def upgrade_channels(
     all_channels: bool = False,
     elevate: Elevator = NO_ELEVATOR,
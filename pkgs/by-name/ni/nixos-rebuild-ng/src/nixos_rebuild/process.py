@@ -4,12 +4,14 @@ import os
 import re
 import shlex
 import subprocess
-from collections.abc import Mapping
+import time
+from collections.abc import Mapping, Sequence
 from dataclasses import dataclass
 from ipaddress import AddressValueError, IPv6Address
+from pathlib import Path
 from typing import Final, Self, TextIO, TypedDict, Unpack
 
-from . import tmpdir
+from . import timings, tmpdir
 from .elevate import (
     NO_ELEVATOR,
     PRESERVE_ENV,
@@ -29,6 +31,10 @@ SSH_DEFAULT_OPTS: Final = [
     "-o",
     "ControlPersist=60",
 ]
+SSH_POOL_DEFAULT_TTL: Final = 600
+
+_ssh_opts: list[str] = SSH_DEFAULT_OPTS
+_ssh_prewarm: list[subprocess.Popen[str]] = []
 
 
 @dataclass(frozen=True)
@@ -94,8 +100,89 @@ class RunKwargs(TypedDict, total=False):
     stdout: int | TextIO | None
 
 
+def ssh_opts() -> list[str]:
+    "SSH options for connection sharing, see `enable_ssh_pool`."
+    return _ssh_opts
+
+
+def ssh_pool_dir() -> Path:
+    # Like the tmpdir, this needs to be short because of the ControlPath
+    # length limit, see `tmpdir.make_tmpdir`
+    runtime_dir = os.getenv("XDG_RUNTIME_DIR")
+    if runtime_dir and len(runtime_dir) < 30:
+        return Path(runtime_dir) / "nixos-rebuild"
+    return Path(f"/tmp/nixos-rebuild-{os.getuid()}")
+
+
+def enable_ssh_pool(ttl: int = SSH_POOL_DEFAULT_TTL) -> None:
+    """Share SSH connections across invocations of nixos-rebuild.
+
+    The ControlMaster sockets are kept in a per-user runtime directory
+    instead of the tmpdir of this run, so `cleanup_ssh` leaves them alone and
+    each master stays around until it was idle for `ttl` seconds.
+    """
+    global _ssh_opts
+    pool_dir = ssh_pool_dir()
+    try:
+        pool_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+        if pool_dir.stat().st_uid != os.getuid():
+            raise PermissionError(f"'{pool_dir}' is owned by another user")
+        pool_dir.chmod(0o700)
+    except OSError as ex:
+        logger.warning("not sharing SSH connections across runs: %s", ex)
+        return
+
+    _ssh_opts = [
+        "-o",
+        "ControlMaster=auto",
+        "-o",
+        f"ControlPath={pool_dir / 'ssh-%C'}",
+        "-o",
+        f"ControlPersist={ttl}",
+    ]
+
+
+def prewarm_ssh(remotes: Sequence[Remote]) -> None:
+    """Open the SSH connections to `remotes` in the background, so the
+    handshakes happen while e.g. the system is evaluated locally.
+
+    This never prompts. If a connection needs a password it is simply opened
+    later, by the first command that uses it.
+    """
+    for remote in remotes:
+        if remote.store_type not in ("ssh", "ssh-ng"):
+            continue
+        args = [
+            "ssh",
+            *remote.opts,
+            *_ssh_opts,
+            "-o",
+            "BatchMode=yes",
+            remote.ssh_host(),
+            "--",
+            "true",
+        ]
+        logger.debug("pre-warming SSH connection with args=%r", args)
+        _ssh_prewarm.append(
+            subprocess.Popen(
+                args,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                text=True,
+            )
+        )
+
+
 def cleanup_ssh() -> None:
     "Close SSH ControlMaster connection."
+    # reap the pre-warming clients, the ones still connecting aren't useful
+    # anymore at this point
+    for proc in _ssh_prewarm:
+        if proc.poll() is None:
+            proc.terminate()
+        proc.wait()
+    _ssh_prewarm.clear()
     for ctrl in tmpdir.TMPDIR_PATH.glob("ssh-*"):
         run_wrapper(
             ["ssh", "-o", f"ControlPath={ctrl}", "-O", "exit", "dummyhost"],
@@ -107,60 +194,80 @@ def cleanup_ssh() -> None:
 atexit.register(cleanup_ssh)
 
 
-def run_wrapper(
+def _wrap_command(
     args: Args,
-    *,
-    check: bool = True,
-    env: Mapping[str, EnvValue] | None = None,
-    append_local_env: Mapping[str, str] | None = None,
-    remote: Remote | None = None,
-    elevate: Elevator = NO_ELEVATOR,
-    **kwargs: Unpack[RunKwargs],
-) -> subprocess.CompletedProcess[str]:
-    "Wrapper around `subprocess.run` that supports extra functionality."
-    process_input = None
+    env: Mapping[str, EnvValue] | None,
+    remote: Remote | None,
+    elevate: Elevator,
+) -> tuple[list[Arg], dict[str, str] | None, str | None, list[Arg]]:
+    """Build the command line to run `args` with, possibly elevated or on a
+    remote host.
+
+    Returns it together with the environment and the stdin for the process,
+    and the arguments to log."""
     run_args: list[Arg] = list(args)
-    final_args: list[Arg]
 
     normalized_env = _normalize_env(env)
     resolved_env = _resolve_env_local(normalized_env)
 
     if remote:
         rwrapped = elevate.wrap_remote(normalized_env, run_args)
-        process_input = rwrapped.stdin
-        remote_run_args: list[Arg] = rwrapped.argv
-
         ssh_args: list[Arg] = [
             "ssh",
             *remote.opts,
-            *SSH_DEFAULT_OPTS,
+            *ssh_opts(),
             remote.ssh_host(),
             "--",
-            *[_quote_remote_arg(a) for a in remote_run_args],
+            *[_quote_remote_arg(a) for a in rwrapped.argv],
         ]
-        final_args = ssh_args
-        popen_env = None  # keep ssh's environment normal
-
-    else:
-        wrapped = elevate.wrap_local()
-        process_input = wrapped.stdin
-        if elevate.elevates:
-            # subprocess.run(env=...) would affect the elevator process,
-            # which may then drop env for the target command. Inject env
-            # via `env -i ... cmd` instead so it survives.
-            if env is not None and resolved_env:
-                run_args = _prefix_env_cmd(run_args, resolved_env)
-            final_args = [*wrapped.prefix, *run_args]
-            popen_env = None
-        else:
-            # Unprivileged local: we can fully control the environment
-            # with subprocess.run(env=...)
-            final_args = run_args
-            popen_env = None if env is None else resolved_env
+        # keep ssh's environment normal
+        return ssh_args, None, rwrapped.stdin, rwrapped.argv
+
+    wrapped = elevate.wrap_local()
+    if elevate.elevates:
+        # subprocess.run(env=...) would affect the elevator process,
+        # which may then drop env for the target command. Inject env
+        # via `env -i ... cmd` instead so it survives.
+        if env is not None and resolved_env:
+            run_args = _prefix_env_cmd(run_args, resolved_env)
+        return [*wrapped.prefix, *run_args], None, wrapped.stdin, run_args
+
+    # Unprivileged local: we can fully control the environment
+    # with subprocess.run(env=...)
+    popen_env = None if env is None else resolved_env
+    return run_args, popen_env, wrapped.stdin, run_args
+
+
+def run_wrapper(
+    args: Args,
+    *,
+    check: bool = True,
+    env: Mapping[str, EnvValue] | None = None,
+    append_local_env: Mapping[str, str] | None = None,
+    remote: Remote | None = None,
+    elevate: Elevator = NO_ELEVATOR,
+    stdin_text: str | None = None,
+    **kwargs: Unpack[RunKwargs],
+) -> subprocess.CompletedProcess[str]:
+    """Wrapper around `subprocess.run` that supports extra functionality.
+
+    `stdin_text` is passed to the command on stdin, also for remote commands. This
+    is the way to pass long argument lists to a remote command, since ssh
+    sends the whole command line as a single argument with limited length."""
+    final_args, popen_env, process_input, logged_args = _wrap_command(
+        args, env, remote, elevate
+    )
+
+    if stdin_text is not None:
+        if process_input is not None:
+            raise ValueError(
+                "stdin_text can't be used with an elevator that needs stdin"
+            )
+        process_input = stdin_text
 
     logger.debug(
         "calling run with args=%r, kwargs=%r, env=%r, append_local_env=%r",
-        _sanitize_env_run_args(remote_run_args if remote else run_args),
+        _sanitize_env_run_args(logged_args),
         kwargs,
         env,
         append_local_env,
@@ -170,6 +277,7 @@ def run_wrapper(
         popen_env = dict(os.environ) if popen_env is None else dict(popen_env)
         popen_env.update(append_local_env)
 
+    start, counter = time.time(), time.perf_counter()
     try:
         r = subprocess.run(
             final_args,
@@ -180,6 +288,15 @@ def run_wrapper(
             errors="surrogateescape",
             **kwargs,
         )
+        timings.record_command(
+            args,
+            remote.host if remote else None,
+            start,
+            counter,
+            r.returncode,
+            r.stdout,
+            r.stderr,
+        )
 
         if kwargs.get("capture_output") or kwargs.get("stderr") or kwargs.get("stdout"):
             logger.debug(
@@ -193,12 +310,54 @@ def run_wrapper(
         if remote and not elevate.elevates:
             _kill_long_running_ssh_process(args, remote)
         raise
-    except subprocess.CalledProcessError:
+    except subprocess.CalledProcessError as ex:
+        timings.record_command(
+            args,
+            remote.host if remote else None,
+            start,
+            counter,
+            ex.returncode,
+            ex.stdout,
+            ex.stderr,
+        )
         if remote and (hint := elevate.on_remote_failure()):
             logger.error(hint)
         raise
 
 
+def popen_wrapper(
+    args: Args,
+    *,
+    env: Mapping[str, EnvValue] | None = None,
+    remote: Remote | None = None,
+    elevate: Elevator = NO_ELEVATOR,
+    stdout: int | None = None,
+    stderr: int | None = None,
+) -> subprocess.Popen[str]:
+    """Wrapper around `subprocess.Popen` for commands whose output needs to
+    be processed while they are still running, see `run_wrapper`."""
+    final_args, popen_env, process_input, logged_args = _wrap_command(
+        args, env, remote, elevate
+    )
+    logger.debug(
+        "calling popen with args=%r, env=%r", _sanitize_env_run_args(logged_args), env
+    )
+    process = subprocess.Popen(
+        final_args,
+        env=popen_env,
+        stdin=None if process_input is None else subprocess.PIPE,
+        stdout=stdout,
+        stderr=stderr,
+        text=True,
+        errors="surrogateescape",
+    )
+    if process_input is not None:
+        assert process.stdin is not None
+        process.stdin.write(process_input)
+        process.stdin.close()
+    return process
+
+
 def _resolve_env(env: Mapping[str, EnvValue] | None) -> dict[str, str]:
     normalized = _normalize_env(env)
     return _resolve_env_local(normalized)
@@ -282,7 +441,7 @@ def _kill_long_running_ssh_process(args: Args, remote: Remote) -> None:
             [
                 "ssh",
                 *remote.opts,
-                *SSH_DEFAULT_OPTS,
+                *ssh_opts(),
                 remote.ssh_host(),
                 "--",
                 "pkill",
@@ -1,31 +1,67 @@
 import argparse
+import hashlib
 import json
 import logging
 import os
 import sys
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Final
+from subprocess import CalledProcessError
+from typing import Final, Literal
 
-from . import nix, tmpdir
+from . import nix, timings, tmpdir
 from .constants import EXECUTABLE
 from .models import (
     Action,
     BuildAttr,
     Flake,
+    FleetHost,
     GroupedNixArgs,
     ImageVariants,
     NixOSRebuildError,
     Profile,
 )
 from .process import Remote, cleanup_ssh
-from .utils import tabulate
+from .utils import read_cache, tabulate, write_cache
 
 NIXOS_REBUILD_ATTR: Final = "config.system.build.nixos-rebuild"
 NIXOS_REBUILD_REEXEC_ENV: Final = "_NIXOS_REBUILD_REEXEC"
+REEXEC_CACHE_FILE: Final = "reexec.json"
+REEXEC_CACHE_MAX_ENTRIES: Final = 32
 
 logger: Final = logging.getLogger(__name__)
 
 
+def _reexec_cache_key(
+    flake: Flake,
+    grouped_nix_args: GroupedNixArgs,
+) -> str | None:
+    """Identify the inputs that nixos-rebuild is built from: the locked flake
+    (its narHash) and all its locked inputs.
+
+    Only flakes are cached. Without one, the configuration and everything it
+    imports (including overlays) could change the result, and nothing short
+    of evaluating it identifies that. Returns None if the flake is not
+    locked.
+    """
+    metadata = nix.get_flake_metadata(flake, grouped_nix_args.flake_eval_flags)
+    if not metadata or "narHash" not in metadata.get("locked", {}):
+        return None
+    inputs = [str(flake), metadata["locked"], metadata.get("locks")]
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+def _write_reexec_cache(key: str, drv: Path) -> None:
+    # Keep only the most recent entries, dicts preserve insertion order
+    cache = read_cache(REEXEC_CACHE_FILE)
+    cache.pop(key, None)
+    cache[key] = str(drv)
+    write_cache(
+        REEXEC_CACHE_FILE, dict(list(cache.items())[-REEXEC_CACHE_MAX_ENTRIES:])
+    )
+
+
 def reexec(
     argv: list[str],
     args: argparse.Namespace,
@@ -34,22 +70,38 @@ def reexec(
     if os.environ.get(NIXOS_REBUILD_REEXEC_ENV):
         return
 
-    drv = None
-    if flake := Flake.from_arg(args.flake, Remote.from_arg(args.target_host)):
-        drv = nix.build_flake(
-            NIXOS_REBUILD_ATTR,
-            flake,
-            grouped_nix_args.flake_build_flags
-            | grouped_nix_args.flake_eval_flags
-            | {"no_link": True},
-        )
-    else:
-        build_attr = BuildAttr.from_arg(args.attr, args.file)
-        drv = nix.build(
-            NIXOS_REBUILD_ATTR,
-            build_attr,
-            grouped_nix_args.build_flags | {"no_out_link": True},
-        )
+    flake = Flake.from_arg(args.flake, Remote.from_arg(args.target_host))
+    build_attr = None if flake else BuildAttr.from_arg(args.attr, args.file)
+
+    with timings.phase("reexec"):
+        # Building nixos-rebuild needs a full evaluation, so remember which
+        # version we got for the same inputs
+        cache_key = _reexec_cache_key(flake, grouped_nix_args) if flake else None
+        drv = None
+        cached = read_cache(REEXEC_CACHE_FILE).get(cache_key) if cache_key else None
+        # The cached version may have been garbage collected since
+        if cached and (Path(cached) / f"bin/{EXECUTABLE}").exists():
+            logger.debug("using cached nixos-rebuild for re-exec: %s", cached)
+            drv = Path(cached)
+
+        if drv is None:
+            if flake:
+                drv = nix.build_flake(
+                    NIXOS_REBUILD_ATTR,
+                    flake,
+                    grouped_nix_args.flake_build_flags
+                    | grouped_nix_args.flake_eval_flags
+                    | {"no_link": True},
+                )
+            else:
+                assert build_attr is not None
+                drv = nix.build(
+                    NIXOS_REBUILD_ATTR,
+                    build_attr,
+                    grouped_nix_args.build_flags | {"no_out_link": True},
+                )
+            if cache_key and drv:
+                _write_reexec_cache(cache_key, drv)
 
     if drv:
         new = drv / f"bin/{EXECUTABLE}"
@@ -65,7 +117,11 @@ def reexec(
             cleanup_ssh()
             tmpdir.TMPDIR.cleanup()
             try:
-                os.execve(new, argv, os.environ | {NIXOS_REBUILD_REEXEC_ENV: "1"})
+                os.execve(
+                    new,
+                    argv,
+                    os.environ | timings.to_env() | {NIXOS_REBUILD_REEXEC_ENV: "1"},
+                )
             except Exception:
                 # Possible errors that we can have here:
                 # - Missing the binary
@@ -77,7 +133,11 @@ def reexec(
                 )
                 # We already run clean-up, let's re-exec in the current version
                 # to avoid issues
-                os.execve(current, argv, os.environ | {NIXOS_REBUILD_REEXEC_ENV: "1"})
+                os.execve(
+                    current,
+                    argv,
+                    os.environ | timings.to_env() | {NIXOS_REBUILD_REEXEC_ENV: "1"},
+                )
 
 
 def _validate_image_variant(image_variant: str, variants: ImageVariants) -> None:
@@ -88,6 +148,18 @@ def _validate_image_variant(image_variant: str, variants: ImageVariants) -> None
         )
 
 
+def _select_image_variants(
+    image_variants: list[str] | None,
+    variants: ImageVariants,
+) -> list[str]:
+    if image_variants and "all" in image_variants:
+        return list(variants)
+    for image_variant in image_variants or [""]:
+        _validate_image_variant(image_variant, variants)
+    assert image_variants
+    return image_variants
+
+
 def _get_system_attr(
     action: Action,
     args: argparse.Namespace,
@@ -96,20 +168,30 @@ def _get_system_attr(
     grouped_nix_args: GroupedNixArgs,
 ) -> str:
     match action:
+        # Several named variants are validated by _build_images, while
+        # evaluating their derivations
+        case Action.BUILD_IMAGE if (
+            len(args.image_variant or []) > 1 and "all" not in args.image_variant
+        ):
+            attr = f"config.system.build.images.{args.image_variant[0]}"
+        # The system itself is evaluated as part of the build, only the
+        # image variants are evaluated up front
         case Action.BUILD_IMAGE if flake:
-            variants = nix.get_build_image_variants_flake(
-                flake,
-                eval_flags=grouped_nix_args.flake_eval_flags,
-            )
-            _validate_image_variant(args.image_variant, variants)
-            attr = f"config.system.build.images.{args.image_variant}"
+            with timings.phase("eval"):
+                variants = nix.get_build_image_variants_flake(
+                    flake,
+                    eval_flags=grouped_nix_args.flake_eval_flags,
+                )
+            args.image_variant = _select_image_variants(args.image_variant, variants)
+            attr = f"config.system.build.images.{args.image_variant[0]}"
         case Action.BUILD_IMAGE:
-            variants = nix.get_build_image_variants(
-                build_attr,
-                instantiate_flags=grouped_nix_args.common_flags,
-            )
-            _validate_image_variant(args.image_variant, variants)
-            attr = f"config.system.build.images.{args.image_variant}"
+            with timings.phase("eval"):
+                variants = nix.get_build_image_variants(
+                    build_attr,
+                    instantiate_flags=grouped_nix_args.common_flags,
+                )
+            args.image_variant = _select_image_variants(args.image_variant, variants)
+            attr = f"config.system.build.images.{args.image_variant[0]}"
         case Action.BUILD_VM:
             attr = "config.system.build.vm"
         case Action.BUILD_VM_WITH_BOOTLOADER:
@@ -151,57 +233,69 @@ def _build_system(
     flake: Flake | None,
     build_attr: BuildAttr,
     grouped_nix_args: GroupedNixArgs,
+    copy_while_building: bool = False,
+    adaptive_copy: bool = False,
 ) -> Path:
     dry_run = action == Action.DRY_BUILD
     # actions that we will not add a /result symlink in CWD
     no_link = action in (Action.SWITCH, Action.BOOT, Action.TEST, Action.DRY_ACTIVATE)
-
-    match (build_host, flake):
-        case (Remote(_), Flake(_)):
-            path_to_config = nix.build_remote_flake(
-                attr,
-                flake,
-                build_host,
-                eval_flags=grouped_nix_args.flake_build_flags
-                | grouped_nix_args.flake_eval_flags,
-                flake_build_flags={"no_link": no_link, "dry_run": dry_run}
-                | grouped_nix_args.flake_build_flags,
-                copy_flags=grouped_nix_args.copy_flags,
-            )
-        case (None, Flake(_)):
-            path_to_config = nix.build_flake(
-                attr,
-                flake,
-                flake_build_flags={"no_link": no_link, "dry_run": dry_run}
-                | grouped_nix_args.flake_build_flags
-                | grouped_nix_args.flake_eval_flags,
-            )
-        case (Remote(_), None):
-            path_to_config = nix.build_remote(
-                attr,
-                build_attr,
-                build_host,
-                realise_flags=grouped_nix_args.common_flags,
-                instantiate_flags=grouped_nix_args.build_flags,
-                copy_flags=grouped_nix_args.copy_flags,
-            )
-        case (None, None):
-            path_to_config = nix.build(
-                attr,
-                build_attr,
-                build_flags={"no_out_link": no_link, "dry_run": dry_run}
-                | grouped_nix_args.build_flags,
-            )
+    # start copying to the target host while building locally, the final
+    # copy_closure below then only has to copy what is left
+    copy_to = target_host if copy_while_building and not dry_run else None
+
+    with timings.phase("build"):
+        match (build_host, flake):
+            case (Remote(_), Flake(_)):
+                path_to_config = nix.build_remote_flake(
+                    attr,
+                    flake,
+                    build_host,
+                    eval_flags=grouped_nix_args.flake_build_flags
+                    | grouped_nix_args.flake_eval_flags,
+                    flake_build_flags={"no_link": no_link, "dry_run": dry_run}
+                    | grouped_nix_args.flake_build_flags,
+                    copy_flags=grouped_nix_args.copy_flags,
+                )
+            case (None, Flake(_)):
+                path_to_config = nix.build_flake(
+                    attr,
+                    flake,
+                    flake_build_flags={"no_link": no_link, "dry_run": dry_run}
+                    | grouped_nix_args.flake_build_flags
+                    | grouped_nix_args.flake_eval_flags,
+                    copy_to=copy_to,
+                    copy_flags=grouped_nix_args.copy_flags,
+                )
+            case (Remote(_), None):
+                path_to_config = nix.build_remote(
+                    attr,
+                    build_attr,
+                    build_host,
+                    realise_flags=grouped_nix_args.common_flags,
+                    instantiate_flags=grouped_nix_args.build_flags,
+                    copy_flags=grouped_nix_args.copy_flags,
+                )
+            case (None, None):
+                path_to_config = nix.build(
+                    attr,
+                    build_attr,
+                    build_flags={"no_out_link": no_link, "dry_run": dry_run}
+                    | grouped_nix_args.build_flags,
+                    copy_to=copy_to,
+                    copy_flags=grouped_nix_args.copy_flags,
+                )
 
     # In dry_run mode there is nothing to copy
     # https://github.com/NixOS/nixpkgs/issues/444156
     if not dry_run:
-        nix.copy_closure(
-            path_to_config,
-            to_host=target_host,
-            from_host=build_host,
-            copy_flags=grouped_nix_args.copy_flags,
-        )
+        with timings.phase("copy"):
+            nix.copy_closure(
+                path_to_config,
+                to_host=target_host,
+                from_host=build_host,
+                copy_flags=grouped_nix_args.copy_flags,
+                adaptive=adaptive_copy,
+            )
 
     return path_to_config
 
@@ -223,15 +317,10 @@ def _activate_system(
 
     match action:
         case Action.SWITCH | Action.BOOT if not args.rollback:
-            nix.set_profile(
-                profile,
-                path_to_config,
-                target_host=target_host,
-                elevate=args.elevator,
-            )
-            nix.switch_to_configuration(
+            nix.activate(
                 path_to_config,
                 action,
+                profile=profile,
                 target_host=target_host,
                 elevate=args.elevator,
                 specialisation=args.specialisation,
@@ -239,9 +328,10 @@ def _activate_system(
             )
             print_result("Done. The new configuration is", path_to_config)
         case Action.SWITCH | Action.BOOT | Action.TEST | Action.DRY_ACTIVATE:
-            nix.switch_to_configuration(
+            nix.activate(
                 path_to_config,
                 action,
+                profile=None,
                 target_host=target_host,
                 elevate=args.elevator,
                 specialisation=args.specialisation,
@@ -258,19 +348,118 @@ def _activate_system(
             if flake:
                 image_name = nix.get_build_image_name_flake(
                     flake,
-                    args.image_variant,
+                    args.image_variant[0],
                     eval_flags=grouped_nix_args.flake_eval_flags,
                 )
             else:
                 image_name = nix.get_build_image_name(
                     build_attr,
-                    args.image_variant,
+                    args.image_variant[0],
                     instantiate_flags=grouped_nix_args.common_flags,
                 )
             disk_path = path_to_config / image_name
             print_result("Done. The disk image can be found in", disk_path)
 
 
+def _build_images(
+    args: argparse.Namespace,
+    build_host: Remote | None,
+    target_host: Remote | None,
+    flake: Flake | None,
+    build_attr: BuildAttr,
+    grouped_nix_args: GroupedNixArgs,
+) -> None:
+    """Build several image variants at once.
+
+    The derivations of all variants come from a single evaluation, which
+    also validates the variant names, and are built by a single `nix-store
+    --realise`, so Nix can build them in parallel.
+    """
+    with timings.phase("eval"):
+        if flake:
+            variants, derivations = nix.get_build_image_derivations_flake(
+                flake,
+                args.image_variant,
+                eval_flags=grouped_nix_args.flake_eval_flags,
+            )
+        else:
+            variants, derivations = nix.get_build_image_derivations(
+                build_attr,
+                args.image_variant,
+                instantiate_flags=grouped_nix_args.common_flags,
+            )
+    for image_variant in args.image_variant:
+        _validate_image_variant(image_variant, variants)
+
+    with timings.phase("build"):
+        nix.realise(
+            [d.drv_path for d in derivations.values()],
+            build_host,
+            out_link=Path("result"),
+            realise_flags=grouped_nix_args.common_flags,
+            copy_flags=grouped_nix_args.copy_flags,
+        )
+
+    with timings.phase("copy"):
+        nix.copy_closure(
+            [d.out_path for d in derivations.values()],
+            to_host=target_host,
+            copy_flags=grouped_nix_args.copy_flags,
+            adaptive=args.adaptive_copy,
+        )
+
+    print("Done. The disk images can be found in:", file=sys.stderr, flush=True)
+    print(
+        tabulate(
+            [
+                {"variant": variant, "image": d.out_path / d.file_path}
+                for variant, d in derivations.items()
+            ],
+            headers={"variant": "Variant", "image": "Image"},
+        ),
+        flush=True,
+    )
+
+
+def _diff_closures(
+    current_config: Path,
+    new_config: Path,
+    target_host: Remote | None,
+) -> tuple[Path, Path, str]:
+    with timings.phase("diff"):
+        diff = nix.diff_closures(current_config, new_config, target_host)
+    return current_config, new_config, diff
+
+
+def _print_diff(
+    diff: Future[tuple[Path, Path, str]],
+    diff_format: Literal["text", "json"],
+) -> None:
+    # runs after the activation, so it must not mask an activation error
+    try:
+        current_config, new_config, output = diff.result()
+    except Exception as ex:  # noqa: BLE001
+        logger.warning("could not diff the configurations: %s", ex)
+        return
+
+    match diff_format:
+        case "text":
+            print(f"<<< {current_config}\n>>> {new_config}", file=sys.stderr)
+            print(output, end="", file=sys.stderr, flush=True)
+        case "json":
+            # a single line, so it is easy to tell apart from other output
+            print(
+                json.dumps(
+                    {
+                        "before": str(current_config),
+                        "after": str(new_config),
+                        "changes": nix.parse_closures_diff(output),
+                    }
+                ),
+                flush=True,
+            )
+
+
 def build_and_activate_system(
     action: Action,
     args: argparse.Namespace,
@@ -290,13 +479,26 @@ def build_and_activate_system(
         grouped_nix_args=grouped_nix_args,
     )
 
+    if action == Action.BUILD_IMAGE and len(args.image_variant) > 1:
+        _build_images(
+            args=args,
+            build_host=build_host,
+            target_host=target_host,
+            flake=flake,
+            build_attr=build_attr,
+            grouped_nix_args=grouped_nix_args,
+        )
+        return
+
     if args.store_path:
         path_to_config = Path(args.store_path)
-        nix.copy_closure(
-            path_to_config,
-            to_host=target_host,
-            copy_flags=grouped_nix_args.copy_flags,
-        )
+        with timings.phase("copy"):
+            nix.copy_closure(
+                path_to_config,
+                to_host=target_host,
+                copy_flags=grouped_nix_args.copy_flags,
+                adaptive=args.adaptive_copy,
+            )
     elif args.rollback:
         if target_host is not None:
             # The elevated `nix-env --rollback` runs before path_to_config
@@ -318,6 +520,8 @@ def build_and_activate_system(
             flake=flake,
             build_attr=build_attr,
             grouped_nix_args=grouped_nix_args,
+            copy_while_building=args.copy_while_building,
+            adaptive_copy=args.adaptive_copy,
         )
 
     if target_host is not None and not args.rollback:
@@ -326,29 +530,186 @@ def build_and_activate_system(
         args.elevator = args.elevator.for_target_config(path_to_config)
 
     current_config = Path("/run/current-system")
-    if args.diff:
-        if current_config.exists():
-            nix.diff_closures(
-                current_config=current_config,
-                new_config=path_to_config,
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        diff = None
+        if args.diff:
+            if current_config.exists():
+                # The diff only reads the store, so it runs while the new
+                # configuration is activated. Activation changes where
+                # /run/current-system points to, so resolve it first.
+                diff = executor.submit(
+                    _diff_closures,
+                    nix.resolve_link(current_config, target_host),
+                    path_to_config,
+                    target_host,
+                )
+            else:
+                logger.warning(
+                    f"missing '{current_config!s}', skipping configuration diff..."
+                )
+
+        try:
+            _activate_system(
+                path_to_config=path_to_config,
+                action=action,
+                args=args,
                 target_host=target_host,
+                profile=profile,
+                flake=flake,
+                build_attr=build_attr,
+                grouped_nix_args=grouped_nix_args,
             )
-        else:
-            logger.warning(
-                f"missing '{current_config!s}', skipping configuration diff..."
+        finally:
+            if diff:
+                _print_diff(diff, args.diff)
+
+
+def _fleet_batches(
+    hosts: list[FleetHost],
+    canary: int,
+    batch_size: int,
+) -> list[list[FleetHost]]:
+    batches = []
+    if canary:
+        batches.append(hosts[:canary])
+        hosts = hosts[canary:]
+    size = batch_size or len(hosts) or 1
+    batches.extend(hosts[i : i + size] for i in range(0, len(hosts), size))
+    return batches
+
+
+def _short_error(ex: Exception) -> str:
+    lines = str(ex).strip().splitlines()
+    return lines[0] if lines else type(ex).__name__
+
+
+def deploy_fleet(
+    action: Literal[Action.SWITCH, Action.BOOT, Action.TEST, Action.DRY_ACTIVATE],
+    args: argparse.Namespace,
+    hosts: list[FleetHost],
+    build_host: Remote | None,
+    profile: Profile,
+    build_attr: BuildAttr,
+    grouped_nix_args: GroupedNixArgs,
+) -> None:
+    """Deploy the configurations from a fleet inventory to all its hosts.
+
+    Every distinct configuration is built once. Hosts are then deployed in
+    batches (optionally starting with a canary batch) by a bounded pool of
+    workers, and the rollout stops once the share of failed hosts exceeds
+    `--max-failure-rate`.
+    """
+    configurations = list(dict.fromkeys(host.configuration for host in hosts))
+    logger.info(
+        "building %d configuration(s) for %d host(s)...",
+        len(configurations),
+        len(hosts),
+    )
+    built: dict[Flake | Path, Path] = {}
+    build_errors: dict[Flake | Path, str] = {}
+    for configuration in configurations:
+        if isinstance(configuration, Path):
+            built[configuration] = configuration
+            continue
+        try:
+            built[configuration] = _build_system(
+                attr="config.system.build.toplevel",
+                action=action,
+                build_host=build_host,
+                target_host=None,
+                flake=configuration,
+                build_attr=build_attr,
+                grouped_nix_args=grouped_nix_args,
             )
+        except (CalledProcessError, NixOSRebuildError) as ex:
+            logger.error("failed to build '%s': %s", configuration, ex)
+            build_errors[configuration] = _short_error(ex)
+
+    def deploy(host: FleetHost) -> dict[str, str]:
+        target_host = host.target_host
+        result = {
+            "host": target_host.host,
+            "configuration": str(host.configuration),
+            "status": "ok",
+            "time": "",
+            "error": "",
+        }
+        if host.configuration in build_errors:
+            result["status"] = "build failed"
+            result["error"] = build_errors[host.configuration]
+            return result
 
-    _activate_system(
-        path_to_config=path_to_config,
-        action=action,
-        args=args,
-        target_host=target_host,
-        profile=profile,
-        flake=flake,
-        build_attr=build_attr,
-        grouped_nix_args=grouped_nix_args,
+        path_to_config = built[host.configuration]
+        start = time.monotonic()
+        try:
+            nix.copy_closure(
+                path_to_config,
+                to_host=target_host,
+                copy_flags=grouped_nix_args.copy_flags,
+                adaptive=args.adaptive_copy,
+            )
+            nix.activate(
+                path_to_config,
+                action,
+                profile=profile if action in (Action.SWITCH, Action.BOOT) else None,
+                target_host=target_host,
+                elevate=args.elevator.for_target_config(path_to_config),
+                specialisation=args.specialisation,
+                install_bootloader=args.install_bootloader,
+            )
+        except (CalledProcessError, NixOSRebuildError, OSError) as ex:
+            logger.error("failed to deploy to '%s': %s", target_host.host, ex)
+            result["status"] = "failed"
+            result["error"] = _short_error(ex)
+        result["time"] = f"{time.monotonic() - start:.1f}s"
+        return result
+
+    results: list[dict[str, str]] = []
+    batches = _fleet_batches(hosts, args.canary, args.batch_size)
+    with ThreadPoolExecutor(max_workers=args.fleet_jobs) as executor:
+        for i, batch in enumerate(batches):
+            logger.info(
+                "deploying to %s...",
+                ", ".join(host.target_host.host for host in batch),
+            )
+            results.extend(executor.map(deploy, batch))
+
+            failed = sum(1 for r in results if r["status"] != "ok")
+            # Any failure in the canary batch stops the rollout
+            max_failure_rate = 0.0 if args.canary and i == 0 else args.max_failure_rate
+            if failed / len(results) > max_failure_rate and i < len(batches) - 1:
+                logger.error(
+                    "%d of %d host(s) failed, aborting the rollout",
+                    failed,
+                    len(results),
+                )
+                break
+
+    deployed = {r["host"] for r in results}
+    results.extend(
+        {
+            "host": host.target_host.host,
+            "configuration": str(host.configuration),
+            "status": "skipped",
+            "time": "",
+            "error": "",
+        }
+        for host in hosts
+        if host.target_host.host not in deployed
     )
 
+    headers = {
+        "host": "Host",
+        "configuration": "Configuration",
+        "status": "Status",
+        "time": "Time",
+        "error": "Error",
+    }
+    print(tabulate(results, headers=headers), flush=True)
+
+    if failed := sum(1 for r in results if r["status"] not in ("ok", "skipped")):
+        raise NixOSRebuildError(f"deployment failed on {failed} of {len(hosts)} hosts")
+
 
 def edit(flake: Flake | None, grouped_nix_args: GroupedNixArgs) -> None:
     if flake:
@@ -363,8 +724,9 @@ def edit(flake: Flake | None, grouped_nix_args: GroupedNixArgs) -> None:
 def list_generations(
     args: argparse.Namespace,
     profile: Profile,
+    target_host: Remote | None = None,
 ) -> None:
-    generations = nix.list_generations(profile)
+    generations = nix.list_generations(profile, target_host)
     if args.json:
         print(json.dumps(generations, indent=2))
     else:
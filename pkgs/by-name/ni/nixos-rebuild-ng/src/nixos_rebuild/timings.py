@@ -0,0 +1,173 @@
+import json
+import logging
+import os
+import shlex
+import threading
+import time
+from collections.abc import Iterator, Sequence
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, Final, Literal
+
+from .utils import tabulate
+
+# Events recorded before a re-exec, passed on to the new process
+TIMINGS_ENV: Final = "_NIXOS_REBUILD_TIMINGS"
+SLOWEST_COMMANDS: Final = 5
+
+logger: Final = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class TimingEvent:
+    name: str
+    category: Literal["phase", "command"]
+    # wall clock, so events of a re-exec'ed process line up
+    start: float
+    duration: float
+    pid: int = field(default_factory=os.getpid)
+    thread: int = field(default_factory=threading.get_native_id)
+    args: dict[str, Any] = field(default_factory=dict)
+
+
+_enabled = False
+_events: list[TimingEvent] = []
+_lock: Final = threading.Lock()
+
+
+def enable() -> None:
+    "Start recording, including the events of the process that re-exec'ed us."
+    global _enabled
+    _enabled = True
+    if inherited := os.environ.pop(TIMINGS_ENV, None):
+        with _lock:
+            _events.extend(TimingEvent(**e) for e in json.loads(inherited))
+
+
+def to_env() -> dict[str, str]:
+    "Environment to pass the recorded events on through a re-exec."
+    if not _enabled:
+        return {}
+    with _lock:
+        return {TIMINGS_ENV: json.dumps([asdict(e) for e in _events])}
+
+
+def _record(event: TimingEvent) -> None:
+    with _lock:
+        _events.append(event)
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    "Record the time spent in a phase of nixos-rebuild, e.g. 'build'."
+    if not _enabled:
+        yield
+        return
+
+    start = time.time()
+    counter = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(TimingEvent(name, "phase", start, time.perf_counter() - counter))
+
+
+def _size(output: str | bytes | None) -> int | None:
+    if isinstance(output, str):
+        return len(output.encode(errors="surrogateescape"))
+    return None if output is None else len(output)
+
+
+def record_command(
+    args: Sequence[Any],
+    host: str | None,
+    start: float,
+    counter: float,
+    returncode: int,
+    stdout: str | bytes | None,
+    stderr: str | bytes | None,
+) -> None:
+    """Record a finished subprocess, started at `start` (`time.time()`) and
+    `counter` (`time.perf_counter()`). Output sizes are only known if it was
+    captured."""
+    if not _enabled:
+        return
+    _record(
+        TimingEvent(
+            shlex.join(str(a) for a in args),
+            "command",
+            start,
+            time.perf_counter() - counter,
+            args={
+                "host": host or "localhost",
+                "returncode": returncode,
+                "stdout_bytes": _size(stdout),
+                "stderr_bytes": _size(stderr),
+            },
+        )
+    )
+
+
+def summary() -> str:
+    "Format the time spent per phase and the slowest commands as tables."
+    with _lock:
+        events = list(_events)
+
+    phases: dict[str, float] = {}
+    for e in events:
+        if e.category == "phase":
+            phases[e.name] = phases.get(e.name, 0) + e.duration
+    commands = sorted(
+        (e for e in events if e.category == "command"),
+        key=lambda e: e.duration,
+        reverse=True,
+    )
+
+    phase_table = tabulate(
+        [{"phase": n, "time": f"{d:.2f}s"} for n, d in phases.items()],
+        headers={"phase": "Phase", "time": "Time"},
+    )
+    command_table = tabulate(
+        [
+            {
+                "command": e.name if len(e.name) <= 60 else e.name[:57] + "...",
+                "host": e.args["host"],
+                "time": f"{e.duration:.2f}s",
+                "output": e.args["stdout_bytes"] or "-",
+            }
+            for e in commands[:SLOWEST_COMMANDS]
+        ],
+        headers={
+            "command": "Command",
+            "host": "Host",
+            "time": "Time",
+            "output": "Output (bytes)",
+        },
+    )
+    return "\n\n".join(t for t in (phase_table, command_table) if t)
+
+
+def write_trace(path: Path) -> None:
+    "Write the recorded events in the Chrome trace event format."
+    with _lock:
+        events = list(_events)
+
+    trace = {
+        "displayTimeUnit": "ms",
+        "traceEvents": [
+            {
+                "name": e.name,
+                "cat": e.category,
+                "ph": "X",
+                "ts": round(e.start * 1_000_000),
+                "dur": round(e.duration * 1_000_000),
+                "pid": e.pid,
+                "tid": e.thread,
+                "args": e.args,
+            }
+            for e in events
+        ],
+    }
+    path.write_text(json.dumps(trace, indent=2))
+    logger.debug("wrote trace of %d event(s) to '%s'", len(events), path)
@@ -1,10 +1,15 @@
+import json
 import logging
+import os
 from collections.abc import Mapping, Sequence
-from typing import Any, ClassVar, assert_never, override
+from pathlib import Path
+from typing import Any, ClassVar, Final, assert_never, override
 
 type Arg = bool | str | list[str] | list[list[str]] | int | None
 type Args = dict[str, Arg]
 
+logger: Final = logging.getLogger(__name__)
+
 
 class LogFormatter(logging.Formatter):
     formatters: ClassVar = {
@@ -99,3 +104,36 @@ def tabulate(
         result.append(format_row(row))
 
     return "\n".join(result)
+
+
+def cache_path(name: str) -> Path:
+    "Path of a file in the cache directory of nixos-rebuild."
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home) / "nixos-rebuild" / name
+
+
+def read_cache(name: str) -> dict[str, Any]:
+    """Read a JSON object from the cache directory.
+
+    A missing or broken cache file is treated as empty.
+    """
+    try:
+        cache = json.loads(cache_path(name).read_text())
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def write_cache(name: str, cache: Mapping[str, Any]) -> None:
+    """Atomically replace a JSON object in the cache directory.
+
+    Errors are only logged, since a cache is never required to work.
+    """
+    path = cache_path(name)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f".{path.name}.{os.getpid()}")
+        tmp.write_text(json.dumps(cache, indent=2))
+        tmp.replace(path)
+    except OSError as ex:
+        logger.debug("could not write cache '%s': %s", path, ex)
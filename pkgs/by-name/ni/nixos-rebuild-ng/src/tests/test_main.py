@@ -1,7 +1,11 @@
+import io
+import json
 import logging
 import os
+import shlex
 import textwrap
 import uuid
+from importlib.resources import files
 from pathlib import Path
 from subprocess import PIPE, CompletedProcess
 from typing import Any
@@ -13,6 +17,10 @@ import nixos_rebuild as nr
 
 from .helpers import get_qualified_name
 
+ACTIVATE_SCRIPT = shlex.quote(
+    files(nr.__name__).joinpath(nr.nix.ACTIVATE_SCRIPT).read_text()
+)
+
 DEFAULT_RUN_KWARGS = {
     "env": ANY,
     "input": None,
@@ -65,6 +73,10 @@ def test_parse_args() -> None:
         nr.parse_args(["nixos-rebuild", "edit", "--attr", "attr"])
     assert e.value.code == 2
 
+    with pytest.raises(SystemExit) as e:
+        nr.parse_args(["nixos-rebuild", "switch", "--ssh-pool-ttl", "0"])
+    assert e.value.code == 2
+
     # --store-path validation tests
     with pytest.raises(SystemExit) as e:
         nr.parse_args(
@@ -228,7 +240,7 @@ def test_execute_nix_boot(mock_run: Mock, tmp_path: Path) -> None:
         elif args[0] == "nix-build":
             return CompletedProcess([], 0, str(config_path))
         else:
-            return CompletedProcess([], 0)
+            return CompletedProcess([], 0, "")
 
     mock_run.side_effect = run_side_effect
 
@@ -371,7 +383,7 @@ def test_execute_nix_build_vm(mock_run: Mock, tmp_path: Path) -> None:
         elif args[0] == "nix-instantiate":
             return CompletedProcess([], 1)
         else:
-            return CompletedProcess([], 0)
+            return CompletedProcess([], 0, "")
 
     mock_run.side_effect = run_side_effect
 
@@ -434,7 +446,7 @@ def test_execute_nix_build_image_flake(mock_run: Mock, tmp_path: Path) -> None:
         elif args[0] == "nix-instantiate":
             return CompletedProcess([], 1)
         else:
-            return CompletedProcess([], 0)
+            return CompletedProcess([], 0, "")
 
     mock_run.side_effect = run_side_effect
 
@@ -503,6 +515,152 @@ def test_execute_nix_build_image_flake(mock_run: Mock, tmp_path: Path) -> None:
     )
 
 
+@patch.dict(os.environ, {}, clear=True)
+@patch("subprocess.run", autospec=True)
+def test_execute_nix_build_image_flake_variants(
+    mock_run: Mock,
+    capsys: pytest.CaptureFixture[str],
+) -> None:
+    images = {
+        "azure": {
+            "drvPath": "/nix/store/azure.drv",
+            "outPath": "/nix/store/azure",
+            "filePath": "nixos-image-azure.vhd",
+        },
+        "qcow2": {
+            "drvPath": "/nix/store/qcow2.drv",
+            "outPath": "/nix/store/qcow2",
+            "filePath": "nixos-image-qcow2.qcow2",
+        },
+    }
+
+    def run_side_effect(args: list[str], **kwargs: Any) -> CompletedProcess[str]:
+        if args[0] == "nix" and "builtins.attrNames" in args:
+            return CompletedProcess([], 0, json.dumps(list(images)))
+        elif args[0] == "nix" and "eval" in args:
+            return CompletedProcess(
+                [], 0, json.dumps({"variants": list(images), "images": images})
+            )
+        elif args[0] == "nix-instantiate":
+            return CompletedProcess([], 1)
+        else:
+            return CompletedProcess([], 0, "")
+
+    mock_run.side_effect = run_side_effect
+
+    nr.execute(
+        [
+            "nixos-rebuild",
+            "build-image",
+            "--image-variant",
+            "all",
+            "--flake",
+            "/path/to/config#hostname",
+        ]
+    )
+
+    assert mock_run.call_count == 4
+    # evaluated once, then built without evaluating again
+    mock_run.assert_has_calls(
+        [
+            call(
+                [
+                    "nix",
+                    "--extra-experimental-features",
+                    "nix-command flakes",
+                    "eval",
+                    "--json",
+                    '/path/to/config#nixosConfigurations."hostname".config.system.build.images',
+                    "--apply",
+                    nr.nix._image_derivations_fn(["azure", "qcow2"]),
+                ],
+                check=True,
+                stdout=PIPE,
+                **DEFAULT_RUN_KWARGS,
+            ),
+            call(
+                [
+                    "nix-store",
+                    "--realise",
+                    Path("/nix/store/azure.drv"),
+                    Path("/nix/store/qcow2.drv"),
+                    "--add-root",
+                    Path("result"),
+                ],
+                check=True,
+                stdout=PIPE,
+                **DEFAULT_RUN_KWARGS,
+            ),
+        ]
+    )
+    assert capsys.readouterr().out.split() == [
+        "Variant",
+        "Image",
+        "azure",
+        "/nix/store/azure/nixos-image-azure.vhd",
+        "qcow2",
+        "/nix/store/qcow2/nixos-image-qcow2.qcow2",
+    ]
+
+
+@patch.dict(os.environ, {}, clear=True)
+@patch("subprocess.run", autospec=True)
+def test_execute_nix_build_image_flake_named_variants(mock_run: Mock) -> None:
+    image = {
+        "drvPath": "/nix/store/azure.drv",
+        "outPath": "/nix/store/azure",
+        "filePath": "nixos-image-azure.vhd",
+    }
+
+    def run_side_effect(args: list[str], **kwargs: Any) -> CompletedProcess[str]:
+        if args[0] == "nix" and "eval" in args:
+            return CompletedProcess(
+                [],
+                0,
+                json.dumps(
+                    {"variants": ["azure", "qcow2"], "images": {"azure": image}}
+                ),
+            )
+        elif args[0] == "nix-instantiate":
+            return CompletedProcess([], 1)
+        else:
+            return CompletedProcess([], 0, "")
+
+    mock_run.side_effect = run_side_effect
+
+    # the variants are validated by the evaluation of their derivations
+    with pytest.raises(nr.models.NixOSRebuildError, match="supported image variants"):
+        nr.execute(
+            [
+                "nixos-rebuild",
+                "build-image",
+                "--image-variant",
+                "azure",
+                "--image-variant",
+                "vmware",
+                "--flake",
+                "/path/to/config#hostname",
+            ]
+        )
+
+    assert not any("builtins.attrNames" in c.args[0] for c in mock_run.mock_calls)
+    mock_run.assert_called_with(
+        [
+            "nix",
+            "--extra-experimental-features",
+            "nix-command flakes",
+            "eval",
+            "--json",
+            '/path/to/config#nixosConfigurations."hostname".config.system.build.images',
+            "--apply",
+            nr.nix._image_derivations_fn(["azure", "vmware"]),
+        ],
+        check=True,
+        stdout=PIPE,
+        **DEFAULT_RUN_KWARGS,
+    )
+
+
 @patch.dict(
     os.environ,
     {"NIXOS_REBUILD_I_UNDERSTAND_THE_CONSEQUENCES_PLEASE_BREAK_MY_SYSTEM": "1"},
@@ -519,7 +677,7 @@ def test_execute_nix_switch_flake(mock_run: Mock, tmp_path: Path) -> None:
         elif args[0] == "nix-instantiate":
             return CompletedProcess([], 1)
         else:
-            return CompletedProcess([], 0)
+            return CompletedProcess([], 0, "")
 
     mock_run.side_effect = run_side_effect
 
@@ -607,6 +765,7 @@ def test_execute_nix_switch_flake(mock_run: Mock, tmp_path: Path) -> None:
     {"NIXOS_REBUILD_I_UNDERSTAND_THE_CONSEQUENCES_PLEASE_BREAK_MY_SYSTEM": "1"},
     clear=True,
 )
+@patch("subprocess.Popen", autospec=True)
 @patch("subprocess.run", autospec=True)
 @patch("uuid.uuid4", autospec=True)
 @patch(get_qualified_name(nr.services.cleanup_ssh), autospec=True)
@@ -614,6 +773,7 @@ def test_execute_nix_switch_build_target_host(
     mock_cleanup_ssh: Mock,
     mock_uuid4: Mock,
     mock_run: Mock,
+    mock_popen: Mock,
     tmp_path: Path,
 ) -> None:
     config_path = tmp_path / "test"
@@ -633,11 +793,14 @@ def test_execute_nix_switch_build_target_host(
         elif args[0] == "ssh" and "readlink" in args:
             return CompletedProcess([], 0, str(config_path))
         else:
-            return CompletedProcess([], 0)
+            return CompletedProcess([], 0, "")
 
     mock_run.side_effect = run_side_effect
     mock_uuid4.return_value = uuid.UUID(int=0)
 
+    mock_popen.return_value.stdout = io.StringIO("")
+    mock_popen.return_value.wait.return_value = 0
+
     nr.execute(
         [
             "nixos-rebuild",
@@ -657,7 +820,7 @@ def test_execute_nix_switch_build_target_host(
         ]
     )
 
-    assert mock_run.call_count == 12
+    assert mock_run.call_count == 9
     mock_run.assert_has_calls(
         [
             call(
@@ -791,64 +954,37 @@ def test_execute_nix_switch_build_target_host(
                 check=True,
                 **DEFAULT_RUN_KWARGS,
             ),
-            call(
-                [
-                    "ssh",
-                    *nr.process.SSH_DEFAULT_OPTS,
-                    "user@target-host",
-                    "--",
-                    "sudo",
-                    "/bin/sh",
-                    "-c",
-                    """'exec /usr/bin/env -i PATH="${PATH-}" "$@"'""",
-                    "sh",
-                    "nix-env",
-                    "-p",
-                    "/nix/var/nix/profiles/system",
-                    "--set",
-                    str(config_path),
-                ],
-                check=True,
-                **DEFAULT_RUN_KWARGS,
-            ),
-            call(
-                [
-                    "ssh",
-                    *nr.process.SSH_DEFAULT_OPTS,
-                    "user@target-host",
-                    "--",
-                    "/bin/sh",
-                    "-c",
-                    """'exec /usr/bin/env -i PATH="${PATH-}" "$@"'""",
-                    "sh",
-                    "test",
-                    "-d",
-                    "/run/systemd/system",
-                ],
-                check=False,
-                **DEFAULT_RUN_KWARGS,
-            ),
-            call(
-                [
-                    "ssh",
-                    *nr.process.SSH_DEFAULT_OPTS,
-                    "user@target-host",
-                    "--",
-                    "sudo",
-                    "/bin/sh",
-                    "-c",
-                    """'exec /usr/bin/env -i PATH="${PATH-}" LOCALE_ARCHIVE="${LOCALE_ARCHIVE-}" NIXOS_NO_CHECK="${NIXOS_NO_CHECK-}" NIXOS_INSTALL_BOOTLOADER=0 "$@"'""",
-                    "sh",
-                    *nr.nix.SWITCH_TO_CONFIGURATION_CMD_PREFIX,
-                    str(config_path / "bin/switch-to-configuration"),
-                    "switch",
-                ],
-                check=True,
-                stdout=ANY,
-                **DEFAULT_RUN_KWARGS,
-            ),
         ]
     )
+    mock_popen.assert_called_once_with(
+        [
+            "ssh",
+            *nr.process.SSH_DEFAULT_OPTS,
+            "user@target-host",
+            "--",
+            "sudo",
+            "/bin/sh",
+            "-c",
+            """'exec /usr/bin/env -i PATH="${PATH-}" LOCALE_ARCHIVE="${LOCALE_ARCHIVE-}" NIXOS_NO_CHECK="${NIXOS_NO_CHECK-}" NIXOS_INSTALL_BOOTLOADER=0 "$@"'""",
+            "sh",
+            "/bin/sh",
+            "-c",
+            ACTIVATE_SCRIPT,
+            "activate",
+            "/nix/var/nix/profiles/system",
+            str(config_path),
+            str(config_path),
+            "switch",
+            "0",
+            *nr.nix.SWITCH_TO_CONFIGURATION_CMD_PREFIX,
+        ],
+        env=None,
+        stdin=None,
+        stdout=PIPE,
+        stderr=None,
+        text=True,
+        errors="surrogateescape",
+    )
 
 
 @patch.dict(
@@ -856,11 +992,13 @@ def test_execute_nix_switch_build_target_host(
     {"NIXOS_REBUILD_I_UNDERSTAND_THE_CONSEQUENCES_PLEASE_BREAK_MY_SYSTEM": "1"},
     clear=True,
 )
+@patch("subprocess.Popen", autospec=True)
 @patch("subprocess.run", autospec=True)
 @patch(get_qualified_name(nr.services.cleanup_ssh), autospec=True)
 def test_execute_nix_switch_flake_target_host(
     mock_cleanup_ssh: Mock,
     mock_run: Mock,
+    mock_popen: Mock,
     tmp_path: Path,
 ) -> None:
     config_path = tmp_path / "test"
@@ -872,10 +1010,13 @@ def test_execute_nix_switch_flake_target_host(
         elif args[0] == "nix-instantiate":
             return CompletedProcess([], 1)
         else:
-            return CompletedProcess([], 0)
+            return CompletedProcess([], 0, "")
 
     mock_run.side_effect = run_side_effect
 
+    mock_popen.return_value.stdout = io.StringIO("")
+    mock_popen.return_value.wait.return_value = 0
+
     nr.execute(
         [
             "nixos-rebuild",
@@ -889,7 +1030,7 @@ def test_execute_nix_switch_flake_target_host(
         ]
     )
 
-    assert mock_run.call_count == 6
+    assert mock_run.call_count == 3
     mock_run.assert_has_calls(
         [
             call(
@@ -917,64 +1058,37 @@ def test_execute_nix_switch_flake_target_host(
                 check=True,
                 **DEFAULT_RUN_KWARGS,
             ),
-            call(
-                [
-                    "ssh",
-                    *nr.process.SSH_DEFAULT_OPTS,
-                    "user@localhost",
-                    "--",
-                    "sudo",
-                    "/bin/sh",
-                    "-c",
-                    """'exec /usr/bin/env -i PATH="${PATH-}" "$@"'""",
-                    "sh",
-                    "nix-env",
-                    "-p",
-                    "/nix/var/nix/profiles/system",
-                    "--set",
-                    str(config_path),
-                ],
-                check=True,
-                **DEFAULT_RUN_KWARGS,
-            ),
-            call(
-                [
-                    "ssh",
-                    *nr.process.SSH_DEFAULT_OPTS,
-                    "user@localhost",
-                    "--",
-                    "/bin/sh",
-                    "-c",
-                    """'exec /usr/bin/env -i PATH="${PATH-}" "$@"'""",
-                    "sh",
-                    "test",
-                    "-d",
-                    "/run/systemd/system",
-                ],
-                check=False,
-                **DEFAULT_RUN_KWARGS,
-            ),
-            call(
-                [
-                    "ssh",
-                    *nr.process.SSH_DEFAULT_OPTS,
-                    "user@localhost",
-                    "--",
-                    "sudo",
-                    "/bin/sh",
-                    "-c",
-                    """'exec /usr/bin/env -i PATH="${PATH-}" LOCALE_ARCHIVE="${LOCALE_ARCHIVE-}" NIXOS_NO_CHECK="${NIXOS_NO_CHECK-}" NIXOS_INSTALL_BOOTLOADER=0 "$@"'""",
-                    "sh",
-                    *nr.nix.SWITCH_TO_CONFIGURATION_CMD_PREFIX,
-                    str(config_path / "bin/switch-to-configuration"),
-                    "switch",
-                ],
-                check=True,
-                stdout=ANY,
-                **DEFAULT_RUN_KWARGS,
-            ),
         ]
     )
+    mock_popen.assert_called_once_with(
+        [
+            "ssh",
+            *nr.process.SSH_DEFAULT_OPTS,
+            "user@localhost",
+            "--",
+            "sudo",
+            "/bin/sh",
+            "-c",
+            """'exec /usr/bin/env -i PATH="${PATH-}" LOCALE_ARCHIVE="${LOCALE_ARCHIVE-}" NIXOS_NO_CHECK="${NIXOS_NO_CHECK-}" NIXOS_INSTALL_BOOTLOADER=0 "$@"'""",
+            "sh",
+            "/bin/sh",
+            "-c",
+            ACTIVATE_SCRIPT,
+            "activate",
+            "/nix/var/nix/profiles/system",
+            str(config_path),
+            str(config_path),
+            "switch",
+            "0",
+            *nr.nix.SWITCH_TO_CONFIGURATION_CMD_PREFIX,
+        ],
+        env=None,
+        stdin=None,
+        stdout=PIPE,
+        stderr=None,
+        text=True,
+        errors="surrogateescape",
+    )
 
 
 @patch.dict(
@@ -1000,7 +1114,7 @@ def test_execute_nix_switch_flake_build_host(
         elif args[0] == "nix-instantiate":
             return CompletedProcess([], 1)
         else:
-            return CompletedProcess([], 0)
+            return CompletedProcess([], 0, "")
 
     mock_run.side_effect = run_side_effect
 
@@ -1120,7 +1234,7 @@ def test_execute_switch_rollback(mock_run: Mock, tmp_path: Path) -> None:
         elif args[0] == "test":
             return CompletedProcess([], 1)
         else:
-            return CompletedProcess([], 0)
+            return CompletedProcess([], 0, "")
 
     mock_run.side_effect = run_side_effect
 
@@ -1321,7 +1435,7 @@ def test_execute_test_flake(mock_run: Mock, tmp_path: Path) -> None:
         elif args[0] == "test":
             return CompletedProcess([], 1)
         else:
-            return CompletedProcess([], 0)
+            return CompletedProcess([], 0, "")
 
     mock_run.side_effect = run_side_effect
 
@@ -1391,7 +1505,7 @@ def test_execute_test_rollback(
         elif args[0] == "test":
             return CompletedProcess([], 1)
         else:
-            return CompletedProcess([], 0)
+            return CompletedProcess([], 0, "")
 
     mock_run.side_effect = run_side_effect
 
@@ -1503,11 +1617,13 @@ def test_execute_switch_store_path(mock_run: Mock, tmp_path: Path) -> None:
 
 
 @patch.dict(os.environ, {}, clear=True)
+@patch("subprocess.Popen", autospec=True)
 @patch("subprocess.run", autospec=True)
 @patch(get_qualified_name(nr.services.cleanup_ssh), autospec=True)
 def test_execute_switch_store_path_target_host(
     mock_cleanup_ssh: Mock,
     mock_run: Mock,
+    mock_popen: Mock,
     tmp_path: Path,
 ) -> None:
     config_path = tmp_path / "test-system"
@@ -1515,6 +1631,9 @@ def test_execute_switch_store_path_target_host(
 
     mock_run.return_value = CompletedProcess([], 0, stdout="")
 
+    mock_popen.return_value.stdout = io.StringIO("")
+    mock_popen.return_value.wait.return_value = 0
+
     nr.execute(
         [
             "nixos-rebuild",
@@ -1529,7 +1648,7 @@ def test_execute_switch_store_path_target_host(
     )
 
     # --store-path skips build and write_version_suffix, so only copy/activation calls
-    assert mock_run.call_count == 6
+    assert mock_run.call_count == 2
     mock_run.assert_has_calls(
         [
             call(
@@ -1537,78 +1656,34 @@ def test_execute_switch_store_path_target_host(
                 check=True,
                 **DEFAULT_RUN_KWARGS,
             ),
-            call(
-                [
-                    "ssh",
-                    *nr.process.SSH_DEFAULT_OPTS,
-                    "user@remote-host",
-                    "--",
-                    "/bin/sh",
-                    "-c",
-                    """'exec /usr/bin/env -i PATH="${PATH-}" "$@"'""",
-                    "sh",
-                    "test",
-                    "-f",
-                    str(config_path / "nixos-version"),
-                ],
-                check=False,
-                **DEFAULT_RUN_KWARGS,
-            ),
-            call(
-                [
-                    "ssh",
-                    *nr.process.SSH_DEFAULT_OPTS,
-                    "user@remote-host",
-                    "--",
-                    "sudo",
-                    "/bin/sh",
-                    "-c",
-                    """'exec /usr/bin/env -i PATH="${PATH-}" "$@"'""",
-                    "sh",
-                    "nix-env",
-                    "-p",
-                    "/nix/var/nix/profiles/system",
-                    "--set",
-                    str(config_path),
-                ],
-                check=True,
-                **DEFAULT_RUN_KWARGS,
-            ),
-            call(
-                [
-                    "ssh",
-                    *nr.process.SSH_DEFAULT_OPTS,
-                    "user@remote-host",
-                    "--",
-                    "/bin/sh",
-                    "-c",
-                    """'exec /usr/bin/env -i PATH="${PATH-}" "$@"'""",
-                    "sh",
-                    "test",
-                    "-d",
-                    "/run/systemd/system",
-                ],
-                check=False,
-                **DEFAULT_RUN_KWARGS,
-            ),
-            call(
-                [
-                    "ssh",
-                    *nr.process.SSH_DEFAULT_OPTS,
-                    "user@remote-host",
-                    "--",
-                    "sudo",
-                    "/bin/sh",
-                    "-c",
-                    """'exec /usr/bin/env -i PATH="${PATH-}" LOCALE_ARCHIVE="${LOCALE_ARCHIVE-}" NIXOS_NO_CHECK="${NIXOS_NO_CHECK-}" NIXOS_INSTALL_BOOTLOADER=0 "$@"'""",
-                    "sh",
-                    *nr.nix.SWITCH_TO_CONFIGURATION_CMD_PREFIX,
-                    str(config_path / "bin/switch-to-configuration"),
-                    "switch",
-                ],
-                check=True,
-                stdout=ANY,
-                **DEFAULT_RUN_KWARGS,
-            ),
         ]
     )
+    mock_popen.assert_called_once_with(
+        [
+            "ssh",
+            *nr.process.SSH_DEFAULT_OPTS,
+            "user@remote-host",
+            "--",
+            "sudo",
+            "/bin/sh",
+            "-c",
+            """'exec /usr/bin/env -i PATH="${PATH-}" LOCALE_ARCHIVE="${LOCALE_ARCHIVE-}" NIXOS_NO_CHECK="${NIXOS_NO_CHECK-}" NIXOS_INSTALL_BOOTLOADER=0 "$@"'""",
+            "sh",
+            "/bin/sh",
+            "-c",
+            ACTIVATE_SCRIPT,
+            "activate",
+            "/nix/var/nix/profiles/system",
+            str(config_path),
+            str(config_path),
+            "switch",
+            "1",
+            *nr.nix.SWITCH_TO_CONFIGURATION_CMD_PREFIX,
+        ],
+        env=None,
+        stdin=None,
+        stdout=PIPE,
+        stderr=None,
+        text=True,
+        errors="surrogateescape",
+    )
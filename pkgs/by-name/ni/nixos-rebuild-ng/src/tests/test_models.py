@@ -2,6 +2,7 @@ import subprocess
 from pathlib import Path
 from unittest.mock import Mock, patch
 
+import pytest
 from pytest import MonkeyPatch
 
 import nixos_rebuild.models as m
@@ -205,6 +206,42 @@ def test_flake_from_arg(
         ) == m.Flake("/path/to", 'nixosConfigurations."remote-hostname"')
 
 
+def test_fleet_host_from_inventory(tmp_path: Path) -> None:
+    inventory = tmp_path / "inventory.json"
+    inventory.write_text(
+        """{
+            "root@web1": "/etc/nixos#web",
+            "web2": "#web",
+            "db1": "/nix/store/abc-nixos-system-db1"
+        }"""
+    )
+    assert m.FleetHost.from_inventory(str(inventory), "/flake") == [
+        m.FleetHost(
+            m.Remote("root@web1", [], "ssh"),
+            m.Flake("/etc/nixos", 'nixosConfigurations."web"'),
+            None,
+        ),
+        m.FleetHost(
+            m.Remote("web2", [], "ssh"),
+            m.Flake("/flake", 'nixosConfigurations."web"'),
+            None,
+        ),
+        m.FleetHost(
+            m.Remote("db1", [], "ssh"),
+            None,
+            Path("/nix/store/abc-nixos-system-db1"),
+        ),
+    ]
+
+    for content in ["[]", "{}", '{"host": 1}', '{"host": "web"}', "{"]:
+        inventory.write_text(content)
+        with pytest.raises(m.NixOSRebuildError):
+            m.FleetHost.from_inventory(str(inventory), "/flake")
+
+    with pytest.raises(m.NixOSRebuildError):
+        m.FleetHost.from_inventory(str(tmp_path / "missing.json"), "/flake")
+
+
 @patch("pathlib.Path.mkdir", autospec=True)
 def test_profile_from_arg(mock_mkdir: Mock) -> None:
     assert m.Profile.from_arg("system") == m.Profile(
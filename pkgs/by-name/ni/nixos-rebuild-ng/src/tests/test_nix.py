@@ -1,8 +1,11 @@
+import io
+import json
+import logging
 import sys
 import textwrap
 import uuid
 from pathlib import Path
-from subprocess import PIPE, CompletedProcess
+from subprocess import PIPE, CalledProcessError, CompletedProcess
 from typing import Any
 from unittest.mock import ANY, Mock, call, patch
 
@@ -13,6 +16,7 @@ import nixos_rebuild.elevate as e
 import nixos_rebuild.models as m
 import nixos_rebuild.nix as n
 import nixos_rebuild.process as p
+import nixos_rebuild.utils as u
 
 from .helpers import get_qualified_name
 
@@ -51,6 +55,120 @@ def test_build(mock_run: Mock) -> None:
     )
 
 
+@patch(get_qualified_name(n.popen_wrapper, n), autospec=True)
+@patch(get_qualified_name(n.run_wrapper, n), autospec=True)
+def test_build_flake_copy_to(
+    mock_run: Mock,
+    mock_popen: Mock,
+    capsys: pytest.CaptureFixture[str],
+) -> None:
+    events = [
+        {
+            "action": "start",
+            "id": 1,
+            "type": n.NIX_ACT_SUBSTITUTE,
+            "fields": ["/nix/store/dep"],
+        },
+        {
+            "action": "start",
+            "id": 2,
+            "type": n.NIX_ACT_BUILD,
+            "fields": ["/nix/store/sys.drv"],
+            "text": "building '/nix/store/sys.drv'",
+        },
+        {"action": "start", "id": 3, "type": 0, "fields": []},
+        {"action": "stop", "id": 1},
+        {
+            "action": "result",
+            "id": 2,
+            "type": n.NIX_RES_BUILD_LOG_LINE,
+            "fields": ["building"],
+        },
+        {"action": "msg", "level": 1, "msg": "warning: something"},
+        {"action": "stop", "id": 3},
+        {"action": "stop", "id": 2},
+    ]
+    process = mock_popen.return_value
+    process.stderr = io.StringIO(
+        "plain line\n" + "".join(f"@nix {json.dumps(e)}\n" for e in events)
+    )
+    process.stdout = io.StringIO("/nix/store/system\n")
+    process.wait.return_value = 0
+
+    def run_side_effect(args: list[Any], **kwargs: Any) -> CompletedProcess[str]:
+        if args[0] == "nix-store":
+            return CompletedProcess(args, 0, stdout="/nix/store/system\n")
+        return CompletedProcess(args, 0, stdout="")
+
+    mock_run.side_effect = run_side_effect
+    target_host = m.Remote("user@target.host", [], "ssh")
+
+    assert n.build_flake(
+        "config.system.build.toplevel",
+        m.Flake("/flake", "nixosConfigurations.hostname"),
+        {"log_format": "bar", "print_build_logs": True},
+        copy_to=target_host,
+    ) == Path("/nix/store/system")
+
+    assert mock_popen.call_args.args[0][-2:] == ["--log-format", "internal-json"]
+    copied = [
+        arg
+        for c in mock_run.call_args_list
+        if c.args[0][0] == "nix-copy-closure"
+        for arg in c.args[0]
+        if isinstance(arg, Path)
+    ]
+    # the substituted path and the outputs of the finished build
+    assert sorted(copied) == [Path("/nix/store/dep"), Path("/nix/store/system")]
+    assert capsys.readouterr().err == (
+        "plain line\nbuilding '/nix/store/sys.drv'\nbuilding\nwarning: something\n"
+    )
+
+    # without --print-build-logs only the log of a failed build is shown
+    error = "error: builder for '/nix/store/sys.drv' failed with exit code 1"
+    events = [
+        *events[1:2],
+        *[
+            {
+                "action": "result",
+                "id": 2,
+                "type": n.NIX_RES_BUILD_LOG_LINE,
+                "fields": [f"line {i}"],
+            }
+            for i in range(30)
+        ],
+        {"action": "stop", "id": 2},
+        {"action": "msg", "level": 0, "msg": error},
+    ]
+    process.stderr = io.StringIO("".join(f"@nix {json.dumps(e)}\n" for e in events))
+    process.stdout = io.StringIO("")
+    process.wait.return_value = 1
+    with pytest.raises(CalledProcessError):
+        n.build_flake(
+            "config.system.build.toplevel",
+            m.Flake("/flake", "nixosConfigurations.hostname"),
+            copy_to=target_host,
+        )
+    assert capsys.readouterr().err.splitlines() == [
+        "building '/nix/store/sys.drv'",
+        error,
+        "last 25 log lines of '/nix/store/sys.drv':",
+        *[f"line {i}" for i in range(5, 30)],
+    ]
+    process.terminate.assert_not_called()
+
+    # an interrupted build is stopped
+    process.stderr = Mock(__iter__=Mock(side_effect=KeyboardInterrupt))
+    process.poll.return_value = None
+    with pytest.raises(KeyboardInterrupt):
+        n.build_flake(
+            "config.system.build.toplevel",
+            m.Flake("/flake", "nixosConfigurations.hostname"),
+            copy_to=target_host,
+        )
+    process.terminate.assert_called_once_with()
+
+
 @patch(
     get_qualified_name(n.run_wrapper, n),
     autospec=True,
@@ -296,6 +414,104 @@ def test_copy_closure(monkeypatch: MonkeyPatch) -> None:
         )
 
 
+def test_copy_closure_adaptive(monkeypatch: MonkeyPatch, tmp_path: Path) -> None:
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    closure = Path("/nix/store/closure")
+    dep = "/nix/store/dep"
+    target_host = m.Remote("user@target.host", [], "ssh")
+    path_info = {
+        str(closure): {"narSize": 8 * 1024 * 1024},
+        dep: {"narSize": 100 * 1024 * 1024},
+    }
+
+    def run_side_effect(args: list[str], **kwargs: Any) -> CompletedProcess[str]:
+        if "path-info" in args:
+            return CompletedProcess([], 0, json.dumps(path_info))
+        if "--check-validity" in args:
+            return CompletedProcess([], 0, f"{missing}\n")
+        return CompletedProcess([], 0)
+
+    missing = ""
+    with patch(
+        get_qualified_name(n.run_wrapper, n),
+        autospec=True,
+        side_effect=run_side_effect,
+    ) as mock_run:
+        n.copy_closure(closure, target_host, adaptive=True)
+        assert mock_run.call_count == 2
+        mock_run.assert_called_with(
+            ["xargs", "nix-store", "--check-validity", "--print-invalid"],
+            remote=target_host,
+            stdin_text=f"{closure}\n{dep}",
+            stdout=PIPE,
+        )
+
+    missing = str(closure)
+    with patch(
+        get_qualified_name(n.run_wrapper, n),
+        autospec=True,
+        side_effect=run_side_effect,
+    ) as mock_run:
+        n.copy_closure(closure, target_host, adaptive=True)
+        mock_run.assert_called_with(
+            ["nix-copy-closure", "--to", "user@target.host", closure],
+            append_local_env={"NIX_SSHOPTS": " ".join(p.SSH_DEFAULT_OPTS)},
+        )
+    stats = u.read_cache(n.COPY_STATS_FILE)["user@target.host"]
+    assert stats.keys() == {"plain_throughput"}
+
+    # a slow link, with more than a minute worth of missing paths
+    u.write_cache(
+        n.COPY_STATS_FILE,
+        {"user@target.host": {"plain_throughput": 1024 * 1024}},
+    )
+    missing = dep
+    with patch(
+        get_qualified_name(n.run_wrapper, n),
+        autospec=True,
+        side_effect=run_side_effect,
+    ) as mock_run:
+        n.copy_closure(closure, target_host, adaptive=True)
+        mock_run.assert_called_with(
+            ["nix-copy-closure", "-s", "--to", "user@target.host", closure],
+            append_local_env={
+                "NIX_SSHOPTS": " ".join(
+                    [
+                        "-o",
+                        "Compression=yes",
+                        "-o",
+                        f"ControlPath={p.tmpdir.TMPDIR_PATH / 'ssh-compressed-%C'}",
+                        *p.SSH_DEFAULT_OPTS,
+                    ]
+                )
+            },
+        )
+    # substitution hides the link throughput, so nothing is recorded
+    stats = u.read_cache(n.COPY_STATS_FILE)["user@target.host"]
+    assert stats == {"plain_throughput": 1024 * 1024}
+
+    # compression turned out to be slower, so it is switched off again
+    u.write_cache(
+        n.COPY_STATS_FILE,
+        {
+            "user@target.host": {
+                "plain_throughput": 1024 * 1024,
+                "compressed_throughput": 512 * 1024,
+            }
+        },
+    )
+    with patch(
+        get_qualified_name(n.run_wrapper, n),
+        autospec=True,
+        side_effect=run_side_effect,
+    ) as mock_run:
+        n.copy_closure(closure, target_host, adaptive=True)
+        mock_run.assert_called_with(
+            ["nix-copy-closure", "-s", "--to", "user@target.host", closure],
+            append_local_env={"NIX_SSHOPTS": " ".join(p.SSH_DEFAULT_OPTS)},
+        )
+
+
 @patch(get_qualified_name(n.run_wrapper, n), autospec=True)
 def test_edit(mock_run: Mock, monkeypatch: MonkeyPatch, tmpdir: Path) -> None:
     with monkeypatch.context() as mp:
@@ -426,6 +642,72 @@ def test_get_build_image_variants_flake(mock_run: Mock) -> None:
     )
 
 
+@patch(get_qualified_name(n.run_wrapper, n), autospec=True)
+def test_realise(mock_run: Mock) -> None:
+    drvs = [Path("/nix/store/a.drv"), Path("/nix/store/b.drv")]
+    n.realise(drvs, None, Path("result"), {"realise": True})
+    mock_run.assert_called_once_with(
+        [*["nix-store", "--realise", *drvs], "--add-root", Path("result"), "--realise"],
+        stdout=PIPE,
+    )
+
+    build_host = m.Remote("user@build.host", [], "ssh")
+    mock_run.reset_mock()
+    mock_run.side_effect = [
+        CompletedProcess([], 0),
+        CompletedProcess([], 0, "/tmp/tmpdir\n"),
+        CompletedProcess([], 0, "/tmp/tmpdir/result\n/tmp/tmpdir/result-2\n"),
+        CompletedProcess([], 0, "/nix/store/a\n/nix/store/b\n"),
+        CompletedProcess([], 0),
+        CompletedProcess([], 0),
+    ]
+    n.realise(drvs, build_host)
+    mock_run.assert_has_calls(
+        [
+            call(
+                ["nix-copy-closure", "--to", "user@build.host", *drvs],
+                append_local_env=ANY,
+            ),
+            call(
+                ["mktemp", "-d", "-t", "nixos-rebuild.XXXXX"],
+                remote=build_host,
+                stdout=PIPE,
+            ),
+            call(
+                [
+                    "nix-store",
+                    "--realise",
+                    *drvs,
+                    "--add-root",
+                    Path("/tmp/tmpdir/result"),
+                ],
+                remote=build_host,
+                stdout=PIPE,
+            ),
+            call(
+                ["readlink", "-f", "/tmp/tmpdir/result", "/tmp/tmpdir/result-2"],
+                remote=build_host,
+                stdout=PIPE,
+            ),
+            call(
+                [
+                    "nix-copy-closure",
+                    "--from",
+                    "user@build.host",
+                    Path("/nix/store/a"),
+                    Path("/nix/store/b"),
+                ],
+                append_local_env=ANY,
+            ),
+            call(
+                ["rm", "-rf", Path("/tmp/tmpdir")],
+                remote=build_host,
+                check=False,
+            ),
+        ]
+    )
+
+
 def test_get_nixpkgs_rev(tmpdir: Path) -> None:
     assert n.get_nixpkgs_rev(None) is None
     assert n.get_nixpkgs_rev(tmpdir) is None
@@ -598,9 +880,83 @@ def test_list_generations(mock_get_generations: Mock, tmp_path: Path) -> None:
 
 
 @patch(get_qualified_name(n.run_wrapper, n), autospec=True)
+def test_list_generations_index(
+    mock_run: Mock,
+    monkeypatch: MonkeyPatch,
+    tmp_path: Path,
+) -> None:
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    store_path = tmp_path / "store/system"
+    (store_path / "kernel-modules/lib/modules/6.12.1").mkdir(parents=True)
+    (store_path / "specialisation/foo").mkdir(parents=True)
+    (store_path / "nixos-version").write_text("25.05\n")
+    profiles = tmp_path / "profiles"
+    profiles.mkdir()
+    (profiles / "system-1-link").symlink_to(store_path)
+    (profiles / "system").symlink_to("system-1-link")
+    mock_run.return_value = CompletedProcess([], 0, stdout="abc123\n")
+
+    expected = [
+        {
+            "generation": 1,
+            "date": ANY,
+            "nixosVersion": "25.05",
+            "kernelVersion": "6.12.1",
+            "configurationRevision": "abc123",
+            "specialisations": ["foo"],
+            "current": True,
+        }
+    ]
+    profile = m.Profile("system", profiles / "system")
+    assert n.list_generations(profile) == expected
+    assert mock_run.call_count == 1
+
+    # the second time everything comes from the index
+    (store_path / "nixos-version").unlink()
+    assert n.list_generations(profile) == expected
+    assert mock_run.call_count == 1
+
+
+@patch(get_qualified_name(n.run_wrapper, n), autospec=True)
+def test_list_generations_remote(mock_run: Mock) -> None:
+    target_host = m.Remote("user@host", [], "ssh")
+    profile = m.Profile("system", Path("/nix/var/nix/profiles/system"))
+    mock_run.return_value = CompletedProcess(
+        [],
+        0,
+        stdout="1\t1730000000\t0\t24.11\t6.6.1\tUnknown\n"
+        "2\t1730000000\t1\t25.05\t6.12.1\tabc123\tfoo\tbar\n",
+    )
+
+    generations = n.list_generations(profile, target_host)
+    mock_run.assert_called_once_with(
+        ["/bin/sh", "-c", ANY, "list-generations", profile.path],
+        remote=target_host,
+        check=False,
+        stdout=PIPE,
+    )
+    assert [g["generation"] for g in generations] == [2, 1]
+    assert generations[0]["specialisations"] == ["foo", "bar"]
+    assert generations[0]["current"]
+    assert generations[1]["kernelVersion"] == "6.6.1"
+    assert not generations[1]["current"]
+
+    mock_run.return_value = CompletedProcess([], 1, stdout="")
+    with pytest.raises(m.NixOSRebuildError):
+        n.list_generations(profile, target_host)
+
+
+@patch(
+    get_qualified_name(n.run_wrapper, n),
+    autospec=True,
+    return_value=CompletedProcess([], 0, "diff\n"),
+)
 def test_diff_closures(mock_run: Mock) -> None:
-    n.diff_closures(
-        Path("/run/current-system"), Path("/nix/var/nix/profiles/system"), None
+    assert (
+        n.diff_closures(
+            Path("/run/current-system"), Path("/nix/var/nix/profiles/system"), None
+        )
+        == "diff\n"
     )
     mock_run.assert_called_with(
         [
@@ -613,10 +969,52 @@ def test_diff_closures(mock_run: Mock) -> None:
             Path("/nix/var/nix/profiles/system"),
         ],
         remote=None,
-        stdout=sys.stderr,
+        stdout=PIPE,
     )
 
 
+def test_parse_closures_diff() -> None:
+    diff = textwrap.dedent("""\
+        firefox: 120.0 → 121.0, +1234.5 KiB
+        \x1b[1mlinux\x1b[0m: 6.6.1, 6.6.1-modules → 6.6.2, 6.6.2-modules, \x1b[31;1m+20.0 KiB\x1b[0m
+        hello: ∅ → 2.12, +50.0 KiB
+        removed: ε → ∅, -4.0 KiB
+        glibc: -1.5 KiB
+    """)
+    assert n.parse_closures_diff(diff) == [
+        {
+            "package": "firefox",
+            "versionsBefore": ["120.0"],
+            "versionsAfter": ["121.0"],
+            "sizeDelta": 1264128,
+        },
+        {
+            "package": "linux",
+            "versionsBefore": ["6.6.1", "6.6.1-modules"],
+            "versionsAfter": ["6.6.2", "6.6.2-modules"],
+            "sizeDelta": 20480,
+        },
+        {
+            "package": "hello",
+            "versionsBefore": [],
+            "versionsAfter": ["2.12"],
+            "sizeDelta": 51200,
+        },
+        {
+            "package": "removed",
+            "versionsBefore": [""],
+            "versionsAfter": [],
+            "sizeDelta": -4096,
+        },
+        {
+            "package": "glibc",
+            "versionsBefore": [],
+            "versionsAfter": [],
+            "sizeDelta": -1536,
+        },
+    ]
+
+
 @patch(get_qualified_name(n.run_wrapper, n), autospec=True)
 def test_repl(mock_run: Mock) -> None:
     n.repl(m.BuildAttr("<nixpkgs/nixos>", None), {"nix_flag": True})
@@ -917,6 +1315,112 @@ def test_switch_to_configuration_with_systemd_run(
     )
 
 
+@patch(get_qualified_name(n.switch_to_configuration, n), autospec=True)
+@patch(get_qualified_name(n.set_profile, n), autospec=True)
+@patch(get_qualified_name(n.popen_wrapper, n), autospec=True)
+def test_activate(
+    mock_popen: Mock,
+    mock_set_profile: Mock,
+    mock_switch: Mock,
+    monkeypatch: MonkeyPatch,
+    caplog: pytest.LogCaptureFixture,
+) -> None:
+    def finish(returncode: int, stdout: str) -> None:
+        process = mock_popen.return_value
+        process.stdout = io.StringIO(stdout)
+        process.wait.return_value = returncode
+
+    profile = m.Profile("system", Path("/path/to/profile"))
+    config_path = Path("/path/to/config")
+
+    # locally, this is just set_profile + switch_to_configuration
+    n.activate(
+        config_path,
+        m.Action.SWITCH,
+        profile=profile,
+        target_host=None,
+        elevate=e.NO_ELEVATOR,
+    )
+    mock_set_profile.assert_called_once_with(
+        profile, config_path, target_host=None, elevate=e.NO_ELEVATOR
+    )
+    mock_switch.assert_called_once()
+    mock_popen.assert_not_called()
+
+    target_host = m.Remote("user@localhost", [], "ssh")
+    monkeypatch.delenv("NIXOS_REBUILD_NO_SYSTEMD_RUN", raising=False)
+    monkeypatch.delenv(
+        "NIXOS_REBUILD_I_UNDERSTAND_THE_CONSEQUENCES_PLEASE_BREAK_MY_SYSTEM",
+        raising=False,
+    )
+    finish(
+        0,
+        '{"step": "check", "status": "ok"}\n'
+        '{"step": "set-profile", "status": "ok"}\n'
+        '{"step": "switch-to-configuration", "status": "ok"}\n',
+    )
+    caplog.set_level(logging.INFO)
+    n.activate(
+        config_path,
+        m.Action.SWITCH,
+        profile=profile,
+        target_host=target_host,
+        elevate=SUDO,
+        install_bootloader=True,
+    )
+    mock_popen.assert_called_once_with(
+        [
+            "/bin/sh",
+            "-c",
+            ANY,
+            "activate",
+            profile.path,
+            config_path,
+            config_path,
+            "switch",
+            "1",
+            *n.SWITCH_TO_CONFIGURATION_CMD_PREFIX,
+        ],
+        env={
+            "LOCALE_ARCHIVE": e.PRESERVE_ENV,
+            "NIXOS_NO_CHECK": e.PRESERVE_ENV,
+            "NIXOS_INSTALL_BOOTLOADER": "1",
+        },
+        remote=target_host,
+        elevate=SUDO,
+        stdout=PIPE,
+    )
+    # a single command for all steps, reporting each one
+    mock_switch.assert_called_once()
+    assert "activation step 'set-profile': ok" in caplog.messages
+
+    finish(1, '{"step": "check", "status": "failed"}\n')
+    with pytest.raises(m.NixOSRebuildError, match="missing essential files"):
+        n.activate(
+            config_path,
+            m.Action.BOOT,
+            profile=profile,
+            target_host=target_host,
+            elevate=SUDO,
+        )
+
+    finish(
+        4,
+        "noise from the shell profile\n"
+        '{"step": "switch-to-configuration", "status": "failed"}\n',
+    )
+    with pytest.raises(CalledProcessError) as exc:
+        n.activate(
+            config_path,
+            m.Action.TEST,
+            profile=None,
+            target_host=target_host,
+            elevate=SUDO,
+        )
+    assert exc.value.returncode == 4
+    assert exc.value.cmd == [str(config_path / "bin/switch-to-configuration"), "test"]
+
+
 @patch("os.geteuid", autospec=True, return_value=1000)
 @patch(get_qualified_name(n.run_wrapper, n), autospec=True)
 def test_upgrade_channels(mock_run: Mock, mock_geteuid: Mock, tmpdir: Path) -> None:
@@ -1,7 +1,8 @@
+from pathlib import Path
 from typing import Any
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 
-from pytest import MonkeyPatch
+from pytest import MonkeyPatch, raises
 
 import nixos_rebuild.elevate as e
 import nixos_rebuild.models as m
@@ -186,6 +187,21 @@ def test_run_wrapper(mock_run: Any) -> None:
         input="password\n",
     )
 
+    p.run_wrapper(
+        ["xargs", "test"],
+        remote=m.Remote("user@localhost", [], "ssh"),
+        stdin_text="a\nb",
+    )
+    assert mock_run.call_args.kwargs["input"] == "a\nb"
+
+    with raises(ValueError):
+        p.run_wrapper(
+            ["test"],
+            elevate=e.SudoElevator(password="password"),
+            remote=m.Remote("user@localhost", [], "ssh"),
+            stdin_text="a",
+        )
+
 
 @patch("subprocess.run", autospec=True)
 def test__kill_long_running_ssh_process(mock_run: Any) -> None:
@@ -401,3 +417,109 @@ def test_custom_sudo_args(mock_run: Any) -> None:
         text=True,
         errors="surrogateescape",
     )
+
+
+@patch("subprocess.Popen", autospec=True)
+def test_popen_wrapper(mock_popen: Mock) -> None:
+    p.popen_wrapper(["test"], stdout=p.subprocess.PIPE)
+    mock_popen.assert_called_once_with(
+        ["test"],
+        env=None,
+        stdin=None,
+        stdout=p.subprocess.PIPE,
+        stderr=None,
+        text=True,
+        errors="surrogateescape",
+    )
+
+    # like run_wrapper, including the password for the elevator on stdin
+    mock_popen.return_value.stdin = Mock()
+    p.popen_wrapper(
+        ["test"],
+        elevate=e.SudoElevator(password="password"),
+        remote=m.Remote("user@localhost", [], "ssh"),
+    )
+    assert mock_popen.call_args.args[0] == [
+        "ssh",
+        *p.SSH_DEFAULT_OPTS,
+        "user@localhost",
+        "--",
+        "sudo",
+        "--prompt=",
+        "--stdin",
+        "/bin/sh",
+        "-c",
+        """'exec /usr/bin/env -i PATH="${PATH-}" "$@"'""",
+        "sh",
+        "test",
+    ]
+    assert mock_popen.call_args.kwargs["stdin"] == p.subprocess.PIPE
+    mock_popen.return_value.stdin.write.assert_called_once_with("password\n")
+    mock_popen.return_value.stdin.close.assert_called_once_with()
+
+
+def test_ssh_pool(monkeypatch: MonkeyPatch, tmp_path: Path) -> None:
+    monkeypatch.setenv("XDG_RUNTIME_DIR", "/run/user/1000")
+    assert p.ssh_pool_dir() == Path("/run/user/1000/nixos-rebuild")
+    monkeypatch.delenv("XDG_RUNTIME_DIR")
+    assert p.ssh_pool_dir() == Path(f"/tmp/nixos-rebuild-{p.os.getuid()}")
+
+    monkeypatch.setattr(p, "_ssh_opts", p.SSH_DEFAULT_OPTS)
+    monkeypatch.setattr(p, "_ssh_prewarm", [])
+    monkeypatch.setattr(p, "ssh_pool_dir", lambda: tmp_path / "pool")
+    assert p.ssh_opts() == p.SSH_DEFAULT_OPTS
+
+    p.enable_ssh_pool(ttl=300)
+    assert (tmp_path / "pool").stat().st_mode & 0o777 == 0o700
+    pool_opts = [
+        "-o",
+        "ControlMaster=auto",
+        "-o",
+        f"ControlPath={tmp_path / 'pool' / 'ssh-%C'}",
+        "-o",
+        "ControlPersist=300",
+    ]
+    assert p.ssh_opts() == pool_opts
+
+    remotes = [
+        m.Remote("user@host", ["--ssh", "opt"], "ssh"),
+        m.Remote("bucket", [], "s3"),
+    ]
+    with patch("subprocess.Popen", autospec=True) as mock_popen:
+        p.prewarm_ssh(remotes)
+    mock_popen.assert_called_once_with(
+        [
+            "ssh",
+            "--ssh",
+            "opt",
+            *pool_opts,
+            "-o",
+            "BatchMode=yes",
+            "user@host",
+            "--",
+            "true",
+        ],
+        stdin=p.subprocess.DEVNULL,
+        stdout=p.subprocess.DEVNULL,
+        stderr=p.subprocess.DEVNULL,
+        text=True,
+    )
+    assert p._ssh_prewarm == [mock_popen.return_value]
+
+    mock_popen.return_value.poll.return_value = None
+    with patch("subprocess.run", autospec=True):
+        p.cleanup_ssh()
+    mock_popen.return_value.terminate.assert_called_once_with()
+    mock_popen.return_value.wait.assert_called_once_with()
+    assert p._ssh_prewarm == []
+
+    with patch("subprocess.run", autospec=True) as mock_run:
+        p.run_wrapper(["true"], remote=remotes[0])
+    assert mock_run.call_args.args[0][:11] == [
+        "ssh",
+        "--ssh",
+        "opt",
+        *pool_opts,
+        "user@host",
+        "--",
+    ]
@@ -1,8 +1,11 @@
+import json
 import os
+import threading
 from pathlib import Path
-from subprocess import CompletedProcess
+from subprocess import CalledProcessError, CompletedProcess
 from unittest.mock import ANY, Mock, call, patch
 
+import pytest
 from pytest import MonkeyPatch
 
 import nixos_rebuild as n
@@ -69,9 +72,13 @@ def test_reexec(
 
 @patch.dict(os.environ, {}, clear=True)
 @patch("os.execve", autospec=True)
+@patch(get_qualified_name(s.nix.get_flake_metadata), autospec=True, return_value=None)
 @patch(get_qualified_name(s.nix.build_flake), autospec=True)
 def test_reexec_flake(
-    mock_build: Mock, mock_execve: Mock, monkeypatch: MonkeyPatch
+    mock_build: Mock,
+    mock_metadata: Mock,
+    mock_execve: Mock,
+    monkeypatch: MonkeyPatch,
 ) -> None:
     monkeypatch.setattr(s, "EXECUTABLE", "nixos-rebuild-ng")
     argv = ["/path/bin/nixos-rebuild-ng", "switch", "--flake"]
@@ -116,6 +123,52 @@ def test_reexec_flake(
     )
 
 
+@patch("os.execve", autospec=True)
+@patch(get_qualified_name(s.nix.get_flake_metadata), autospec=True)
+@patch(get_qualified_name(s.nix.build_flake), autospec=True)
+def test_reexec_cache(
+    mock_build: Mock,
+    mock_metadata: Mock,
+    mock_execve: Mock,
+    monkeypatch: MonkeyPatch,
+    tmp_path: Path,
+) -> None:
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.delenv(s.NIXOS_REBUILD_REEXEC_ENV, raising=False)
+    monkeypatch.setattr(s, "EXECUTABLE", "nixos-rebuild-ng")
+    new = tmp_path / "new"
+    (new / "bin").mkdir(parents=True)
+    (new / "bin/nixos-rebuild-ng").touch()
+
+    argv = ["/path/bin/nixos-rebuild-ng", "switch", "--flake", "/flake#host"]
+    args, grouped_nix_args = n.parse_args(argv)
+    mock_metadata.return_value = {"locked": {"narHash": "sha256-A"}, "locks": {}}
+    mock_build.return_value = new
+
+    s.reexec(argv, args, grouped_nix_args)
+    s.reexec(argv, args, grouped_nix_args)
+    # the second run uses the cached result for the same locked flake
+    mock_build.assert_called_once()
+    assert mock_execve.call_count == 2
+    assert mock_execve.call_args.args[0] == new / "bin/nixos-rebuild-ng"
+
+    # a different lock means building again
+    mock_metadata.return_value = {"locked": {"narHash": "sha256-B"}, "locks": {}}
+    s.reexec(argv, args, grouped_nix_args)
+    assert mock_build.call_count == 2
+
+    # as does a garbage collected result
+    (new / "bin/nixos-rebuild-ng").unlink()
+    s.reexec(argv, args, grouped_nix_args)
+    assert mock_build.call_count == 3
+
+    # without a narHash there is no cache
+    mock_metadata.return_value = {"locked": {}, "locks": {}}
+    s.reexec(argv, args, grouped_nix_args)
+    s.reexec(argv, args, grouped_nix_args)
+    assert mock_build.call_count == 5
+
+
 @patch.dict(os.environ, {s.NIXOS_REBUILD_REEXEC_ENV: "1"}, clear=True)
 @patch("os.execve", autospec=True)
 @patch(get_qualified_name(s.nix.build_flake), autospec=True)
@@ -134,3 +187,218 @@ def test_reexec_skip_if_already_reexec(mock_build: Mock, mock_execve: Mock) -> N
     s.reexec(argv, args, grouped_nix_args)
     mock_build.assert_not_called()
     mock_execve.assert_not_called()
+
+
+def _fleet(*hosts: tuple[str, str]) -> list[n.models.FleetHost]:
+    return [
+        n.models.FleetHost(
+            n.models.Remote(host, [], "ssh"),
+            n.models.Flake("/flake", attr),
+            None,
+        )
+        for host, attr in hosts
+    ]
+
+
+@patch(get_qualified_name(s.nix.activate), autospec=True)
+@patch(get_qualified_name(s.nix.copy_closure), autospec=True)
+@patch(get_qualified_name(s.nix.build_flake), autospec=True)
+def test_deploy_fleet(
+    mock_build: Mock,
+    mock_copy: Mock,
+    mock_activate: Mock,
+    capsys: pytest.CaptureFixture[str],
+) -> None:
+    args, grouped_nix_args = n.parse_args(
+        ["nixos-rebuild", "switch", "--fleet", "inventory.json"]
+    )
+    mock_build.side_effect = lambda attr, flake, **kwargs: Path(f"/nix/store/{flake}")
+    hosts = _fleet(("web1", "web"), ("web2", "web"), ("db1", "db"))
+
+    s.deploy_fleet(
+        action=n.models.Action.SWITCH,
+        args=args,
+        hosts=hosts,
+        build_host=None,
+        profile=n.models.Profile("system", Path("/nix/var/nix/profiles/system")),
+        build_attr=n.models.BuildAttr("<nixpkgs/nixos>", None),
+        grouped_nix_args=grouped_nix_args,
+    )
+
+    # every distinct configuration is only built once
+    assert mock_build.call_count == 2
+    # (the build itself copies to the local store, which is a no-op)
+    assert len([c for c in mock_copy.call_args_list if c.kwargs["to_host"]]) == 3
+    assert mock_activate.call_count == 3
+    mock_copy.assert_any_call(
+        Path("/nix/store/" + str(hosts[2].flake)),
+        to_host=hosts[2].target_host,
+        copy_flags=ANY,
+        adaptive=False,
+    )
+
+    out = capsys.readouterr().out
+    assert out.splitlines()[0].split() == [
+        "Host",
+        "Configuration",
+        "Status",
+        "Time",
+        "Error",
+    ]
+    assert [line.split()[0] for line in out.splitlines()[1:]] == [
+        "web1",
+        "web2",
+        "db1",
+    ]
+
+
+@patch(get_qualified_name(s.nix.activate), autospec=True)
+@patch(get_qualified_name(s.nix.copy_closure), autospec=True)
+@patch(get_qualified_name(s.nix.build_flake), autospec=True)
+def test_deploy_fleet_canary_failure(
+    mock_build: Mock,
+    mock_copy: Mock,
+    mock_activate: Mock,
+    capsys: pytest.CaptureFixture[str],
+) -> None:
+    args, grouped_nix_args = n.parse_args(
+        [
+            "nixos-rebuild",
+            "test",
+            "--fleet",
+            "inventory.json",
+            "--canary",
+            "1",
+            "--max-failure-rate",
+            "0.5",
+        ]
+    )
+    mock_build.return_value = Path("/nix/store/system")
+    mock_activate.side_effect = CalledProcessError(1, "switch-to-configuration")
+    hosts = _fleet(("web1", "web"), ("web2", "web"), ("web3", "web"))
+
+    with pytest.raises(n.models.NixOSRebuildError, match="on 1 of 3 hosts"):
+        s.deploy_fleet(
+            action=n.models.Action.TEST,
+            args=args,
+            hosts=hosts,
+            build_host=None,
+            profile=n.models.Profile("system", Path("/nix/var/nix/profiles/system")),
+            build_attr=n.models.BuildAttr("<nixpkgs/nixos>", None),
+            grouped_nix_args=grouped_nix_args,
+        )
+
+    # the failed canary stops the rollout, and `test` does not set the profile
+    mock_activate.assert_called_once_with(
+        Path("/nix/store/system"),
+        n.models.Action.TEST,
+        profile=None,
+        target_host=hosts[0].target_host,
+        elevate=ANY,
+        specialisation=None,
+        install_bootloader=False,
+    )
+    statuses = [line.split()[2] for line in capsys.readouterr().out.splitlines()[1:]]
+    assert statuses == ["failed", "skipped", "skipped"]
+
+
+def test_fleet_batches() -> None:
+    hosts = _fleet(*[(f"host{i}", "web") for i in range(7)])
+    batches = s._fleet_batches(hosts, canary=1, batch_size=4)
+    assert [len(b) for b in batches] == [1, 4, 2]
+    assert [len(b) for b in s._fleet_batches(hosts, canary=0, batch_size=0)] == [7]
+    assert s._fleet_batches([], canary=0, batch_size=0) == []
+
+
+@patch.object(s.Path, "exists", autospec=True, return_value=True)
+@patch(get_qualified_name(s.nix.resolve_link), autospec=True)
+@patch(get_qualified_name(s.nix.diff_closures), autospec=True)
+@patch(get_qualified_name(s.nix.activate), autospec=True)
+@patch(get_qualified_name(s.nix.copy_closure), autospec=True)
+def test_build_and_activate_system_diff(
+    mock_copy: Mock,
+    mock_activate: Mock,
+    mock_diff: Mock,
+    mock_resolve: Mock,
+    mock_exists: Mock,
+    capsys: pytest.CaptureFixture[str],
+) -> None:
+    args, grouped_nix_args = n.parse_args(
+        ["nixos-rebuild", "--diff=json", "test", "--store-path", "/nix/store/new"]
+    )
+    mock_resolve.return_value = Path("/nix/store/old")
+    activated = threading.Event()
+    mock_activate.side_effect = lambda *args, **kwargs: activated.set()
+
+    def diff(*args: object) -> str:
+        # only returns once activation has started, i.e. runs concurrently
+        assert activated.wait(5)
+        return "hello: 2.11 → 2.12, +1.0 KiB\n"
+
+    mock_diff.side_effect = diff
+
+    s.build_and_activate_system(
+        action=n.models.Action.TEST,
+        args=args,
+        build_host=None,
+        target_host=None,
+        profile=n.models.Profile("system", Path("/nix/var/nix/profiles/system")),
+        flake=None,
+        build_attr=n.models.BuildAttr("<nixpkgs/nixos>", None),
+        grouped_nix_args=grouped_nix_args,
+    )
+
+    mock_resolve.assert_called_once_with(Path("/run/current-system"), None)
+    mock_diff.assert_called_once_with(
+        Path("/nix/store/old"), Path("/nix/store/new"), None
+    )
+    out = capsys.readouterr().out.splitlines()
+    assert out[0] == "/nix/store/new"
+    assert json.loads(out[1]) == {
+        "before": "/nix/store/old",
+        "after": "/nix/store/new",
+        "changes": [
+            {
+                "package": "hello",
+                "versionsBefore": ["2.11"],
+                "versionsAfter": ["2.12"],
+                "sizeDelta": 1024,
+            }
+        ],
+    }
+
+
+@patch.object(s.Path, "exists", autospec=True, return_value=True)
+@patch(get_qualified_name(s.nix.resolve_link), autospec=True)
+@patch(get_qualified_name(s.nix.diff_closures), autospec=True)
+@patch(get_qualified_name(s.nix.activate), autospec=True)
+@patch(get_qualified_name(s.nix.copy_closure), autospec=True)
+def test_build_and_activate_system_diff_error(
+    mock_copy: Mock,
+    mock_activate: Mock,
+    mock_diff: Mock,
+    mock_resolve: Mock,
+    mock_exists: Mock,
+    caplog: pytest.LogCaptureFixture,
+) -> None:
+    args, grouped_nix_args = n.parse_args(
+        ["nixos-rebuild", "--diff", "test", "--store-path", "/nix/store/new"]
+    )
+    mock_resolve.return_value = Path("/nix/store/old")
+    mock_activate.side_effect = CalledProcessError(1, "switch-to-configuration")
+    mock_diff.side_effect = OSError("connection reset")
+
+    # the activation error is not masked by the failed diff
+    with pytest.raises(CalledProcessError):
+        s.build_and_activate_system(
+            action=n.models.Action.TEST,
+            args=args,
+            build_host=None,
+            target_host=None,
+            profile=n.models.Profile("system", Path("/nix/var/nix/profiles/system")),
+            flake=None,
+            build_attr=n.models.BuildAttr("<nixpkgs/nixos>", None),
+            grouped_nix_args=grouped_nix_args,
+        )
+
+    assert "could not diff the configurations: connection reset" in caplog.text
@@ -0,0 +1,82 @@
+import json
+from pathlib import Path
+from subprocess import CompletedProcess
+from typing import Any
+from unittest.mock import patch
+
+from pytest import MonkeyPatch
+
+import nixos_rebuild.process as p
+import nixos_rebuild.timings as t
+
+
+def test_timings(monkeypatch: MonkeyPatch, tmp_path: Path) -> None:
+    monkeypatch.setattr(t, "_events", [])
+    monkeypatch.setattr(t, "_enabled", False)
+
+    # nothing is recorded until enabled
+    with t.phase("build"):
+        pass
+    assert t._events == []
+    assert t.to_env() == {}
+
+    # events of the process that re-exec'ed us are picked up
+    inherited = [{"name": "reexec", "category": "phase", "start": 1.0, "duration": 2.0}]
+    monkeypatch.setenv(t.TIMINGS_ENV, json.dumps(inherited))
+    t.enable()
+    assert [e.name for e in t._events] == ["reexec"]
+    assert t.TIMINGS_ENV not in p.os.environ
+
+    with (
+        t.phase("build"),
+        patch(
+            "subprocess.run",
+            autospec=True,
+            return_value=CompletedProcess([], 0, stdout="/nix/store/ü\n"),
+        ),
+    ):
+        p.run_wrapper(["nix-build", "default.nix"], stdout=p.subprocess.PIPE)
+
+    command, build = t._events[1:]
+    assert build.name == "build"
+    assert command.name == "nix-build default.nix"
+    assert command.args == {
+        "host": "localhost",
+        "returncode": 0,
+        "stdout_bytes": 14,
+        "stderr_bytes": None,
+    }
+    assert command.duration <= build.duration
+
+    assert json.loads(t.to_env()[t.TIMINGS_ENV])[0] == {
+        **inherited[0],
+        "pid": t._events[0].pid,
+        "thread": t._events[0].thread,
+        "args": {},
+    }
+
+    summary = t.summary().splitlines()
+    assert summary[0].split() == ["Phase", "Time"]
+    assert summary[1].split() == ["reexec", "2.00s"]
+    assert summary[2].split()[0] == "build"
+    assert summary[4].split() == ["Command", "Host", "Time", "Output", "(bytes)"]
+    assert summary[5].split()[:3] == ["nix-build", "default.nix", "localhost"]
+
+    trace_file = tmp_path / "trace.json"
+    t.write_trace(trace_file)
+    trace: dict[str, Any] = json.loads(trace_file.read_text())
+    assert [e["name"] for e in trace["traceEvents"]] == [
+        "reexec",
+        "nix-build default.nix",
+        "build",
+    ]
+    assert trace["traceEvents"][0] | {"pid": 0, "tid": 0} == {
+        "name": "reexec",
+        "cat": "phase",
+        "ph": "X",
+        "ts": 1_000_000,
+        "dur": 2_000_000,
+        "pid": 0,
+        "tid": 0,
+        "args": {},
+    }
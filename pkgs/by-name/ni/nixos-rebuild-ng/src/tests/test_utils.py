@@ -1,4 +1,7 @@
 import textwrap
+from pathlib import Path
+
+from pytest import MonkeyPatch
 
 import nixos_rebuild.utils as u
 
@@ -58,3 +61,15 @@ def test_tabulate() -> None:
         Foo    Bar
         12345  ['abc', 'cde']
         345    456""")
+
+
+def test_cache(monkeypatch: MonkeyPatch, tmp_path: Path) -> None:
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    assert u.cache_path("test.json") == tmp_path / "nixos-rebuild/test.json"
+    assert u.read_cache("test.json") == {}
+
+    u.write_cache("test.json", {"key": ["value"]})
+    assert u.read_cache("test.json") == {"key": ["value"]}
+
+    u.cache_path("test.json").write_text("not json")
+    assert u.read_cache("test.json") == {}
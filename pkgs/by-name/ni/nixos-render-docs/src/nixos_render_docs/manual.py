@@ -1,7 +1,10 @@
+from __future__ import annotations
+
 import argparse
 import hashlib
 import html
 import json
+import os
 import re
 import xml.sax.saxutils as xml
 
@@ -10,9 +13,10 @@ from collections.abc import Mapping, Sequence
 from pathlib import Path
 from typing import Any, Callable, cast, ClassVar, Generic, get_args, NamedTuple
 
+import markdown_it
 from markdown_it.token import Token
 
-from . import md, options
+from . import md, options, parallel
 from .html import HTMLRenderer, UnresolvedXrefError
 from .manual_structure import check_structure, FragmentType, is_include, make_xml_id, TocEntry, TocEntryType, XrefTarget
 from .md import Converter, Renderer
@@ -28,19 +32,90 @@ class BaseConverter(Converter[md.TR], Generic[md.TR]):
     INCLUDE_FRAGMENT_ALLOWED_ARGS: ClassVar[set[str]] = set()
     INCLUDE_OPTIONS_ALLOWED_ARGS: ClassVar[set[str]] = set()
 
+    # bump this when changing what is stored in the parse cache
+    PARSE_CACHE_VERSION: ClassVar[int] = 1
+
     _base_paths: list[Path]
     _current_type: list[TocEntryType]
+    # directory of token streams keyed by everything that influences parsing, so
+    # unchanged files need not be parsed again. see _parse_markdown.
+    _parse_cache: Path | None = None
+    _parse_cache_salt: str | None = None
+    # token streams parsed ahead of time by _prefetch, keyed by source and auto id prefix.
+    _prefetched: dict[tuple[str, str | None], list[Token]]
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._prefetched = {}
 
     def convert(self, infile: Path, outfile: Path) -> None:
         self._base_paths = [ infile ]
         self._current_type = ['book']
         try:
+            self._prefetch(infile)
             tokens = self._parse(infile.read_text())
             self._postprocess(infile, outfile, tokens)
             converted = self._renderer.render(tokens)
             outfile.write_text(converted)
         except Exception as e:
             raise RuntimeError(f"failed to render manual {infile}") from e
+        finally:
+            self._prefetched = {}
+
+    # parsing markdown is by far the most expensive part of processing includes, and it
+    # does not depend on anything but the source and the auto id prefix. we can thus
+    # parse the whole include tree level by level using the process pool and leave only
+    # the (cheap, stateful) structural processing for _parse.
+    def _prefetch(self, infile: Path) -> None:
+        queue: list[tuple[Path, str | None]] = [ (infile, None) ]
+        seen = set(queue)
+        while queue:
+            level = []
+            for (path, prefix) in queue:
+                try:
+                    level.append((path, path.read_text(), prefix))
+                except OSError:
+                    pass # reported with proper context by _parse_included_blocks
+            parsed = parallel.map(self._parallel_parse_step, [ (src, prefix) for _, src, prefix in level ], 1,
+                                  self._parallel_parse_init_worker, self._parallel_parse_prepare())
+            queue = []
+            for ((path, src, prefix), tokens) in zip(level, parsed):
+                if tokens is None:
+                    continue
+                self._prefetched[(src, prefix)] = tokens
+                for include in self._find_includes(path, tokens):
+                    if include not in seen:
+                        seen.add(include)
+                        queue.append(include)
+
+    def _find_includes(self, path: Path, tokens: Sequence[Token]) -> list[tuple[Path, str | None]]:
+        result = []
+        for token in tokens:
+            if not is_include(token) or not token.map:
+                continue
+            directive = token.info[12:].split()
+            if not directive or directive[0] == 'options':
+                continue
+            args = { k: v for k, _sep, v in map(lambda s: s.partition('='), directive[1:]) }
+            for (lnum, line) in enumerate(token.content.splitlines(), token.map[0] + 1):
+                prefix = f"{args['auto-id-prefix']}-{lnum}" if "auto-id-prefix" in args else None
+                result.append((path.parent / line.strip(), prefix))
+        return result
+
+    # see options.BaseConverter for why this is done with a prepare/init pair.
+    @abstractmethod
+    def _parallel_parse_prepare(self) -> Any: raise NotImplementedError()
+    @classmethod
+    @abstractmethod
+    def _parallel_parse_init_worker(cls, a: Any) -> BaseConverter[md.TR]: raise NotImplementedError()
+
+    @classmethod
+    def _parallel_parse_step(cls, s: BaseConverter[md.TR], a: tuple[str, str | None]) -> list[Token] | None:
+        try:
+            return s._parse_markdown(*a)
+        except Exception:
+            # the file will be parsed again by _parse, which reports errors with context.
+            return None
 
     def _postprocess(self, infile: Path, outfile: Path, tokens: Sequence[Token]) -> None:
         pass
@@ -73,7 +148,36 @@ class BaseConverter(Converter[md.TR], Generic[md.TR]):
 
 
 
-    def _parse(self, src: str, *, auto_id_prefix: None | str = None) -> list[Token]:
+    def _parse_cache_key(self, src: str, auto_id_prefix: None | str) -> str:
+        if self._parse_cache_salt is None:
+            # the active rules also identify the plugins in use, the options change what
+            # some of them (eg typographer replacements) produce.
+            self._parse_cache_salt = json.dumps([
+                self.PARSE_CACHE_VERSION,
+                markdown_it.__version__,
+                f"{type(self).__module__}.{type(self).__qualname__}",
+                self._md.get_active_rules(),
+                dict(self._md.options),
+            ], default=str)
+        digest = hashlib.sha256()
+        for part in [ self._parse_cache_salt, auto_id_prefix or "", src ]:
+            digest.update(part.encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def _parse_markdown(self, src: str, auto_id_prefix: None | str) -> list[Token]:
+        if (prefetched := self._prefetched.pop((src, auto_id_prefix), None)) is not None:
+            return prefetched
+
+        cache_file = None
+        if self._parse_cache is not None:
+            cache_file = self._parse_cache / f"{self._parse_cache_key(src, auto_id_prefix)}.json"
+            try:
+                with open(cache_file) as f:
+                    return [ Token.from_dict(t) for t in json.load(f) ]
+            except (OSError, ValueError):
+                pass # not cached yet, or a broken entry we will simply overwrite
+
         tokens = super()._parse(src)
         if auto_id_prefix:
             def set_token_ident(token: Token, ident: str) -> None:
@@ -82,6 +186,19 @@ class BaseConverter(Converter[md.TR], Generic[md.TR]):
 
             self._handle_headings(tokens, src=src, on_heading=set_token_ident)
 
+        if cache_file is not None:
+            # write to a temporary file first so concurrent builds never see partial entries
+            tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+            try:
+                cache_file.parent.mkdir(parents=True, exist_ok=True)
+                tmp_file.write_text(json.dumps([ t.as_dict() for t in tokens ]))
+                tmp_file.replace(cache_file)
+            except OSError:
+                tmp_file.unlink(missing_ok=True)
+        return tokens
+
+    def _parse(self, src: str, *, auto_id_prefix: None | str = None) -> list[Token]:
+        tokens = self._parse_markdown(src, auto_id_prefix)
 
         check_structure(src, self._current_type[-1], tokens)
         for token in tokens:
@@ -266,6 +383,9 @@ class ManualHTMLRenderer(RendererMixin, HTMLRenderer):
     _in_dir: Path
     _html_params: HTMLParameters
     _redirects: Redirects | None
+    # into-file chunks found while rendering the main file. these are rendered only once
+    # the main file is done, in parallel. see _render_book.
+    _chunks: list[tuple[str, int, Path, Token]] | None = None
 
     def __init__(self, toplevel_tag: str, revision: str, html_params: HTMLParameters,
                  manpage_urls: Mapping[str, str], xref_targets: dict[str, XrefTarget],
@@ -299,6 +419,47 @@ class ManualHTMLRenderer(RendererMixin, HTMLRenderer):
         (self._toplevel_tag, self._headings, self._attrspans, self._hlevel_offset, self._in_dir) = state
 
     def _render_book(self, tokens: Sequence[Token]) -> str:
+        self._chunks = []
+        try:
+            result = self._render_book_file(tokens)
+            chunks = self._chunks
+        finally:
+            self._chunks = None
+
+        # options are rendered with the process pool themselves, and worker processes
+        # can't have pools of their own. render them here instead of in the chunk.
+        for (_tag, _hlevel_offset, _in_dir, token) in chunks:
+            self._prerender_options(token)
+        parallel.map(self._parallel_render_chunk_step, chunks, 1,
+                     self._parallel_render_chunk_init_worker, self._parallel_render_chunk_prepare())
+        return result
+
+    def _parallel_render_chunk_prepare(self) -> Any:
+        return (self._toplevel_tag, self._revision, self._html_params, self._manpage_urls,
+                self._xref_targets, self._redirects, self._in_dir, self._base_path)
+    @classmethod
+    def _parallel_render_chunk_init_worker(cls, a: Any) -> ManualHTMLRenderer:
+        return cls(*a)
+
+    @classmethod
+    def _parallel_render_chunk_step(cls, s: ManualHTMLRenderer, a: tuple[str, int, Path, Token]) -> None:
+        (tag, hlevel_offset, in_dir, token) = a
+        state = s._push(tag, hlevel_offset - s._hlevel_offset)
+        try:
+            s._in_dir = in_dir
+            s._write_chunk(token)
+        finally:
+            s._pop(state)
+
+    def _prerender_options(self, token: Token) -> None:
+        for (included, _path) in token.meta['included']:
+            for sub in included:
+                if sub.type == 'included_options':
+                    sub.meta['rendered'] = self.included_options(sub, included, 0)
+                elif sub.type.startswith('included_'):
+                    self._prerender_options(sub)
+
+    def _render_book_file(self, tokens: Sequence[Token]) -> str:
         assert tokens[4].children
         title_id = cast(str, tokens[0].attrs.get('id', ""))
         title = self._xref_targets[title_id].title
@@ -358,7 +519,7 @@ class ManualHTMLRenderer(RendererMixin, HTMLRenderer):
                 '  </div>',
             ])
 
-        scripts = self._html_params.scripts
+        scripts = list(self._html_params.scripts)
         if self._redirects:
             redirects_name = f'{toc.target.path.split('.html')[0]}-redirects.js'
             with open(self._base_path / redirects_name, 'w') as file:
@@ -511,7 +672,7 @@ class ManualHTMLRenderer(RendererMixin, HTMLRenderer):
         return tag, style
 
     def _included_thing(self, tag: str, token: Token, tokens: Sequence[Token], i: int) -> str:
-        outer, inner = [], []
+        outer = []
         # since books have no non-include content the toplevel book wrapper will not count
         # towards nesting depth. other types will have at least a title+id heading which
         # *does* count towards the nesting depth. chapters give a -1 to included sections
@@ -522,29 +683,37 @@ class ManualHTMLRenderer(RendererMixin, HTMLRenderer):
             else self._headings[-1].level
         )
         outer.append(self._maybe_close_partintro())
-        into = token.meta['include-args'].get('into-file')
-        fragments = token.meta['included']
         state = self._push(tag, hoffset)
-        if into:
-            toc = TocEntry.of(fragments[0][0][0])
-            inner.append(self._file_header(toc))
-            # we do not set _hlevel_offset=0 because docbook didn't either.
+        if not token.meta['include-args'].get('into-file'):
+            outer += self._render_fragments(token)
+        elif self._chunks is not None:
+            self._chunks.append((tag, self._hlevel_offset, self._in_dir, token))
         else:
-            inner = outer
+            self._write_chunk(token)
+        self._pop(state)
+        return "".join(outer)
+
+    def _render_fragments(self, token: Token) -> list[str]:
+        result = []
         in_dir = self._in_dir
-        for included, path in fragments:
+        for included, path in token.meta['included']:
             try:
                 self._in_dir = (in_dir / path).parent
-                inner.append(self.render(included))
+                result.append(self.render(included))
             except Exception as e:
                 raise RuntimeError(f"rendering {path}") from e
-        if into:
-            inner.append(self._file_footer(toc))
-            (self._base_path / into).write_text("".join(inner))
-        self._pop(state)
-        return "".join(outer)
+        self._in_dir = in_dir
+        return result
+
+    def _write_chunk(self, token: Token) -> None:
+        toc = TocEntry.of(token.meta['included'][0][0][0])
+        # we do not set _hlevel_offset=0 because docbook didn't either.
+        inner = [ self._file_header(toc), *self._render_fragments(token), self._file_footer(toc) ]
+        (self._base_path / token.meta['include-args']['into-file']).write_text("".join(inner))
 
     def included_options(self, token: Token, tokens: Sequence[Token], i: int) -> str:
+        if (rendered := token.meta.get('rendered')) is not None:
+            return cast(str, rendered)
         conv = options.HTMLConverter(self._manpage_urls, self._revision,
                                      token.meta['list-id'], token.meta['id-prefix'],
                                      self._xref_targets)
@@ -570,13 +739,21 @@ class HTMLConverter(BaseConverter[ManualHTMLRenderer]):
         self._appendix_count += 1
         return _to_base26(self._appendix_count - 1)
 
-    def __init__(self, revision: str, html_params: HTMLParameters, manpage_urls: Mapping[str, str], redirects: Redirects | None = None):
+    def __init__(self, revision: str, html_params: HTMLParameters, manpage_urls: Mapping[str, str],
+                 redirects: Redirects | None = None, parse_cache: Path | None = None):
         super().__init__()
         self._revision, self._html_params, self._manpage_urls, self._redirects = revision, html_params, manpage_urls, redirects
+        self._parse_cache = parse_cache
         self._xref_targets = {}
         self._redirection_targets = set()
         # renderer not set on purpose since it has a dependency on the output path!
 
+    def _parallel_parse_prepare(self) -> Any:
+        return (self._revision, self._html_params, self._manpage_urls, None, self._parse_cache)
+    @classmethod
+    def _parallel_parse_init_worker(cls, a: Any) -> HTMLConverter:
+        return cls(*a)
+
     def convert(self, infile: Path, outfile: Path) -> None:
         self._renderer = ManualHTMLRenderer(
             'book', self._revision, self._html_params, self._manpage_urls, self._xref_targets,
@@ -764,6 +941,7 @@ def _build_cli_html(p: argparse.ArgumentParser) -> None:
     p.add_argument('--section-toc-depth', default=0, type=int)
     p.add_argument('--media-dir', default="media", type=Path)
     p.add_argument('--redirects', type=Path)
+    p.add_argument('--parse-cache', type=Path)
     p.add_argument('infile', type=Path)
     p.add_argument('outfile', type=Path)
 
@@ -778,7 +956,7 @@ def _run_cli_html(args: argparse.Namespace) -> None:
             args.revision,
             HTMLParameters(args.generator, args.stylesheet, args.script, args.toc_depth,
                            args.chunk_toc_depth, args.section_toc_depth, args.media_dir),
-            json.load(manpage_urls), redirects)
+            json.load(manpage_urls), redirects, args.parse_cache)
         md.convert(args.infile, args.outfile)
 
 def build_cli(p: argparse.ArgumentParser) -> None:
@@ -1,8 +1,10 @@
 from __future__ import annotations
 
 import argparse
+import hashlib
 import html
 import json
+import os
 import xml.sax.saxutils as xml
 
 from abc import abstractmethod
@@ -12,6 +14,7 @@ from pathlib import Path
 from typing import Any, Generic, Optional
 from urllib.parse import quote
 
+import markdown_it
 
 from . import md
 from . import parallel
@@ -35,12 +38,30 @@ def option_is(option: Option, key: str, typ: str) -> Optional[dict[str, str]]:
 class BaseConverter(Converter[md.TR], Generic[md.TR]):
     __option_block_separator__: str
 
-    _options: dict[str, RenderedOption]
+    # bump this when changing what is stored in the render cache
+    RENDER_CACHE_VERSION = 1
 
-    def __init__(self, revision: str):
+    _options: dict[str, RenderedOption]
+    # directory of rendered options keyed by the option and everything that influences
+    # rendering it, so unchanged options need not be rendered again. see add_options.
+    _render_cache: Path | None = None
+    _render_cache_salt: str | None = None
+    # token streams of the option currently being rendered, shared with other converters
+    # rendering the same option. see MultiConverter.
+    _parse_memo: dict[str, list[Token]] | None = None
+
+    def __init__(self, revision: str, render_cache: Path | None = None):
         super().__init__()
         self._options = {}
         self._revision = revision
+        self._render_cache = render_cache
+
+    def _parse(self, src: str) -> list[Token]:
+        if self._parse_memo is None:
+            return super()._parse(src)
+        if (tokens := self._parse_memo.get(src)) is None:
+            tokens = self._parse_memo[src] = super()._parse(src)
+        return tokens
 
     def _sorted_options(self) -> list[tuple[str, RenderedOption]]:
         keys = list(self._options.keys())
@@ -164,11 +185,83 @@ class BaseConverter(Converter[md.TR], Generic[md.TR]):
     def _parallel_render_step(cls, s: BaseConverter[md.TR], a: Any) -> RenderedOption:
         return s._render_option(*a)
 
+    # everything besides the option itself that influences how it is rendered. the
+    # parameters used to set up render workers are a superset of this by definition.
+    def _render_cache_config(self) -> Any:
+        return self._parallel_render_prepare()
+
+    # state outside of the cache key that rendering an option looked at, eg to resolve
+    # link texts. cache entries are only used if this is still the same.
+    def _render_cache_deps(self, option: RenderedOption) -> dict[str, Any]:
+        return {}
+
+    def _render_cache_key(self, option: dict[str, Any]) -> str:
+        if self._render_cache_salt is None:
+            self._render_cache_salt = json.dumps([
+                self.RENDER_CACHE_VERSION,
+                markdown_it.__version__,
+                f"{type(self).__module__}.{type(self).__qualname__}",
+                self._render_cache_config(),
+            ], default=str)
+        digest = hashlib.sha256()
+        for part in [ self._render_cache_salt, json.dumps(option, sort_keys=True) ]:
+            digest.update(part.encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def _load_rendered(self, cache_file: Path) -> RenderedOption | None:
+        try:
+            with open(cache_file) as f:
+                entry = json.load(f)
+            result = RenderedOption(entry['loc'], entry['lines'], entry['links'])
+            return result if self._render_cache_deps(result) == entry['deps'] else None
+        except (OSError, ValueError, KeyError, TypeError):
+            return None # not cached yet, or a broken entry we will simply overwrite
+
+    def _store_rendered(self, cache_file: Path, option: RenderedOption) -> None:
+        # write to a temporary file first so concurrent builds never see partial entries
+        tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+        try:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file.write_text(json.dumps(option._asdict() | { 'deps': self._render_cache_deps(option) }))
+            tmp_file.replace(cache_file)
+        except OSError:
+            tmp_file.unlink(missing_ok=True)
+
+    # called before any of the options are rendered, with all options that will be added.
+    def _prepare_options(self, options: dict[str, Any]) -> None:
+        pass
+
+    # cache lookups happen before rendering rather than in the workers so only options
+    # that actually need rendering are sent to the pool. returns the cached options and
+    # the cache files of the options that are missing.
+    def _lookup_rendered(self, options: dict[str, Any]) -> tuple[dict[str, RenderedOption], dict[str, Path]]:
+        cached: dict[str, RenderedOption] = {}
+        cache_files: dict[str, Path] = {}
+        if self._render_cache is not None:
+            for (name, option) in options.items():
+                cache_file = self._render_cache / f"{self._render_cache_key(option)}.json"
+                if (rendered := self._load_rendered(cache_file)) is not None:
+                    cached[name] = rendered
+                else:
+                    cache_files[name] = cache_file
+        return (cached, cache_files)
+
+    def _add_rendered(self, options: dict[str, Any], cached: dict[str, RenderedOption],
+                      cache_files: dict[str, Path], rendered: dict[str, RenderedOption]) -> None:
+        for (name, cache_file) in cache_files.items():
+            self._store_rendered(cache_file, rendered[name])
+        for name in options.keys():
+            self._options[name] = cached[name] if name in cached else rendered[name]
+
     def add_options(self, options: dict[str, Any]) -> None:
-        mapped = parallel.map(self._parallel_render_step, options.items(), 100,
+        self._prepare_options(options)
+        (cached, cache_files) = self._lookup_rendered(options)
+        missing = [ (name, option) for (name, option) in options.items() if name not in cached ]
+        mapped = parallel.map(self._parallel_render_step, missing, 100,
                               self._parallel_render_init_worker, self._parallel_render_prepare())
-        for (name, option) in zip(options.keys(), mapped):
-            self._options[name] = option
+        self._add_rendered(options, cached, cache_files,
+                           dict(zip([ name for (name, _option) in missing ], mapped)))
 
     @abstractmethod
     def finalize(self) -> str: raise NotImplementedError()
@@ -196,9 +289,10 @@ class ManpageConverter(BaseConverter[OptionsManpageRenderer]):
                  header: list[str] | None,
                  footer: list[str] | None,
                  *,
+                 render_cache: Path | None = None,
                  # only for parallel rendering
                  _options_by_id: Optional[dict[str, str]] = None):
-        super().__init__(revision)
+        super().__init__(revision, render_cache)
         self._options_by_id = _options_by_id or {}
         self._renderer = OptionsManpageRenderer({}, self._options_by_id)
         self._header = header
@@ -215,16 +309,24 @@ class ManpageConverter(BaseConverter[OptionsManpageRenderer]):
     def _parallel_render_init_worker(cls, a: Any) -> ManpageConverter:
         return cls(a[0], a[1], a[2], **a[3])
 
+    # the id map changes whenever any option is added or removed and would invalidate
+    # everything. it's only used to turn links to other options into the names of those
+    # options though, so we record how the links of each option resolved instead.
+    def _render_cache_config(self) -> Any:
+        return (self._revision,)
+
+    def _render_cache_deps(self, option: RenderedOption) -> dict[str, Any]:
+        return { link: self._options_by_id.get(link) for link in option.links or [] }
+
     def _render_option(self, name: str, option: dict[str, Any]) -> RenderedOption:
         links = self._renderer.link_footnotes = []
         result = super()._render_option(name, option)
         self._renderer.link_footnotes = None
         return result._replace(links=links)
 
-    def add_options(self, options: dict[str, Any]) -> None:
+    def _prepare_options(self, options: dict[str, Any]) -> None:
         for (k, v) in options.items():
             self._options_by_id[f'#{make_xml_id(f"opt-{k}")}'] = k
-        return super().add_options(options)
 
     def _render_code(self, option: dict[str, Any], key: str) -> list[str]:
         try:
@@ -321,8 +423,9 @@ class CommonMarkConverter(BaseConverter[OptionsCommonMarkRenderer]):
     _anchor_prefix: str
 
 
-    def __init__(self, manpage_urls: Mapping[str, str], revision: str, anchor_style: AnchorStyle = AnchorStyle.NONE, anchor_prefix: str = ""):
-        super().__init__(revision)
+    def __init__(self, manpage_urls: Mapping[str, str], revision: str, anchor_style: AnchorStyle = AnchorStyle.NONE, anchor_prefix: str = "",
+                 render_cache: Path | None = None):
+        super().__init__(revision, render_cache)
         self._renderer = OptionsCommonMarkRenderer(manpage_urls)
         self._anchor_style = anchor_style
         self._anchor_prefix = anchor_prefix
@@ -373,8 +476,8 @@ class OptionsAsciiDocRenderer(OptionDocsRestrictions, AsciiDocRenderer):
 class AsciiDocConverter(BaseConverter[OptionsAsciiDocRenderer]):
     __option_block_separator__ = ""
 
-    def __init__(self, manpage_urls: Mapping[str, str], revision: str):
-        super().__init__(revision)
+    def __init__(self, manpage_urls: Mapping[str, str], revision: str, render_cache: Path | None = None):
+        super().__init__(revision, render_cache)
         self._renderer = OptionsAsciiDocRenderer(manpage_urls)
 
     def _parallel_render_prepare(self) -> Any:
@@ -498,10 +601,53 @@ class HTMLConverter(BaseConverter[OptionsHTMLRenderer]):
 
         return "\n".join(result)
 
+# renders the same options with several converters at once. options are loaded and
+# sent to the worker processes only once, and each option's markdown is parsed only
+# once for all converters since none of the renderers modify the token stream.
+class MultiConverter:
+    _converters: list[BaseConverter[Any]]
+
+    def __init__(self, converters: Sequence[BaseConverter[Any]]):
+        self._converters = list(converters)
+
+    def _parallel_render_prepare(self) -> Any:
+        return [ (type(c), c._parallel_render_prepare()) for c in self._converters ]
+    @classmethod
+    def _parallel_render_init_worker(cls, a: Any) -> MultiConverter:
+        return cls([ typ._parallel_render_init_worker(args) for (typ, args) in a ])
+
+    def _render_option(self, name: str, option: dict[str, Any]) -> list[RenderedOption]:
+        memo: dict[str, list[Token]] = {}
+        try:
+            for c in self._converters:
+                c._parse_memo = memo
+            return [ c._render_option(name, option) for c in self._converters ]
+        finally:
+            for c in self._converters:
+                c._parse_memo = None
+
+    @classmethod
+    def _parallel_render_step(cls, s: MultiConverter, a: Any) -> list[RenderedOption]:
+        return s._render_option(*a)
+
+    def add_options(self, options: dict[str, Any]) -> None:
+        lookups = []
+        for c in self._converters:
+            c._prepare_options(options)
+            lookups.append(c._lookup_rendered(options))
+        missing = [ (name, option) for (name, option) in options.items()
+                    if any(name not in cached for (cached, _cache_files) in lookups) ]
+        mapped = parallel.map(self._parallel_render_step, missing, 100,
+                              self._parallel_render_init_worker, self._parallel_render_prepare())
+        for (i, (c, (cached, cache_files))) in enumerate(zip(self._converters, lookups)):
+            c._add_rendered(options, cached, cache_files,
+                            { name: rendered[i] for ((name, _option), rendered) in zip(missing, mapped) })
+
 def _build_cli_manpage(p: argparse.ArgumentParser) -> None:
     p.add_argument('--revision', required=True)
     p.add_argument("--header", type=Path)
     p.add_argument("--footer", type=Path)
+    p.add_argument('--render-cache', type=Path)
     p.add_argument("infile")
     p.add_argument("outfile")
 
@@ -514,9 +660,7 @@ def parse_anchor_style(value: str|AnchorStyle) -> AnchorStyle:
     except ValueError:
         raise argparse.ArgumentTypeError(f"Invalid value {value}\nExpected one of {', '.join(style.value for style in AnchorStyle)}")
 
-def _build_cli_commonmark(p: argparse.ArgumentParser) -> None:
-    p.add_argument('--manpage-urls', required=True)
-    p.add_argument('--revision', required=True)
+def _build_cli_anchors(p: argparse.ArgumentParser) -> None:
     p.add_argument(
         '--anchor-style',
         required=False,
@@ -529,16 +673,35 @@ def _build_cli_commonmark(p: argparse.ArgumentParser) -> None:
         default="",
         help="(default: no prefix) String to prepend to anchor ids. Not used when anchor style is none."
     )
+
+def _build_cli_commonmark(p: argparse.ArgumentParser) -> None:
+    p.add_argument('--manpage-urls', required=True)
+    p.add_argument('--revision', required=True)
+    _build_cli_anchors(p)
+    p.add_argument('--render-cache', type=Path)
     p.add_argument("infile")
     p.add_argument("outfile")
 
 def _build_cli_asciidoc(p: argparse.ArgumentParser) -> None:
     p.add_argument('--manpage-urls', required=True)
     p.add_argument('--revision', required=True)
+    p.add_argument('--render-cache', type=Path)
     p.add_argument("infile")
     p.add_argument("outfile")
 
-def _run_cli_manpage(args: argparse.Namespace) -> None:
+def _build_cli_multi(p: argparse.ArgumentParser) -> None:
+    p.add_argument('--manpage-urls', required=True)
+    p.add_argument('--revision', required=True)
+    p.add_argument('--render-cache', type=Path)
+    p.add_argument('--manpage', metavar='OUTFILE', help="write the options manpage to OUTFILE")
+    p.add_argument("--header", type=Path, help="manpage header")
+    p.add_argument("--footer", type=Path, help="manpage footer")
+    p.add_argument('--commonmark', metavar='OUTFILE', help="write commonmark options docs to OUTFILE")
+    _build_cli_anchors(p)
+    p.add_argument('--asciidoc', metavar='OUTFILE', help="write asciidoc options docs to OUTFILE")
+    p.add_argument("infile")
+
+def _manpage_converter(args: argparse.Namespace) -> ManpageConverter:
     header = None
     footer = None
 
@@ -550,12 +713,16 @@ def _run_cli_manpage(args: argparse.Namespace) -> None:
         with args.footer.open() as f:
             footer = f.read().splitlines()
 
-    md = ManpageConverter(
+    return ManpageConverter(
         revision = args.revision,
         header = header,
         footer = footer,
+        render_cache = args.render_cache,
     )
 
+def _run_cli_manpage(args: argparse.Namespace) -> None:
+    md = _manpage_converter(args)
+
     with open(args.infile, 'r') as f:
         md.add_options(json.load(f))
     with open(args.outfile, 'w') as f:
@@ -566,7 +733,8 @@ def _run_cli_commonmark(args: argparse.Namespace) -> None:
         md = CommonMarkConverter(json.load(manpage_urls),
             revision = args.revision,
             anchor_style = parse_anchor_style(args.anchor_style),
-            anchor_prefix = args.anchor_prefix)
+            anchor_prefix = args.anchor_prefix,
+            render_cache = args.render_cache)
 
         with open(args.infile, 'r') as f:
             md.add_options(json.load(f))
@@ -575,18 +743,45 @@ def _run_cli_commonmark(args: argparse.Namespace) -> None:
 
 def _run_cli_asciidoc(args: argparse.Namespace) -> None:
     with open(args.manpage_urls, 'r') as manpage_urls:
-        md = AsciiDocConverter(json.load(manpage_urls), revision = args.revision)
+        md = AsciiDocConverter(json.load(manpage_urls), revision = args.revision,
+                               render_cache = args.render_cache)
 
         with open(args.infile, 'r') as f:
             md.add_options(json.load(f))
         with open(args.outfile, 'w') as f:
             f.write(md.finalize())
 
+def _run_cli_multi(args: argparse.Namespace) -> None:
+    with open(args.manpage_urls, 'r') as manpage_urls:
+        urls = json.load(manpage_urls)
+
+    outputs: list[tuple[BaseConverter[Any], str]] = []
+    if args.manpage is not None:
+        outputs.append((_manpage_converter(args), args.manpage))
+    if args.commonmark is not None:
+        outputs.append((CommonMarkConverter(urls,
+            revision = args.revision,
+            anchor_style = parse_anchor_style(args.anchor_style),
+            anchor_prefix = args.anchor_prefix,
+            render_cache = args.render_cache), args.commonmark))
+    if args.asciidoc is not None:
+        outputs.append((AsciiDocConverter(urls, revision = args.revision,
+                                          render_cache = args.render_cache), args.asciidoc))
+    if not outputs:
+        raise RuntimeError("no outputs requested")
+
+    with open(args.infile, 'r') as f:
+        MultiConverter([ md for (md, _outfile) in outputs ]).add_options(json.load(f))
+    for (md, outfile) in outputs:
+        with open(outfile, 'w') as f:
+            f.write(md.finalize())
+
 def build_cli(p: argparse.ArgumentParser) -> None:
     formats = p.add_subparsers(dest='format', required=True)
     _build_cli_manpage(formats.add_parser('manpage'))
     _build_cli_commonmark(formats.add_parser('commonmark'))
     _build_cli_asciidoc(formats.add_parser('asciidoc'))
+    _build_cli_multi(formats.add_parser('multi'))
 
 def run_cli(args: argparse.Namespace) -> None:
     if args.format == 'manpage':
@@ -595,5 +790,7 @@ def run_cli(args: argparse.Namespace) -> None:
         _run_cli_commonmark(args)
     elif args.format == 'asciidoc':
         _run_cli_asciidoc(args)
+    elif args.format == 'multi':
+        _run_cli_multi(args)
     else:
         raise RuntimeError('format not hooked up', args)
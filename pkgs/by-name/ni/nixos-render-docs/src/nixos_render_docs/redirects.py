@@ -87,6 +87,9 @@ class Redirects:
     _redirects_script: str
 
     _xref_targets: dict[str, XrefTarget] = field(default_factory=dict)
+    # built from the redirects and xref targets on first use, see _build_index.
+    _server_redirects: dict[str, str] | None = field(default=None, init=False)
+    _client_redirects: dict[str, dict[str, str]] | None = field(default=None, init=False)
 
     def validate(self, initial_xref_targets: dict[str, XrefTarget]):
         """
@@ -120,26 +123,25 @@ class Redirects:
             if identifier not in xref_targets:
                 continue
 
-            if not locations or locations[0] != f"{xref_targets[identifier].path}#{identifier}":
+            current_path = xref_targets[identifier].path
+            if not locations or locations[0] != f"{current_path}#{identifier}":
                 identifiers_missing_current_outpath.add(identifier)
 
             for location in locations[1:]:
                 if '#' in location:
                     path, anchor = location.split('#')
 
-                    if anchor in identifiers_without_redirects:
-                        identifiers_without_redirects.remove(anchor)
+                    identifiers_without_redirects.discard(anchor)
 
                     if location not in client_side_redirects:
-                        client_side_redirects[location] = f"{xref_targets[identifier].path}#{identifier}"
-                        for identifier, xref_target in xref_targets.items():
-                            if xref_target.path == path and anchor == identifier:
-                                conflicting_anchors.add(anchor)
+                        client_side_redirects[location] = f"{current_path}#{identifier}"
+                        if anchor in xref_targets and xref_targets[anchor].path == path:
+                            conflicting_anchors.add(anchor)
                     else:
                         divergent_redirects.add(location)
                 else:
                     if location not in server_side_redirects:
-                        server_side_redirects[location] = xref_targets[identifier].path
+                        server_side_redirects[location] = current_path
                     else:
                         divergent_redirects.add(location)
 
@@ -159,28 +161,43 @@ class Redirects:
             )
 
         self._xref_targets = xref_targets
+        self._server_redirects = None
+        self._client_redirects = None
 
-    def get_client_redirects(self, target: str):
-        paths_to_target = {src for src, dest in self.get_server_redirects().items() if dest == target}
-        client_redirects = {}
-        for locations in self._raw_redirects.values():
-            for location in locations[1:]:
-                if '#' not in location:
-                    continue
-                path, anchor = location.split('#')
-                if path not in [target, *paths_to_target]:
-                    continue
-                client_redirects[anchor] = locations[0]
-        return client_redirects
-
-    def get_server_redirects(self):
-        server_redirects = {}
-        for identifier, locations in self._raw_redirects.items():
-            for location in locations[1:]:
-                if '#' not in location and location not in server_redirects:
-                    server_redirects[location] = self._xref_targets[identifier].path
-        return server_redirects
+    def _build_index(self) -> tuple[dict[str, str], dict[str, dict[str, str]]]:
+        """
+        Compute the server redirects and the client redirects of every output path at once
+
+        A historical `path#anchor` location is redirected on the page at `path` itself, and
+        on the page `path` is redirected to by the server if it no longer exists. Later
+        locations of the same anchor take precedence, matching the order of the redirects file.
+        """
+        if self._server_redirects is None or self._client_redirects is None:
+            server_redirects: dict[str, str] = {}
+            for identifier, locations in self._raw_redirects.items():
+                for location in locations[1:]:
+                    if '#' not in location and location not in server_redirects:
+                        server_redirects[location] = self._xref_targets[identifier].path
+
+            client_redirects: dict[str, dict[str, str]] = {}
+            for locations in self._raw_redirects.values():
+                for location in locations[1:]:
+                    if '#' not in location:
+                        continue
+                    path, anchor = location.split('#')
+                    client_redirects.setdefault(path, {})[anchor] = locations[0]
+                    if (server_target := server_redirects.get(path)) is not None:
+                        client_redirects.setdefault(server_target, {})[anchor] = locations[0]
+
+            self._server_redirects, self._client_redirects = server_redirects, client_redirects
+        return (self._server_redirects, self._client_redirects)
+
+    def get_client_redirects(self, target: str) -> dict[str, str]:
+        return dict(self._build_index()[1].get(target, {}))
+
+    def get_server_redirects(self) -> dict[str, str]:
+        return dict(self._build_index()[0])
 
     def get_redirect_script(self, target: str) -> str:
-        client_redirects = self.get_client_redirects(target)
+        client_redirects = self._build_index()[1].get(target, {})
         return self._redirects_script.replace('REDIRECTS_PLACEHOLDER', json.dumps(client_redirects))
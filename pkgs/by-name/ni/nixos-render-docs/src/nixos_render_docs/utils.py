@@ -2,6 +2,22 @@ from typing import Any
 
 _frozen_classes: dict[type, type] = {}
 
+def _frozen_class(cls: type) -> type:
+    if not (frozen := _frozen_classes.get(cls)):
+        def __setattr__(instance: Any, n: str, v: Any) -> None:
+            raise TypeError(f'{cls.__name__} is frozen')
+        frozen = type(cls.__name__, (cls,), {
+            '__setattr__': __setattr__,
+        })
+        _frozen_classes[cls] = frozen
+    return frozen
+
+def _unpickle_freezeable(cls: type, frozen: bool) -> Any:
+    result: Any = object.__new__(cls)
+    if frozen:
+        result.__class__ = _frozen_class(cls)
+    return result
+
 # make a derived class freezable (ie, disallow modifications).
 # we do this by changing the class of an instance at runtime when freeze()
 # is called, providing a derived class that is exactly the same except
@@ -10,12 +26,13 @@ _frozen_classes: dict[type, type] = {}
 # field because it does not insert anything into the class dict.
 class Freezeable:
     def freeze(self) -> None:
+        self.__class__ = _frozen_class(type(self))
+
+    # frozen classes only exist at runtime and can't be pickled by name, which we need
+    # to pass frozen objects to worker processes. pickle them as their original class
+    # instead and freeze them again on load. the state is restored through __dict__
+    # after the object was created, so this also works for cyclic structures.
+    def __reduce__(self) -> tuple[Any, ...]:
         cls = type(self)
-        if not (frozen := _frozen_classes.get(cls)):
-            def __setattr__(instance: Any, n: str, v: Any) -> None:
-                raise TypeError(f'{cls.__name__} is frozen')
-            frozen = type(cls.__name__, (cls,), {
-                '__setattr__': __setattr__,
-            })
-            _frozen_classes[cls] = frozen
-        self.__class__ = frozen
+        frozen = _frozen_classes.get(cls.__mro__[1]) is cls
+        return (_unpickle_freezeable, (cls.__mro__[1] if frozen else cls, frozen), self.__dict__)
@@ -0,0 +1,51 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from nixos_render_docs import parallel
+from nixos_render_docs.manual import HTMLConverter, HTMLParameters
+
+
+def write_manual(src: Path) -> None:
+    src.mkdir()
+    (src / "index.md").write_text(
+        "# Book {#book}\n## Subtitle\n"
+        "```{=include=} chapters\nchapter.md\n```\n"
+        "```{=include=} appendix html:into-file=//options.html\noptions.md\n```\n"
+        "```{=include=} appendix html:into-file=//other.html\nother.md\n```\n"
+    )
+    (src / "chapter.md").write_text(
+        "# Chapter {#chapter}\n\n"
+        "```{=include=} sections\nsection.md\n```\n"
+    )
+    (src / "section.md").write_text("# Section {#section}\n\nSee [](#opt-foo) and [](#other).\n")
+    (src / "options.md").write_text(
+        "# Options {#options}\n\n"
+        "```{=include=} options\nid-prefix: opt-\nlist-id: options-list\nsource: options.json\n```\n"
+    )
+    (src / "options.json").write_text(json.dumps({
+        "foo": { "declarations": [], "description": "Foo, see [](#chapter).", "loc": ["foo"],
+                 "readOnly": False, "type": "boolean" },
+    }))
+    (src / "other.md").write_text("# Other {#other}\n\nBack to [](#section).\n")
+
+
+def convert(src: Path, out: Path) -> dict[str, str]:
+    out.mkdir()
+    md = HTMLConverter("1.0.0", HTMLParameters("", [], [], 2, 2, 2, Path("")), {})
+    md.convert(src / "index.md", out / "index.html")
+    return { f.name: f.read_text() for f in out.iterdir() }
+
+
+def test_parallel_manual(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    write_manual(tmp_path / "src")
+    sequential = convert(tmp_path / "src", tmp_path / "sequential")
+    monkeypatch.setattr(parallel, "pool_processes", 2)
+    pooled = convert(tmp_path / "src", tmp_path / "pooled")
+
+    assert sorted(pooled.keys()) == ["index.html", "options.html", "other.html"]
+    assert pooled == sequential
+    assert 'href="options.html#opt-foo"' in pooled["index.html"]
+    assert 'href="index.html#chapter"' in pooled["options.html"]
+    assert 'href="index.html#section"' in pooled["other.html"]
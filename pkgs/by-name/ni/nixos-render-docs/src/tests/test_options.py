@@ -1,10 +1,13 @@
 import json
 from pathlib import Path
+from typing import Any
+from unittest.mock import patch
 import pytest
 from markdown_it.token import Token
 
 import nixos_render_docs
-from nixos_render_docs.options import AnchorStyle
+from nixos_render_docs.options import AnchorStyle, ManpageConverter
+from nixos_render_docs.types import RenderedOption
 
 def test_option_headings() -> None:
     c = nixos_render_docs.options.HTMLConverter({}, 'local', 'vars', 'opt-', {})
@@ -39,3 +42,89 @@ def test_options_commonmark_legacy_anchors() -> None:
     c.add_options(opts)
     s = c.finalize()
     assert s == expected
+
+def test_options_render_cache(tmp_path: Path) -> None:
+    cache = tmp_path / "cache"
+    opts = {
+        "foo": { "declarations": [], "description": "Foo, see [](#opt-bar).", "loc": ["foo"],
+                 "readOnly": False, "type": "boolean" },
+        "bar": { "declarations": [], "description": "Bar.", "loc": ["bar"],
+                 "readOnly": False, "type": "boolean" },
+    }
+
+    def render(opts: dict[str, Any]) -> tuple[str, list[str]]:
+        c = nixos_render_docs.options.ManpageConverter('local', None, None, render_cache = cache)
+        rendered = []
+        render_option = ManpageConverter._render_option
+        def record(self: ManpageConverter, name: str, option: dict[str, Any]) -> RenderedOption:
+            rendered.append(name)
+            return render_option(self, name, option)
+        with patch.object(ManpageConverter, "_render_option", record):
+            c.add_options(opts)
+        return c.finalize(), rendered
+
+    first, rendered = render(opts)
+    assert rendered == ["foo", "bar"]
+    assert len(list(cache.glob("*.json"))) == 2
+
+    second, rendered = render(opts)
+    assert rendered == []
+    assert second == first
+
+    # changing an option renders only that option again
+    opts["bar"]["description"] = "Changed bar."
+    third, rendered = render(opts)
+    assert rendered == ["bar"]
+    assert "Changed bar" in third
+
+    # an option rendered while a link target was missing is rendered again once it exists
+    opts["foo"]["description"] = "Foo, see [](#opt-baz)."
+    with pytest.raises(KeyError):
+        render(opts)
+    opts["baz"] = opts["bar"] | { "loc": ["baz"] }
+    fourth, rendered = render(opts)
+    assert rendered == ["foo", "baz"]
+    assert "Foo, see \\fBbaz\\fR[1]" in fourth
+
+    # adding options does not invalidate the others
+    opts["qux"] = opts["bar"] | { "loc": ["qux"] }
+    _fifth, rendered = render(opts)
+    assert rendered == ["qux"]
+
+    # other converters (or configurations) do not share entries
+    c = nixos_render_docs.options.CommonMarkConverter({}, 'local', render_cache = cache)
+    c.add_options(opts)
+    assert len(list(cache.glob("*.json"))) == 6 + 4
+
+@pytest.mark.parametrize("jobs", [ None, 2 ])
+def test_options_multi(jobs: int | None, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(nixos_render_docs.parallel, "pool_processes", jobs)
+    with Path('tests/sample_options_simple.json').open() as f:
+        opts = json.load(f)
+
+    def converters() -> list[nixos_render_docs.options.BaseConverter[Any]]:
+        return [
+            ManpageConverter('local', None, None),
+            nixos_render_docs.options.CommonMarkConverter({}, 'local'),
+            nixos_render_docs.options.AsciiDocConverter({}, 'local'),
+        ]
+
+    parsed = []
+    parse = nixos_render_docs.md.Converter._parse
+    def record(self: nixos_render_docs.md.Converter[Any], src: str) -> list[Token]:
+        parsed.append(src)
+        return parse(self, src)
+
+    with patch.object(nixos_render_docs.md.Converter, "_parse", record):
+        single = converters()
+        for c in single:
+            c.add_options(opts)
+        single_parsed, parsed[:] = list(parsed), []
+
+        multi = converters()
+        nixos_render_docs.options.MultiConverter(multi).add_options(opts)
+
+    assert [ c.finalize() for c in multi ] == [ c.finalize() for c in single ]
+    if jobs is None:
+        assert sorted(parsed) == sorted(set(single_parsed))
+        assert len(parsed) < len(single_parsed)
@@ -0,0 +1,55 @@
+from pathlib import Path
+from typing import Any
+from unittest.mock import patch
+
+from nixos_render_docs.manual import HTMLConverter, HTMLParameters
+from nixos_render_docs.md import Converter
+
+
+def write_manual(tmp_path: Path, chapter: str) -> None:
+    (tmp_path / "index.md").write_text(
+        "# Book {#book}\n## Subtitle\n"
+        "```{=include=} chapters auto-id-prefix=auto\nchapter.md\nother.md\n```\n"
+    )
+    (tmp_path / "chapter.md").write_text(chapter)
+    (tmp_path / "other.md").write_text("# Other {#other}\n\nText with a [link](#chapter).\n")
+
+
+def convert(tmp_path: Path, cache: Path) -> tuple[str, list[str]]:
+    md = HTMLConverter("1.0.0", HTMLParameters("", [], [], 2, 2, 2, Path("")), {}, None, cache)
+    parsed = []
+    parse = Converter._parse
+    def record(self: Converter[Any], src: str) -> object:
+        parsed.append(src.split("\n", 1)[0])
+        return parse(self, src)
+    with patch.object(Converter, "_parse", record):
+        md.convert(tmp_path / "index.md", tmp_path / "index.html")
+    return (tmp_path / "index.html").read_text(), parsed
+
+
+def test_parse_cache(tmp_path: Path) -> None:
+    cache = tmp_path / "cache"
+    write_manual(tmp_path, "# Chapter {#chapter}\n\n## Section\n")
+
+    first, parsed = convert(tmp_path, cache)
+    assert parsed == ["# Book {#book}", "# Chapter {#chapter}", "# Other {#other}"]
+    assert len(list(cache.glob("*.json"))) == 3
+
+    # nothing changed, nothing is parsed again
+    second, parsed = convert(tmp_path, cache)
+    assert parsed == []
+    assert second == first
+
+    # only the changed file is parsed again
+    write_manual(tmp_path, "# Chapter {#chapter}\n\n## Changed section\n")
+    third, parsed = convert(tmp_path, cache)
+    assert parsed == ["# Chapter {#chapter}"]
+    assert "Changed section" in third
+    assert 'id="auto-3-1.1"' in third
+
+    # broken entries are parsed and written again
+    for entry in cache.glob("*.json"):
+        entry.write_text("{")
+    fourth, parsed = convert(tmp_path, cache)
+    assert len(parsed) == 3
+    assert fourth == third
@@ -1,4 +1,5 @@
 import json
+import tempfile
 import unittest
 from pathlib import Path
 
@@ -7,8 +8,13 @@ from nixos_render_docs.redirects import Redirects, RedirectsError
 
 
 class TestRedirects(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = Path(tmp.name)
+
     def setup_test(self, sources, raw_redirects):
-        with open(Path(__file__).parent / 'index.md', 'w') as infile:
+        with open(self.dir / 'index.md', 'w') as infile:
             indexHTML = ["# Redirects test suite {#redirects-test-suite}\n## Setup steps"]
             for path in sources.keys():
                 outpath = f"{path.split('.md')[0]}.html"
@@ -16,14 +22,14 @@ class TestRedirects(unittest.TestCase):
             infile.write("\n".join(indexHTML))
 
         for filename, content in sources.items():
-            with open(Path(__file__).parent / filename, 'w') as infile:
+            with open(self.dir / filename, 'w') as infile:
                 infile.write(content)
 
         redirects = Redirects({"redirects-test-suite": ["index.html#redirects-test-suite"]} | raw_redirects, '')
         return HTMLConverter("1.0.0", HTMLParameters("", [], [], 2, 2, 2, Path("")), {}, redirects)
 
     def run_test(self, md: HTMLConverter):
-        md.convert(Path(__file__).parent / 'index.md', Path(__file__).parent / 'index.html')
+        md.convert(self.dir / 'index.md', self.dir / 'index.html')
 
     def assert_redirect_error(self, expected_errors: dict, md: HTMLConverter):
         with self.assertRaises(RuntimeError) as context:
@@ -257,3 +263,25 @@ class TestRedirects(unittest.TestCase):
         client_redirects = md._redirects.get_client_redirects("foo.html")
         expected_redirects = {'old': 'bar.html#bar'}
         self.assertEqual(client_redirects, expected_redirects)
+
+    def test_redirect_scripts(self):
+        """Test that every output page gets a script with exactly its own client-side redirects"""
+        md = self.setup_test(
+            sources={"foo.md": "# Foo {#foo}", "bar.md": "# Bar {#bar}"},
+            raw_redirects={
+                'foo': ['foo.html#foo', 'foo-prime.html', 'bar.html#old-foo'],
+                'bar': ['bar.html#bar', 'foo-prime.html#old-bar', 'foo.html#old-bar'],
+            },
+        )
+        md._redirects._redirects_script = 'REDIRECTS_PLACEHOLDER'
+        self.run_test(md)
+
+        scripts = {}
+        for page in ["index", "foo", "bar"]:
+            with open(self.dir / f"{page}-redirects.js") as script:
+                scripts[page] = json.load(script)
+        self.assertEqual(scripts, {
+            "index": {},
+            "foo": {'old-bar': 'bar.html#bar'},
+            "bar": {'old-foo': 'foo.html#foo'},
+        })